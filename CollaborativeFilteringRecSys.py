@@ -1,52 +1,94 @@
+import os
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import OneHotEncoder, StandardScaler
-from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics.pairwise import cosine_similarity
+from ann import build_index, check_recall, load_index
+from artifacts import catalog_meta, check_catalog, new_model_version, read_meta, staging, write_meta
+from catalog import append_rows
+from features import FeaturePipeline, memory_footprint
+from instrumentation import stage
+from records import make_records
 
 class CollaborativeFilteringRecSys:
-    def __init__(self, playlist_data, song_dataset, k=30):
+    def __init__(self, playlist_data, song_dataset, k=30, index='exact', index_params=None):
+        # index: 'exact' for brute-force KNN (the reference) or 'lsh' for the approximate index in ann.py
         self.playlist_data = playlist_data
         self.song_dataset = song_dataset
         self.k = k
         self.categorical_cols = ['track_id', 'track_name', 'artist_names', 'genre']
         self.numerical_cols = ['popularity', 'duration_ms']
-        self.onehot_encoder = OneHotEncoder(handle_unknown='ignore')
-        self.scaler = StandardScaler()
+        self.features = FeaturePipeline(self.categorical_cols, self.numerical_cols, multi_label_cols=['genre']) # one column per single genre
+        self.index = index
+        self.index_params = index_params or {}
         self.knn_model = None
         self.preprocessed_data = None
+        self.catalog_features = None
+        self.track_rows = None
+        self.num_catalog_rows = None # song dataset rows before add_tracks, later rows were added from playlists
+        self.model_version = None # new on every fit, add_tracks and remove_tracks
 
-    def preprocess_data(self):
+    @staticmethod
+    def prepare_song_dataset(song_dataset):
         # Drop unwanted columns
         columns_to_drop = ['Unnamed: 0', 'danceability','energy','key','loudness','mode','speechiness','acousticness','instrumentalness','liveness','valence','tempo','time_signature']
 
-        self.song_dataset = self.song_dataset.drop(columns=columns_to_drop)
+        song_dataset = song_dataset.drop(columns=columns_to_drop, errors='ignore') # the columnar catalog may already leave these out
         # Rename columns
-        column_mapping = {'artist_name': 'artists_names'}
-        self.song_dataset = self.song_dataset.rename(columns=column_mapping)
-                                                     
+        column_mapping = {'artist_name': 'artist_names'} # match the playlist and liked songs column name
+        song_dataset = song_dataset.rename(columns=column_mapping)
+        # Create 'decade' column
+        song_dataset['decade'] = (song_dataset['year'] // 10) * 10
+        return song_dataset
+
+    @staticmethod
+    def prepare_playlist(playlist_data):
         columns_to_drop = ['explicit','album','uri']
-        self.playlist_data = self.playlist_data.drop(columns=columns_to_drop)
+        playlist_data = playlist_data.drop(columns=columns_to_drop)
         column_mapping = {'release_date': 'year'}
-        self.playlist_data = self.playlist_data.rename(columns=column_mapping)
-        self.playlist_data['year'] = self.playlist_data['year'].str.split('-').str[0].astype(int)
+        playlist_data = playlist_data.rename(columns=column_mapping)
+        playlist_data['year'] = playlist_data['year'].str.split('-').str[0].astype(int)
 
         # Create 'decade' column
-        self.playlist_data['decade'] = (self.playlist_data['year'] // 10) * 10
-        self.song_dataset['decade'] = (self.song_dataset['year'] // 10) * 10
+        playlist_data['decade'] = (playlist_data['year'] // 10) * 10
+        return playlist_data
 
-        # One-hot encoding for categorical columns
-        onehot_encoded = self.onehot_encoder.fit_transform(self.playlist_data[self.categorical_cols])
+    def preprocess_data(self):
+        with stage('collab.prepare', items=len(self.song_dataset) + len(self.playlist_data)):
+            self.song_dataset = self.prepare_song_dataset(self.song_dataset)
+            self.playlist_data = self.prepare_playlist(self.playlist_data)
+        self.num_catalog_rows = len(self.song_dataset)
 
-        # Normalization for numerical columns
-        normalized_data = self.scaler.fit_transform(self.playlist_data[self.numerical_cols])
+        # One-hot encoding for categorical columns and normalization for numerical columns, kept sparse.
+        # The recommendations come from the song dataset, so that is what gets featurized and indexed
+        with stage('collab.encode', items=len(self.song_dataset) + len(self.playlist_data)):
+            self.catalog_features = self.features.fit_transform(self.song_dataset)
+            self.preprocessed_data = self.features.transform(self.playlist_data)
 
-        # Combine one-hot encoded and normalized data
-        self.preprocessed_data = pd.concat([pd.DataFrame(onehot_encoded.toarray()), pd.DataFrame(normalized_data)], axis=1)
+    def feature_memory(self):
+        # Memory used by the catalog feature matrix
+        return memory_footprint(self.catalog_features)
 
     def train_model(self):
-        # Create KNN model based on https://scikit-learn.org/stable/modules/neighbors.html
-        self.knn_model = NearestNeighbors(n_neighbors=self.k, metric='cosine')
-        self.knn_model.fit(self.preprocessed_data)
+        # Create KNN model based on https://scikit-learn.org/stable/modules/neighbors.html (or the approximate index)
+        with stage('collab.fit', items=self.catalog_features.shape[0]):
+            self.knn_model = build_index(self.index, **self.index_params).fit(self.catalog_features)
+        # The index keeps a normalized copy of the features. Cosine distance ignores the norms, so that copy
+        # replaces the raw one (half the memory, and a saved model queries exactly like the fitted one)
+        self.catalog_features = self.knn_model.features
+        self.index_tracks()
+        self.model_version = new_model_version()
+
+    def index_tracks(self):
+        # Map every track id to its row in the song dataset, leaving out the rows remove_tracks took out of the index
+        track_ids = pd.Index(np.asarray(self.song_dataset['track_id'], dtype=object))
+        self.track_rows = pd.Series(np.arange(len(track_ids)), index=track_ids)
+        if self.knn_model.deleted is not None:
+            self.track_rows = self.track_rows[~self.knn_model.deleted]
+        self.track_rows = self.track_rows[~self.track_rows.index.duplicated()] # first row of every track
+
+    def index_recall(self, k=10, num_queries=200):
+        # recall@k of the approximate index against exact KNN, measured on a sample of catalog songs
+        queries = self.catalog_features[np.random.default_rng(0).choice(self.catalog_features.shape[0], min(num_queries, self.catalog_features.shape[0]), replace=False)]
+        return check_recall(self.catalog_features, queries, k, **self.index_params)
 
     def recommend(self, playlist_data):
         # Convert playlist_data to a DataFrame if it's a Series
@@ -54,19 +96,171 @@ class CollaborativeFilteringRecSys:
             playlist_data = pd.DataFrame([playlist_data])
 
         # Preprocess the playlist data
-        playlist_onehot = self.onehot_encoder.transform(playlist_data[self.categorical_cols])
-        playlist_normalized = self.scaler.transform(playlist_data[self.numerical_cols])
-        playlist_preprocessed = pd.concat([pd.DataFrame(playlist_onehot.toarray()), pd.DataFrame(playlist_normalized)], axis=1)
+        with stage('collab.encode', items=len(playlist_data)):
+            playlist_preprocessed = self.features.transform(playlist_data)
 
-        # Find the nearest neighbors
-        distances, indices = self.knn_model.kneighbors(playlist_preprocessed)
+        # Find the nearest neighbors of every playlist song in one batched query, leaving room for the playlist's own songs
+        with stage('collab.kneighbors', items=len(playlist_data)):
+            distances, indices = self.knn_model.kneighbors(playlist_preprocessed, self.k + len(playlist_data))
 
-        # Get the recommended songs from the song dataset
-        recommended_songs = []
-        for idx in indices.flatten():
-            recommended_song = self.song_dataset.iloc[idx]
-            if recommended_song['track_id'] not in playlist_data['track_id'].values:
-                recommended_songs.append(recommended_song)
+        # Get the recommended songs from the song dataset, best rank of every playlist song first
+        rows = indices.T.ravel()
+        rows = pd.unique(rows[rows >= 0])
+        recommended_songs = self.song_dataset.iloc[rows]
+        recommended_songs = recommended_songs[~recommended_songs['track_id'].isin(playlist_data['track_id'])]
 
         # Return the top-n recommended songs
-        return pd.DataFrame(recommended_songs[:self.k])
\ No newline at end of file
+        return recommended_songs.head(self.k)
+
+    def recommend_many(self, track_ids, num_recs=None):
+        """
+        This function recommends the nearest songs for many seed tracks from the song dataset in one batched query.
+
+        Parameters:
+            track_ids (list): Seed track ids. Seeds that are not in the song dataset get no recommendations.
+            num_recs (int): Number of recommendations per seed, defaults to k.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in track_ids), rank, row (in song_dataset) and track_id.
+        """
+        num_recs = num_recs or self.k
+        seed_rows = self.track_rows.reindex(pd.Index(track_ids, dtype=object)).to_numpy()
+        found = np.flatnonzero(~np.isnan(seed_rows))
+        seed_rows = seed_rows[found].astype(np.int64)
+        if len(found) == 0:
+            return make_records([], [], [], [])
+        with stage('collab.kneighbors', items=len(seed_rows)):
+            distances, indices = self.knn_model.kneighbors(self.catalog_features[seed_rows], num_recs + 1)
+
+        # Drop the seed itself (and any other copy of it) and missing neighbours, then keep num_recs per seed
+        all_ids = self.song_dataset['track_id']
+        neighbour_ids = np.asarray(all_ids.iloc[np.maximum(indices, 0).ravel()], dtype=object).reshape(indices.shape)
+        seed_ids = np.asarray(all_ids.iloc[seed_rows], dtype=object)
+        keep = (indices >= 0) & (neighbour_ids != seed_ids[:, None])
+        keep &= np.cumsum(keep, axis=1) <= num_recs
+        seed_pos, rank_pos = np.nonzero(keep)
+        ranks = np.cumsum(keep, axis=1)[keep]
+        return make_records(found[seed_pos], ranks, indices[keep], neighbour_ids[keep])
+
+    def add_tracks(self, playlist_data):
+        """
+        This function adds songs to the playlist without refitting. Songs the song dataset does not have yet are
+        added to it too: their new categorical values extend the feature vocabulary (as new columns, so the rows
+        already indexed are not encoded again), they update the scaler statistics and they are inserted into the
+        neighbour index.
+
+        Parameters:
+            playlist_data (pandas.DataFrame): Songs with the columns written by utils.get_playlist_songs.
+
+        Returns:
+            int: Number of songs added to the song dataset.
+        """
+        songs = self.prepare_playlist(playlist_data)
+        new = songs[~songs['track_id'].isin(self.track_rows.index)].drop_duplicates('track_id')
+        if len(new):
+            self.features.extend(new)
+            self.features.partial_fit(new)
+            self.song_dataset = append_rows(self.song_dataset, new)
+            rows = self.knn_model.add(self.features.transform(new))
+            self.catalog_features = self.knn_model.features
+            self.track_rows = pd.concat([self.track_rows, pd.Series(rows, index=pd.Index(new['track_id'], dtype=object))])
+        self.playlist_data = pd.concat([self.playlist_data, songs], ignore_index=True)
+        self.preprocessed_data = self.features.transform(self.playlist_data)
+        self.model_version = new_model_version()
+        return len(new)
+
+    def remove_tracks(self, track_ids):
+        """
+        This function removes songs from the playlist without refitting. Songs that add_tracks put into the song
+        dataset leave it again: they are taken out of the scaler statistics and tombstoned in the neighbour index.
+        Songs of the original song dataset stay recommendable.
+
+        Parameters:
+            track_ids (list): Track ids to remove.
+
+        Returns:
+            int: Number of songs removed from the song dataset.
+        """
+        track_ids = pd.Index(track_ids, dtype=object)
+        self.playlist_data = self.playlist_data[~self.playlist_data['track_id'].isin(track_ids)].reset_index(drop=True)
+        rows = self.track_rows.reindex(track_ids).dropna().astype(np.int64)
+        rows = rows[(rows >= self.num_catalog_rows) & ~rows.index.isin(self.playlist_data['track_id'])]
+        if len(rows):
+            self.features.forget(self.song_dataset.iloc[rows.to_numpy()])
+            self.knn_model.remove(rows.to_numpy())
+            self.track_rows = self.track_rows.drop(rows.index)
+        self.preprocessed_data = self.features.transform(self.playlist_data)
+        self.model_version = new_model_version()
+        return len(rows)
+
+    def refit_agreement(self, num_queries=200):
+        """
+        This function measures how far add_tracks/remove_tracks have drifted from a full refit: the scaler statistics
+        the indexed rows were encoded with get stale as songs come and go. A fresh model is fitted on the same songs
+        and both answer the same queries.
+
+        Parameters:
+            num_queries (int): Seed songs sampled for recommend_many, the playlist is queried as well.
+
+        Returns:
+            dict: Fraction of the refitted model's recommendations the updated model also returns, for the sampled
+            seeds ('seed_recall') and for the whole playlist ('playlist_recall').
+        """
+        live = np.sort(self.track_rows.to_numpy())
+        refit = CollaborativeFilteringRecSys(self.playlist_data, self.song_dataset.iloc[live].reset_index(drop=True),
+                                             k=self.k, index=self.index, index_params=self.index_params)
+        refit.catalog_features = refit.features.fit_transform(refit.song_dataset)
+        refit.preprocessed_data = refit.features.transform(refit.playlist_data)
+        refit.num_catalog_rows = len(refit.song_dataset)
+        refit.train_model()
+
+        seeds = self.track_rows.index[np.random.default_rng(0).choice(len(self.track_rows), min(num_queries, len(self.track_rows)), replace=False)]
+        ours, theirs = self.recommend_many(seeds), refit.recommend_many(seeds)
+        pairs = lambda records: set(zip(records['seed'].tolist(), records['track_id'].tolist()))
+        seed_recall = len(pairs(ours) & pairs(theirs)) / max(len(theirs), 1)
+        ours, theirs = set(self.recommend(self.playlist_data)['track_id']), set(refit.recommend(refit.playlist_data)['track_id'])
+        return {'seed_recall': seed_recall, 'playlist_recall': len(ours & theirs) / max(len(theirs), 1)}
+
+    def save(self, path):
+        # Write the fitted pipeline, the index and the (preprocessed) playlist as a versioned artifact (see artifacts.py)
+        with staging(path) as tmp_path:
+            self.features.save(os.path.join(tmp_path, 'features'))
+            self.knn_model.save(os.path.join(tmp_path, 'index'))
+            self.playlist_data.to_json(os.path.join(tmp_path, 'playlist.json'), orient='split', index=False)
+            # Songs add_tracks put into the song dataset, they are appended to the catalog again on load
+            added = self.song_dataset.iloc[self.num_catalog_rows:]
+            added.astype(object).to_json(os.path.join(tmp_path, 'added_songs.json'), orient='split', index=False)
+            write_meta(tmp_path, 'collab', k=self.k, index=self.index, index_params=self.index_params,
+                       model_version=self.model_version, **catalog_meta(self.song_dataset.iloc[:self.num_catalog_rows]))
+
+    @classmethod
+    def load(cls, path, song_dataset, mmap=True):
+        """
+        This function loads a fitted recommender written by save, ready to recommend without preprocess_data and train_model.
+
+        Parameters:
+            path (str): Directory the recommender was saved to.
+            song_dataset (pandas.DataFrame): The catalog it was fitted on.
+            mmap (bool): Memory-map the feature and index arrays instead of reading them into memory.
+
+        Returns:
+            CollaborativeFilteringRecSys: The loaded recommender.
+
+        Raises:
+            ValueError: If the artifact was fitted on another catalog.
+        """
+        meta = read_meta(path, 'collab')
+        check_catalog(meta, song_dataset, path)
+        playlist_data = pd.read_json(os.path.join(path, 'playlist.json'), orient='split', dtype=False)
+        song_dataset = cls.prepare_song_dataset(song_dataset)
+        added = pd.read_json(os.path.join(path, 'added_songs.json'), orient='split', dtype=False)
+        model = cls(playlist_data, append_rows(song_dataset, added) if len(added) else song_dataset,
+                    k=meta['k'], index=meta['index'], index_params=meta['index_params'])
+        model.num_catalog_rows = len(song_dataset)
+        model.features = FeaturePipeline.load(os.path.join(path, 'features'))
+        model.knn_model = load_index(os.path.join(path, 'index'), mmap)
+        model.catalog_features = model.knn_model.features # as in train_model
+        model.preprocessed_data = model.features.transform(model.playlist_data)
+        model.index_tracks()
+        model.model_version = meta.get('model_version') or new_model_version()
+        return model
@@ -1,107 +1,398 @@
+import os
+from itertools import chain
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import OneHotEncoder, StandardScaler
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics.pairwise import cosine_similarity
-import random
+import scipy.sparse as sp
+from artifacts import catalog_meta, check_catalog, load_array, new_model_version, load_csr, read_meta, save_array, save_csr, staging, write_meta
+from features import FeaturePipeline, memory_footprint
+from instrumentation import stage
+from records import make_records
+
+# Upper bound on the (catalog chunk x seeds) score block computed at once
+SCORE_BLOCK_SIZE = 1 << 22
+
+# Streaming mode (train_streaming): catalog columns read per chunk, and the categorical features. The track_id and
+# track_name one-hot blocks are left out there, they would make the model as wide as the catalog
+STREAMING_COLUMNS = ['track_id', 'artist_name', 'genre', 'popularity', 'duration_ms', 'year']
+STREAMING_CATEGORICAL_COLS = ['artist_names', 'genre']
+
+def _leading_rows(matrix, num_rows):
+    # The first rows of a CSR matrix as views of its arrays (slicing copies them, and would read a memory-mapped matrix)
+    end = matrix.indptr[num_rows]
+    return sp.csr_matrix((matrix.data[:end], matrix.indices[:end], matrix.indptr[:num_rows + 1]), shape=(num_rows, matrix.shape[1]), copy=False)
+
+def _merge_top(best_rows, best_scores, rows, scores, num_recs):
+    # Running top num_recs per seed: the best of the kept (seeds x num_recs) entries and a (seeds x block) score block
+    rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+    scores = np.concatenate([best_scores, scores], axis=1)
+    keep = np.argpartition(-scores, num_recs - 1, axis=1)[:, :num_recs]
+    return np.take_along_axis(rows, keep, axis=1), np.take_along_axis(scores, keep, axis=1)
+
+def _sorted_top(best_rows, best_scores):
+    # Best first, the entries that were never filled (or only by the seed) get row -1
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best_rows = np.take_along_axis(best_rows, order, axis=1)
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    best_rows[~np.isfinite(best_scores)] = -1
+    return best_rows, best_scores
 
 class ContentBasedRecSys:
-    def __init__(self, song_dataset, liked_songs_dataset, n_songs=100, test_size=0.2):
+    def __init__(self, song_dataset, liked_songs_dataset, n_songs=100, test_size=0.2, random_state=None):
         self.song_dataset = song_dataset
         self.liked_songs_dataset = liked_songs_dataset
         self.n_songs = n_songs
         self.test_size = test_size
+        self.random_state = random_state # seed for the training samples and split, None for a different one every run
         self.categorical_cols = ['track_id', 'track_name', 'artist_names', 'genre']
         self.numerical_cols = ['popularity', 'duration_ms']
-        self.onehot_encoder = OneHotEncoder(handle_unknown='ignore')
-        self.scaler = StandardScaler()
+        self.features = FeaturePipeline(self.categorical_cols, self.numerical_cols, multi_label_cols=['genre']) # one column per single genre
         self.model = None
         self.preprocessed_data = None
         self.train_data = None
         self.test_data = None
+        self.test_songs = None
+        self.catalog_features = None
+        self.catalog_norms = None
+        self.catalog_prob = None
+        self.track_codes = None
+        self.track_rows = None
+        self.model_version = None # new on every fit
 
-    def preprocess_data(self):
+    @staticmethod
+    def prepare_song_dataset(song_dataset):
         # Drop unwanted columns
         columns_to_drop = ['Unnamed: 0', 'danceability','energy','key','loudness','mode','speechiness','acousticness','instrumentalness','liveness','valence','tempo','time_signature']
 
-        self.song_dataset = self.song_dataset.drop(columns=columns_to_drop)
+        song_dataset = song_dataset.drop(columns=columns_to_drop, errors='ignore') # the columnar catalog may already leave these out
         # Rename columns
-        column_mapping = {'artist_name': 'artists_names'}
-        self.song_dataset = self.song_dataset.rename(columns=column_mapping)
-                                                     
+        column_mapping = {'artist_name': 'artist_names'} # match the playlist and liked songs column name
+        song_dataset = song_dataset.rename(columns=column_mapping)
+        # Create 'decade' column
+        song_dataset['decade'] = (song_dataset['year'] // 10) * 10
+        return song_dataset
+
+    @staticmethod
+    def prepare_liked_songs(liked_songs_dataset):
         columns_to_drop = ['explicit','album','uri']
-        self.liked_songs_dataset = self.liked_songs_dataset.drop(columns=columns_to_drop)
+        liked_songs_dataset = liked_songs_dataset.drop(columns=columns_to_drop)
         column_mapping = {'release_date': 'year'}
-        self.liked_songs_dataset = self.liked_songs_dataset.rename(columns=column_mapping)
-        self.liked_songs_dataset['year'] = self.liked_songs_dataset['year'].str.split('-').str[0].astype(int)
+        liked_songs_dataset = liked_songs_dataset.rename(columns=column_mapping)
+        liked_songs_dataset['year'] = liked_songs_dataset['year'].str.split('-').str[0].astype(int)
 
         # Create 'decade' column
-        self.liked_songs_dataset['decade'] = (self.liked_songs_dataset['year'] // 10) * 10
-        self.song_dataset['decade'] = (self.song_dataset['year'] // 10) * 10
-        # Combine the song dataset and liked songs dataset
-        combined_dataset = pd.concat([self.song_dataset, self.liked_songs_dataset])
+        liked_songs_dataset['decade'] = (liked_songs_dataset['year'] // 10) * 10
+        return liked_songs_dataset
 
-        # One-hot encoding for categorical columns
-        onehot_encoded = self.onehot_encoder.fit_transform(combined_dataset[self.categorical_cols])
+    def preprocess_data(self):
+        with stage('content.prepare', items=len(self.song_dataset) + len(self.liked_songs_dataset)):
+            self.song_dataset = self.prepare_song_dataset(self.song_dataset)
+            self.liked_songs_dataset = self.prepare_liked_songs(self.liked_songs_dataset)
+            # Combine the song dataset and liked songs dataset
+            combined_dataset = pd.concat([self.song_dataset, self.liked_songs_dataset])
 
-        # Normalization for numerical columns
-        normalized_data = self.scaler.fit_transform(combined_dataset[self.numerical_cols])
+        # One-hot encoding for categorical columns and normalization for numerical columns, kept sparse
+        with stage('content.encode', items=len(combined_dataset)):
+            self.preprocessed_data = self.features.fit_transform(combined_dataset)
 
-        # Combine one-hot encoded and normalized data
-        self.preprocessed_data = pd.concat([pd.DataFrame(onehot_encoded.toarray()), pd.DataFrame(normalized_data)], axis=1)
+    def feature_memory(self):
+        # Memory used by the preprocessed feature matrix
+        return memory_footprint(self.preprocessed_data)
 
     def train_model(self):
         # Select random songs from the liked songs dataset and the overall song dataset
-        liked_songs_sample = self.liked_songs_dataset.sample(n=self.n_songs)
-        song_dataset_sample = self.song_dataset.sample(n=self.n_songs)
+        rng = np.random.default_rng(self.random_state)
+        liked_songs_sample = self.liked_songs_dataset.sample(n=self.n_songs, random_state=rng)
+        song_dataset_sample = self.song_dataset.sample(n=self.n_songs, random_state=rng)
 
         # Combine the sampled datasets
         train_dataset = pd.concat([liked_songs_sample, song_dataset_sample])
 
         # Preprocess the train dataset
-        train_onehot = self.onehot_encoder.transform(train_dataset[self.categorical_cols])
-        train_normalized = self.scaler.transform(train_dataset[self.numerical_cols])
-        train_preprocessed = pd.concat([pd.DataFrame(train_onehot.toarray()), pd.DataFrame(train_normalized)], axis=1)
+        train_preprocessed = self.features.transform(train_dataset)
 
         # Create target labels (1 for liked songs, 0 for randomly sampled songs)
         target = [1] * self.n_songs + [0] * self.n_songs
 
-        # Split the preprocessed data into train and test sets
-        self.train_data, self.test_data, train_target, test_target = train_test_split(
-            train_preprocessed, target, test_size=self.test_size, stratify=target
+        # Split the preprocessed data into train and test sets, keeping the songs behind the test rows
+        from sklearn.linear_model import LogisticRegression # imported on use, like all of scikit-learn (see cli.py)
+        from sklearn.model_selection import train_test_split
+        train_rows, test_rows, train_target, test_target = train_test_split(
+            np.arange(len(target)), target, test_size=self.test_size, stratify=target, random_state=self.random_state
         )
+        self.train_data = train_preprocessed[train_rows]
+        self.test_data = train_preprocessed[test_rows]
+        self.test_songs = train_dataset.iloc[test_rows]
 
         # Create and train the Logistic Regression model
-        self.model = LogisticRegression()
-        self.model.fit(self.train_data, train_target)
+        with stage('content.fit', items=self.train_data.shape[0]):
+            self.model = LogisticRegression()
+            self.model.fit(self.train_data, train_target)
+        with stage('content.cache', items=len(self.song_dataset)):
+            self.cache_catalog_features()
+        self.model_version = new_model_version()
+
+    def cache_catalog_features(self):
+        # Cache what scoring needs for every catalog song once: the fitted features (the catalog rows come first in
+        # preprocessed_data), their norms, the probability of being liked and the track code used to skip the seed
+        self.catalog_features = _leading_rows(self.preprocessed_data, len(self.song_dataset))
+        self.catalog_norms = np.sqrt(np.asarray(self.catalog_features.multiply(self.catalog_features).sum(axis=1), dtype=np.float32).ravel())
+        self.catalog_norms[self.catalog_norms == 0] = 1
+        weights = self.model.coef_.ravel().astype(np.float32)
+        self.catalog_prob = 1 / (1 + np.exp(-(self.catalog_features @ weights + np.float32(self.model.intercept_[0]))))
+        self.index_tracks()
+
+    def index_tracks(self):
+        # Map every track id to its first row in the song dataset
+        self.track_codes, track_ids = pd.factorize(np.asarray(self.song_dataset['track_id'], dtype=object))
+        first_rows = np.full(len(track_ids), -1, dtype=np.int64)
+        first_rows[self.track_codes[::-1]] = np.arange(len(self.track_codes))[::-1]
+        self.track_rows = pd.Series(first_rows, index=pd.Index(track_ids, dtype=object))
+
+    def score_catalog(self, seed_rows, num_recs):
+        """
+        This function scores every catalog song against many seed songs at once and keeps the top num_recs per seed.
+        The score is the cosine similarity to the seed times the probability that the candidate is liked.
+
+        Parameters:
+            seed_rows (numpy.ndarray): Catalog rows of the seed songs.
+            num_recs (int): Number of songs to keep per seed.
+
+        Returns:
+            tuple: (rows, scores) arrays of shape (len(seed_rows), num_recs), best first. Missing entries are -1 and -inf.
+        """
+        self._require_catalog()
+        seeds = self.catalog_features[seed_rows]
+        # Only the feature columns the seeds use can contribute, so the seeds fit in a small dense block
+        columns = np.unique(seeds.indices)
+        seed_block = (seeds[:, columns].toarray() / self.catalog_norms[seed_rows][:, None]).T.astype(np.float32)
+        seed_codes = self.track_codes[seed_rows]
+
+        num_seeds = len(seed_rows)
+        best_rows = np.full((num_seeds, num_recs), -1, dtype=np.int64)
+        best_scores = np.full((num_seeds, num_recs), -np.inf, dtype=np.float32)
+        chunk_size = max(1024, SCORE_BLOCK_SIZE // max(num_seeds, 1))
+        for start in range(0, self.catalog_features.shape[0], chunk_size):
+            stop = min(start + chunk_size, self.catalog_features.shape[0])
+            # (chunk x seeds) cosine similarities weighted by the like probability of every candidate
+            scores = self.catalog_features[start:stop][:, columns] @ seed_block
+            scores *= (self.catalog_prob[start:stop] / self.catalog_norms[start:stop])[:, None]
+            scores[self.track_codes[start:stop][:, None] == seed_codes[None, :]] = -np.inf # never recommend the seed
+            best_rows, best_scores = _merge_top(best_rows, best_scores, np.arange(start, stop), scores.T, num_recs)
+        return _sorted_top(best_rows, best_scores)
+
+    def _require_catalog(self):
+        # The in-memory methods score the cached catalog features of train_model (or load), train_streaming has none
+        if self.catalog_features is None:
+            raise ValueError("The recommender has no cached catalog features: call train_model or load first, or use "
+                             "recommend_streaming after train_streaming.")
+
+    def get_recommendations_many(self, song_ids, num_recs=30):
+        """
+        This function recommends catalog songs for many seed songs with one pass over the catalog.
+
+        Parameters:
+            song_ids (list): Seed track ids. Seeds that are not in the song dataset get no recommendations.
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in song_ids), rank, row (in song_dataset) and track_id.
+        """
+        self._require_catalog()
+        seed_rows = self.track_rows.reindex(pd.Index(song_ids, dtype=object)).to_numpy()
+        found = np.flatnonzero(~np.isnan(seed_rows))
+        if len(found) == 0:
+            return make_records([], [], [], [])
+        with stage('content.score', items=len(found)):
+            rows, scores = self.score_catalog(seed_rows[found].astype(np.int64), num_recs)
+        seed_pos, rank_pos = np.nonzero(rows >= 0)
+        recommended = rows[seed_pos, rank_pos]
+        return make_records(found[seed_pos], rank_pos + 1, recommended, self.song_dataset['track_id'].iloc[recommended])
 
     def get_recommendations(self, song_id, num_recs=30):
         # Find the song in the song dataset
-        song_data = self.song_dataset[self.song_dataset['track_id'] == song_id]
+        self._require_catalog()
+        seed_row = self.track_rows.get(song_id)
 
-        if song_data.empty:
+        if seed_row is None:
             print(f"Song with ID {song_id} not found in the dataset.")
             return None
 
-        # Preprocess the song data
-        song_onehot = self.onehot_encoder.transform(song_data[self.categorical_cols])
-        song_normalized = self.scaler.transform(song_data[self.numerical_cols])
-        song_preprocessed = pd.concat([pd.DataFrame(song_onehot.toarray()), pd.DataFrame(song_normalized)], axis=1)
+        # Score the whole catalog: cosine similarity to the song times the predicted probability of being liked
+        rows, scores = self.score_catalog(np.array([seed_row]), num_recs)
 
-        # Predict the probability of the song being liked
-        song_prob = self.model.predict_proba(song_preprocessed)[:, 1]
+        # Return the top-k recommended songs
+        return self.song_dataset.iloc[rows[0][rows[0] >= 0]]
 
-        # Calculate the cosine similarity between the song and all songs in the test set
-        test_onehot = self.onehot_encoder.transform(self.test_data[self.categorical_cols])
-        test_normalized = self.scaler.transform(self.test_data[self.numerical_cols])
-        test_preprocessed = pd.concat([pd.DataFrame(test_onehot.toarray()), pd.DataFrame(test_normalized)], axis=1)
-        similarities = cosine_similarity(song_preprocessed, test_preprocessed).flatten()
+    def _catalog_chunks(self, store, chunk_size):
+        # The catalog store a chunk at a time, prepared like song_dataset (the index holds the catalog rows). Track ids
+        # stay dictionary codes, so the dictionary of every track id in the catalog is never loaded
+        for chunk in store.iter_chunks(STREAMING_COLUMNS, chunk_size, codes=['track_id']):
+            yield self.prepare_song_dataset(chunk)
 
-        # Combine the similarity scores and predicted probabilities
-        recommendation_scores = similarities * song_prob
+    def train_streaming(self, store, chunk_size=100000, negative_fraction=0.05, epochs=1, **sgd_params):
+        """
+        This function trains on all liked songs and a large pool of catalog negatives without loading the catalog: it is
+        read a chunk at a time, featurized on the fly and fed to an incremental logistic regression (SGDClassifier with
+        partial_fit). Memory depends on the chunk size and the liked songs, not on the size of the catalog.
 
-        # Get the indices of the top-k recommended songs
-        top_indices = recommendation_scores.argsort()[-num_recs:][::-1]
+        Parameters:
+            store (catalog.CatalogStore): The catalog, e.g. CatalogStore.open('spotify_data.csv').
+            chunk_size (int): Catalog rows per chunk.
+            negative_fraction (float): Fraction of the catalog drawn as negatives, the same rows in every epoch. Liked
+            songs are never negatives.
+            epochs (int): Passes over the catalog.
+            **sgd_params: Extra SGDClassifier parameters.
 
-        # Return the top-k recommended songs
-        return self.test_data.iloc[top_indices]
\ No newline at end of file
+        Returns:
+            ContentBasedRecSys: The trained recommender, see recommend_streaming.
+        """
+        rng = np.random.default_rng(self.random_state)
+        liked = self.prepare_liked_songs(self.liked_songs_dataset)
+        liked_codes = store.lookup('track_id', list(liked['track_id']))
+        is_test = rng.random(len(liked)) < self.test_size # held out liked songs, like the test split of train_model
+
+        # First pass: the scaler statistics and vocabularies. Then every chunk's negatives plus its share of the liked
+        # songs make one partial_fit step. The liked songs are weighted so both classes weigh the same
+        self.features = FeaturePipeline(STREAMING_CATEGORICAL_COLS, self.numerical_cols, multi_label_cols=['genre'])
+        # The catalog is never featurized as a whole, drop what an earlier train_model cached (see _require_catalog)
+        self.preprocessed_data = self.catalog_features = self.catalog_norms = self.catalog_prob = None
+        self.features.fit_chunks(chain([liked], self._catalog_chunks(store, chunk_size)))
+        positives = self.features.transform(liked[~is_test])
+        num_chunks = -(-store.num_rows // chunk_size)
+        positive_weight = max(store.num_rows * negative_fraction, 1) / max(positives.shape[0], 1)
+        from sklearn.linear_model import SGDClassifier
+        self.model = SGDClassifier(loss='log_loss', random_state=int(rng.integers(2 ** 31)), **sgd_params)
+        chunk_seed = int(rng.integers(2 ** 63))
+
+        # Test negatives: as many catalog songs as held out liked songs, the smallest draws outside the training negatives
+        num_test = int(is_test.sum())
+        test_negatives = liked.iloc[:0]
+        for epoch in range(epochs):
+            shares = np.array_split(rng.permutation(positives.shape[0]), num_chunks)
+            for number, (chunk, share) in enumerate(zip(self._catalog_chunks(store, chunk_size), shares)):
+                draws = np.random.default_rng([chunk_seed, number]).random(len(chunk))
+                candidates = ~np.isin(chunk['track_id'].to_numpy(), liked_codes)
+                negatives = chunk[candidates & (draws < negative_fraction)]
+                features = sp.vstack([self.features.transform(negatives), positives[share]], format='csr')
+                target = np.concatenate([np.zeros(len(negatives)), np.ones(len(share))])
+                weights = np.concatenate([np.ones(len(negatives)), np.full(len(share), positive_weight)])
+                self.model.partial_fit(features, target, classes=[0, 1], sample_weight=weights)
+                if epoch == 0 and num_test:
+                    test = candidates & (draws >= negative_fraction)
+                    test_negatives = pd.concat([test_negatives, chunk[test].assign(draw=draws[test])]).nsmallest(num_test, 'draw')
+
+        test_negatives = test_negatives.drop(columns='draw', errors='ignore')
+        test_negatives['track_id'] = store.decode('track_id', test_negatives['track_id'].to_numpy())
+        self.test_songs = pd.concat([liked[is_test], test_negatives])
+        self.test_data = self.features.transform(self.test_songs)
+        self.model_version = new_model_version()
+        return self
+
+    def _streaming_seeds(self, store, song_ids, chunk_size):
+        # Track codes and first catalog rows of the seeds found in the store, one pass over the track id codes
+        codes = store.lookup('track_id', list(song_ids))
+        found = np.flatnonzero(codes >= 0)
+        first_rows = {}
+        track_codes = store.codes('track_id')
+        for start in range(0, store.num_rows, chunk_size):
+            block = np.asarray(track_codes[start:start + chunk_size])
+            for row in np.flatnonzero(np.isin(block, codes[found])):
+                first_rows.setdefault(int(block[row]), start + int(row))
+        found = found[[code in first_rows for code in codes[found]]] if len(found) else found
+        return found, codes[found], np.array([first_rows[code] for code in codes[found]], dtype=np.int64)
+
+    def recommend_streaming(self, store, song_ids, num_recs=30, chunk_size=100000):
+        """
+        This function recommends catalog songs for many seed songs after train_streaming, streaming over the catalog:
+        every chunk is featurized and scored (cosine similarity to the seed times the predicted probability of being
+        liked). Seeds are scored in blocks that keep the (chunk x seeds) score block under SCORE_BLOCK_SIZE, and every
+        block is merged into the running top num_recs of its seeds with argpartition.
+
+        Parameters:
+            store (catalog.CatalogStore): The catalog the model was trained on.
+            song_ids (list): Seed track ids. Seeds that are not in the catalog get no recommendations.
+            num_recs (int): Number of recommendations per seed.
+            chunk_size (int): Catalog rows per chunk.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in song_ids), rank, row (in the catalog) and track_id.
+        """
+        found, seed_codes, seed_rows = self._streaming_seeds(store, song_ids, chunk_size)
+        if len(found) == 0:
+            return make_records([], [], [], [])
+        seed_songs = self.prepare_song_dataset(pd.concat([store.read(STREAMING_COLUMNS, row, row + 1, codes=['track_id']) for row in seed_rows]))
+        seeds = self.features.transform(seed_songs)
+        columns = np.unique(seeds.indices)
+        seed_norms = np.sqrt(np.asarray(seeds.multiply(seeds).sum(axis=1)).ravel())
+        seed_block = (seeds[:, columns].toarray() / np.where(seed_norms > 0, seed_norms, 1)[:, None]).T.astype(np.float32)
+
+        best_rows = np.full((len(found), num_recs), -1, dtype=np.int64)
+        best_scores = np.full((len(found), num_recs), -np.inf, dtype=np.float32)
+        for chunk in self._catalog_chunks(store, chunk_size):
+            features = self.features.transform(chunk)
+            norms = np.sqrt(np.asarray(features.multiply(features).sum(axis=1)).ravel())
+            weights = (self.model.predict_proba(features)[:, 1] / np.where(norms > 0, norms, 1)).astype(np.float32)
+            candidates = features[:, columns]
+            chunk_codes = chunk['track_id'].to_numpy()
+            seed_block_size = max(1, SCORE_BLOCK_SIZE // max(len(chunk), 1))
+            for start in range(0, len(found), seed_block_size):
+                block = slice(start, start + seed_block_size)
+                # (chunk x seed block) cosine similarities weighted by the like probability of every candidate
+                scores = np.asarray(candidates @ seed_block[:, block], dtype=np.float32)
+                scores *= weights[:, None]
+                scores[chunk_codes[:, None] == seed_codes[None, block]] = -np.inf # never recommend the seed
+                best_rows[block], best_scores[block] = _merge_top(best_rows[block], best_scores[block], chunk.index.to_numpy(), scores.T, num_recs)
+
+        best_rows, _ = _sorted_top(best_rows, best_scores)
+        seed_pos, rank_pos = np.nonzero(best_rows >= 0)
+        rows = best_rows[seed_pos, rank_pos]
+        return make_records(found[seed_pos], rank_pos + 1, rows, store.decode('track_id', np.asarray(store.codes('track_id')[rows])))
+
+    def save(self, path):
+        # Write the fitted pipeline, the model weights and the cached catalog scores as a versioned artifact (see artifacts.py)
+        self._require_catalog()
+        with staging(path) as tmp_path:
+            self.features.save(os.path.join(tmp_path, 'features'))
+            save_csr(tmp_path, 'preprocessed', self.preprocessed_data)
+            for name in ('catalog_norms', 'catalog_prob'):
+                save_array(tmp_path, name, getattr(self, name))
+            for name in ('coef_', 'intercept_', 'classes_'):
+                save_array(tmp_path, 'model.' + name.strip('_'), getattr(self.model, name))
+            write_meta(tmp_path, 'content', n_songs=self.n_songs, test_size=self.test_size, random_state=self.random_state,
+                       shape=list(self.preprocessed_data.shape), model_version=self.model_version, **catalog_meta(self.song_dataset))
+
+    @classmethod
+    def load(cls, path, song_dataset, liked_songs_dataset=None, mmap=True):
+        """
+        This function loads a fitted recommender written by save, ready to recommend without preprocess_data and train_model.
+        The train and test splits are not part of the artifact.
+
+        Parameters:
+            path (str): Directory the recommender was saved to.
+            song_dataset (pandas.DataFrame): The catalog it was fitted on.
+            liked_songs_dataset (pandas.DataFrame): The liked songs, only needed to train again.
+            mmap (bool): Memory-map the feature and score arrays instead of reading them into memory.
+
+        Returns:
+            ContentBasedRecSys: The loaded recommender.
+
+        Raises:
+            ValueError: If the artifact was fitted on another catalog.
+        """
+        meta = read_meta(path, 'content')
+        check_catalog(meta, song_dataset, path)
+        model = cls(cls.prepare_song_dataset(song_dataset), liked_songs_dataset, n_songs=meta['n_songs'],
+                    test_size=meta['test_size'], random_state=meta['random_state'])
+        model.features = FeaturePipeline.load(os.path.join(path, 'features'))
+        model.preprocessed_data = load_csr(path, 'preprocessed', tuple(meta['shape']), mmap)
+        from sklearn.linear_model import LogisticRegression
+        model.model = LogisticRegression()
+        for name in ('coef_', 'intercept_', 'classes_'):
+            setattr(model.model, name, load_array(path, 'model.' + name.strip('_'), mmap=False))
+        model.model.n_features_in_ = model.model.coef_.shape[1]
+        model.catalog_features = _leading_rows(model.preprocessed_data, len(model.song_dataset))
+        model.catalog_norms = load_array(path, 'catalog_norms', mmap)
+        model.catalog_prob = load_array(path, 'catalog_prob', mmap)
+        model.index_tracks()
+        model.model_version = meta.get('model_version') or new_model_version()
+        return model
@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from instrumentation import stage
+from records import make_records
+
+### Hybrid recommender: every engine runs concurrently, the answer is ready when the budget runs out.
+# Engines are recommend_many functions (see server.load_engines). Each request starts all of them on
+# a thread pool and waits at most `budget` seconds; engines that are late, busy or failing are left
+# out. The results of the primary engines are merged with weighted reciprocal-rank fusion (RRF):
+# a track scores sum(weight / (rrf_k + rank)) over the engines that returned it. Seeds that end up
+# with fewer than num_recs tracks are topped up from the cheap fallback engines.
+
+RRF_K = 60
+TIMING_SAMPLES = 10000 # durations kept per engine for the percentiles
+
+class EngineTimings:
+    def __init__(self):
+        self.calls = 0
+        self.late = 0
+        self.busy = 0
+        self.errors = 0
+        self.durations = deque(maxlen=TIMING_SAMPLES)
+
+    def snapshot(self):
+        durations = np.array(self.durations) * 1000
+        return {
+            'calls': self.calls, 'late': self.late, 'busy': self.busy, 'errors': self.errors,
+            'p50_ms': float(np.percentile(durations, 50)) if len(durations) else None,
+            'p99_ms': float(np.percentile(durations, 99)) if len(durations) else None,
+        }
+
+class HybridRecSys:
+    def __init__(self, engines, weights=None, fallbacks=('popular', 'random'), budget=0.1, rrf_k=RRF_K):
+        """
+        Parameters:
+            engines (dict): Engine name -> recommend_many function returning records (see records.make_records).
+            weights (dict): Engine name -> RRF weight of the primary engines, 1.0 for engines not listed.
+            fallbacks (list): Engines that only fill seeds the primary engines left short, in this order. Names
+            that are not in engines are ignored.
+            budget (float): Seconds a request may take. Engines that have not answered by then are dropped.
+            rrf_k (int): RRF rank offset, higher values flatten the difference between top and lower ranks.
+        """
+        self.engines = dict(engines)
+        self.weights = {name: 1.0 for name in self.engines}
+        self.weights.update(weights or {})
+        self.fallbacks = [name for name in fallbacks if name in self.engines]
+        self.primary = [name for name in self.engines if name not in self.fallbacks]
+        self.budget = budget
+        self.rrf_k = rrf_k
+        self.timings = {name: EngineTimings() for name in self.engines}
+        self.last_report = {}
+        # One thread per engine: an engine still busy with a late call is skipped, so slow engines never pile up
+        self.pool = ThreadPoolExecutor(max_workers=max(len(self.engines), 1), thread_name_prefix='hybrid')
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _call(self, name, track_ids, num_recs):
+        # One engine call on a pool thread, timed there so late calls are recorded once they end
+        started = time.perf_counter()
+        try:
+            return self.engines[name](track_ids, num_recs), time.perf_counter() - started
+        except Exception:
+            with self.lock:
+                self.timings[name].errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.timings[name].durations.append(time.perf_counter() - started)
+
+    def _start(self, name, track_ids, num_recs):
+        # Submit one engine call, None when the engine is still busy with an earlier (late) call
+        with self.lock:
+            self.timings[name].calls += 1
+            if name in self.running and not self.running[name].done():
+                self.timings[name].busy += 1
+                return None
+            self.running[name] = self.pool.submit(self._call, name, track_ids, num_recs)
+            return self.running[name]
+
+    def recommend_many(self, track_ids, num_recs=30):
+        """
+        This function asks every engine for recommendations at once and merges what arrives within the budget.
+
+        Parameters:
+            track_ids (list): Seed track ids.
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in track_ids), rank, row and track_id. The row is
+            the one of the best ranked engine that returned the track (engines built on the same catalog share rows).
+            How long every engine took is in last_report.
+        """
+        track_ids = list(track_ids)
+        start = time.perf_counter()
+        futures = {name: self._start(name, track_ids, num_recs) for name in self.engines}
+        wait([future for future in futures.values() if future is not None], timeout=self.budget)
+
+        report, results = {}, {}
+        for name, future in futures.items():
+            if future is None:
+                report[name] = {'status': 'busy'}
+            elif not future.done():
+                report[name] = {'status': 'late'}
+                with self.lock:
+                    self.timings[name].late += 1
+            elif future.exception() is not None:
+                report[name] = {'status': 'error', 'error': repr(future.exception())}
+            else:
+                results[name], duration = future.result()
+                report[name] = {'status': 'ok', 'ms': duration * 1000}
+        with stage('hybrid.merge', items=len(track_ids)):
+            records = self._merge(results, num_recs)
+        report['total_ms'] = (time.perf_counter() - start) * 1000
+        self.last_report = report
+        return records
+
+    def _merge(self, results, num_recs):
+        # Weighted RRF over the primary engines, then the fallbacks in order, deduplicated by (seed, track_id). Plain
+        # NumPy: the merge runs while late engines still hold the interpreter, so it has to be cheap
+        parts = [(name, records) for name, records in results.items() if len(records)]
+        if not parts:
+            return make_records([], [], [], [])
+        seeds = np.concatenate([records['seed'] for _, records in parts]).astype(np.int64)
+        ranks = np.concatenate([records['rank'] for _, records in parts]).astype(np.float64)
+        rows = np.concatenate([records['row'] for _, records in parts])
+        track_ids = np.concatenate([np.asarray(records['track_id'], dtype=object) for _, records in parts])
+        fallback = np.concatenate([np.full(len(records), name in self.fallbacks) for name, records in parts])
+        weights = np.concatenate([np.full(len(records), self.weights[name]) for name, records in parts])
+        tiers = np.concatenate([np.full(len(records), self.fallbacks.index(name) if name in self.fallbacks else 0)
+                                for name, records in parts])
+        # Fallback scores sit below every fused score: earlier fallbacks and better ranks first
+        scores = np.where(fallback, -(tiers * (num_recs + 1) + ranks), weights / (self.rrf_k + ranks))
+
+        # One group per (seed, track), its best ranked entry gives the row
+        track_codes = np.unique(track_ids, return_inverse=True)[1].ravel()
+        keys = seeds * (track_codes.max() + 1) + track_codes
+        order = np.lexsort((ranks, keys))
+        groups, first, inverse = np.unique(keys[order], return_index=True, return_inverse=True)
+        fused = np.bincount(inverse, weights=np.where(fallback[order], 0, scores[order]), minlength=len(groups))
+        has_primary = np.bincount(inverse, weights=~fallback[order], minlength=len(groups)) > 0
+        best_fallback = np.full(len(groups), -np.inf)
+        np.maximum.at(best_fallback, inverse, np.where(fallback[order], scores[order], -np.inf))
+        group_scores = np.where(has_primary, fused, best_fallback)
+        group_rows = order[first]
+
+        # Best num_recs groups per seed
+        ranking = np.lexsort((ranks[group_rows], -group_scores, seeds[group_rows]))
+        ranked_seeds = seeds[group_rows][ranking]
+        position = np.arange(len(ranking)) - np.searchsorted(ranked_seeds, ranked_seeds)
+        keep = ranking[position < num_recs]
+        picked = group_rows[keep]
+        return make_records(seeds[picked], position[position < num_recs] + 1, rows[picked], track_ids[picked])
+
+    def report(self):
+        # Per engine: calls, late/busy/error counts and p50/p99 duration (late calls included once they end)
+        with self.lock:
+            return {name: timings.snapshot() for name, timings in self.timings.items()}
@@ -0,0 +1,276 @@
+import os
+import shutil
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from artifacts import load_csr, load_values, new_model_version, read_meta, save_csr, save_values, staging, write_meta
+from instrumentation import stage
+from records import make_records
+
+### Item-item collaborative filtering over many playlists.
+# Playlists are a sparse playlist x track CSR matrix (int32 track ids, one column per distinct track).
+# Two tracks are similar when they are in the same playlists: the cosine of their columns,
+# co-occurrences / sqrt(playlists of a * playlists of b). The similarity is computed a chunk of
+# tracks at a time (a sparse matmul per chunk, spread over worker processes) and only the top_k
+# most similar tracks of every track are kept, so memory grows with the number of tracks and
+# not with the number of track pairs. Rows of the similarity matrix are stored sorted by score.
+
+_worker_matrices = None
+
+def read_playlists(paths):
+    # The track ids of every playlist CSV (the Playlists/*.csv schema), one playlist at a time
+    for path in paths:
+        yield pd.read_csv(path, usecols=['track_id'])['track_id'].dropna()
+
+def playlist_matrix(playlists):
+    """
+    This function builds the playlist x track matrix, interning track ids into int32 column numbers as it goes.
+
+    Parameters:
+        playlists (iterable): Playlists, each an iterable of track ids. Read once, so it can be a generator.
+
+    Returns:
+        tuple: scipy.sparse.csr_matrix of shape (playlists, tracks) with a 1 for every track of a playlist,
+        and the pandas Index of the track id of every column.
+    """
+    vocabulary = {}
+    indices = array('i')
+    indptr = array('q', [0])
+    for tracks in playlists:
+        indices.extend(sorted({vocabulary.setdefault(track_id, len(vocabulary)) for track_id in tracks}))
+        indptr.append(len(indices))
+    indices = np.frombuffer(indices, dtype=np.int32) if len(indices) else np.zeros(0, dtype=np.int32)
+    indptr = np.frombuffer(indptr, dtype=np.int64)
+    if indptr[-1] < np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    matrix = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                           shape=(len(indptr) - 1, len(vocabulary)), copy=False)
+    return matrix, pd.Index(list(vocabulary), dtype=object)
+
+def _attach_matrices(path, num_playlists, num_tracks):
+    # Worker initializer: memory-map the matrices the parent wrote, the page cache is shared by all workers
+    global _worker_matrices
+    _worker_matrices = (load_csr(path, 'by_track', (num_tracks, num_playlists)),
+                        load_csr(path, 'by_playlist', (num_playlists, num_tracks)),
+                        np.load(os.path.join(path, 'norms.npy'), mmap_mode='r'))
+
+def _similar_tracks(start, end, top_k, shrinkage, matrices=None):
+    """
+    This function computes the top_k most similar tracks of the tracks start to end.
+
+    Parameters:
+        start (int): First track of the chunk.
+        end (int): End of the chunk.
+        top_k (int): Similar tracks kept per track.
+        shrinkage (float): Added to the cosine denominator, pulls down pairs seen in few playlists.
+        matrices (tuple): (track x playlist CSR, playlist x track CSR, track norms), the worker's if None.
+
+    Returns:
+        tuple: Number of similar tracks per track, their columns (int32) and their scores (float32), best first.
+    """
+    by_track, by_playlist, norms = matrices or _worker_matrices
+    cooccurrences = (by_track[start:end] @ by_playlist).tocsr()
+    cooccurrences.sort_indices()
+    rows = np.repeat(np.arange(end - start), np.diff(cooccurrences.indptr))
+    columns = cooccurrences.indices
+    scores = cooccurrences.data / (norms[rows + start] * norms[columns] + shrinkage)
+    scores[columns == rows + start] = 0 # a track is not similar to itself
+
+    # Sort every row by score (rows stay in order), then keep the first top_k positive scores of every row
+    order = np.lexsort((-scores, rows))
+    rank = np.arange(len(order)) - cooccurrences.indptr[rows]
+    keep = order[(rank < top_k) & (scores[order] > 0)]
+    return (np.bincount(rows[keep], minlength=end - start), columns[keep].astype(np.int32), scores[keep].astype(np.float32))
+
+class ItemItemRecSys:
+    def __init__(self, top_k=100, shrinkage=0.0, chunk_entries=2 ** 23, workers=None):
+        """
+        Parameters:
+            top_k (int): Similar tracks kept per track, bounds the size of the similarity matrix.
+            shrinkage (float): Added to the cosine denominator, pulls down pairs seen in few playlists.
+            chunk_entries (int): Most co-occurrences one sparse matmul may produce, bounds the memory of one chunk.
+            workers (int): Worker processes for the similarity (default: one per core, 0 computes it in this process).
+        """
+        self.top_k = top_k
+        self.shrinkage = shrinkage
+        self.chunk_entries = chunk_entries
+        self.workers = workers
+        self.track_ids = None # track id of every row and column of the similarity matrix
+        self.similarity = None # (tracks, tracks) CSR, top_k columns per row sorted by score
+        self.num_playlists = 0
+        self.catalog_rows = None # catalog row of every track (-1 when the catalog does not have it), see use_catalog
+        self.model_version = None # new on every fit
+
+    def fit(self, playlists):
+        # Build the playlist x track matrix (see playlist_matrix) and compute the similarity from it
+        with stage('itemitem.playlists') as run:
+            matrix, track_ids = playlist_matrix(playlists)
+            run.items = matrix.shape[0]
+        return self.fit_matrix(matrix, track_ids)
+
+    def fit_matrix(self, matrix, track_ids):
+        """
+        This function computes the top_k pruned item-item similarity of a playlist x track matrix.
+
+        Parameters:
+            matrix (scipy.sparse.spmatrix): Playlist x track matrix, non-zero where a track is in a playlist.
+            track_ids (list): Track id of every column.
+
+        Returns:
+            ItemItemRecSys: The fitted recommender.
+        """
+        if matrix.shape[1] != len(track_ids):
+            raise ValueError(f"The matrix has {matrix.shape[1]} tracks, got {len(track_ids)} track ids.")
+        by_playlist = sp.csr_matrix(matrix, dtype=np.float32, copy=True)
+        by_playlist.sum_duplicates()
+        by_playlist.data[:] = 1 # membership, repeated tracks count once
+        num_playlists, num_tracks = by_playlist.shape
+        by_track = by_playlist.T.tocsr()
+        norms = np.sqrt(np.diff(by_track.indptr)).astype(np.float32) # sqrt of the number of playlists of every track
+        chunks = self._chunks(by_track, by_playlist)
+
+        with stage('itemitem.similarity', items=num_tracks):
+            if self.workers == 0 or len(chunks) <= 1:
+                results = [_similar_tracks(start, end, self.top_k, self.shrinkage, (by_track, by_playlist, norms)) for start, end in chunks]
+            else:
+                # Workers memory-map the matrices from a temporary directory instead of receiving a copy each
+                path = tempfile.mkdtemp(prefix='itemitem')
+                try:
+                    save_csr(path, 'by_track', by_track)
+                    save_csr(path, 'by_playlist', by_playlist)
+                    np.save(os.path.join(path, 'norms.npy'), norms)
+                    del by_track
+                    with ProcessPoolExecutor(max_workers=self.workers or os.cpu_count(), initializer=_attach_matrices,
+                                             initargs=(path, num_playlists, num_tracks)) as pool:
+                        futures = [pool.submit(_similar_tracks, start, end, self.top_k, self.shrinkage) for start, end in chunks]
+                        results = [future.result() for future in futures]
+                finally:
+                    shutil.rmtree(path, ignore_errors=True)
+
+        counts = np.concatenate([result[0] for result in results]) if results else np.zeros(0, dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        if indptr[-1] < np.iinfo(np.int32).max:
+            indptr = indptr.astype(np.int32)
+        indices = np.concatenate([result[1] for result in results]) if results else np.zeros(0, dtype=np.int32)
+        data = np.concatenate([result[2] for result in results]) if results else np.zeros(0, dtype=np.float32)
+        self.similarity = sp.csr_matrix((data, indices, indptr), shape=(num_tracks, num_tracks), copy=False)
+        self.track_ids = pd.Index(track_ids, dtype=object)
+        self.num_playlists = num_playlists
+        self.model_version = new_model_version()
+        return self
+
+    def _chunks(self, by_track, by_playlist):
+        # Split the tracks into runs whose co-occurrences stay under chunk_entries. The co-occurrences of a track
+        # are at most the summed lengths of its playlists, popular tracks get small chunks and rare ones big chunks
+        bound = by_track @ np.diff(by_playlist.indptr).astype(np.float64)
+        ends = np.searchsorted(np.cumsum(bound), np.arange(1, int(bound.sum() // self.chunk_entries) + 1) * self.chunk_entries)
+        ends = np.unique(np.concatenate([np.minimum(ends + 1, len(bound)), [len(bound)]]))
+        return list(zip(np.concatenate([[0], ends[:-1]]).tolist(), ends.tolist())) if len(bound) else []
+
+    def use_catalog(self, catalog):
+        """
+        This function ties the recommender to a catalog, as the other engines are: recommend_many then returns catalog
+        rows and leaves out the tracks of the playlists that the catalog does not have.
+
+        Parameters:
+            catalog (pandas.DataFrame): The catalog, with a track_id column.
+
+        Returns:
+            ItemItemRecSys: The recommender.
+        """
+        catalog_ids = pd.Index(np.asarray(catalog['track_id'], dtype=object))
+        first = np.flatnonzero(~catalog_ids.duplicated()) # a track listed twice is recommended as its first row
+        rows = catalog_ids[first].get_indexer(self.track_ids)
+        self.catalog_rows = np.where(rows >= 0, first[np.maximum(rows, 0)], -1)
+        self.model_version = new_model_version()
+        return self
+
+    def lookup(self, track_ids):
+        # Row of every track id, -1 for tracks that are in no playlist
+        return self.track_ids.get_indexer(pd.Index(track_ids, dtype=object))
+
+    def recommend_many(self, track_ids, num_recs=30):
+        """
+        This function recommends the tracks most often found in the same playlists as each seed track.
+
+        Parameters:
+            track_ids (list): Seed track ids. Seeds that are in no playlist get no recommendations.
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in track_ids), rank, row (in track_ids of the
+            recommender, or in the catalog after use_catalog) and track_id.
+        """
+        rows = self.lookup(track_ids)
+        seeds = np.flatnonzero(rows >= 0)
+        starts = self.similarity.indptr[rows[seeds]]
+        lengths = self.similarity.indptr[rows[seeds] + 1] - starts
+        if self.catalog_rows is None:
+            lengths = np.minimum(lengths, num_recs)
+        # Rows are sorted by score, so the recommendations of a seed are the first num_recs entries of its row
+        ranks = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        columns = np.asarray(self.similarity.indices[np.repeat(starts, lengths) + ranks])
+        seeds = np.repeat(seeds, lengths)
+        if self.catalog_rows is None:
+            return make_records(seeds, ranks + 1, columns, self.track_ids[columns])
+        # Skip the tracks the catalog does not have, then the first num_recs entries that are left
+        columns, seeds = columns[self.catalog_rows[columns] >= 0], seeds[self.catalog_rows[columns] >= 0]
+        ranks = np.arange(len(seeds)) - np.searchsorted(seeds, seeds)
+        keep = ranks < num_recs
+        columns = columns[keep]
+        return make_records(seeds[keep], ranks[keep] + 1, self.catalog_rows[columns], self.track_ids[columns])
+
+    def recommend(self, track_ids, num_recs=30):
+        """
+        This function recommends tracks for a whole playlist: the similarities to all of its tracks are summed.
+
+        Parameters:
+            track_ids (list): Track ids of the playlist.
+            num_recs (int): Number of recommendations.
+
+        Returns:
+            pandas.DataFrame: track_id and score of the recommended tracks, best first, without the playlist's own tracks.
+        """
+        rows = self.lookup(track_ids)
+        rows = np.unique(rows[rows >= 0])
+        neighbours = self.similarity[rows]
+        # Scores of the tracks the playlist's rows touch only, the cost does not grow with the number of tracks
+        columns, positions = np.unique(neighbours.indices, return_inverse=True)
+        scores = np.bincount(positions, weights=neighbours.data, minlength=len(columns))
+        scores[np.isin(columns, rows)] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > num_recs:
+            candidates = candidates[np.argpartition(-scores[candidates], num_recs - 1)[:num_recs]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return pd.DataFrame({'track_id': np.asarray(self.track_ids[columns[candidates]], dtype=object), 'score': scores[candidates]})
+
+    def save(self, path):
+        # Write the similarity matrix and the track ids as a versioned artifact (see artifacts.py)
+        with staging(path) as tmp_path:
+            save_csr(tmp_path, 'similarity', self.similarity)
+            track_ids = save_values(tmp_path, 'track_ids', self.track_ids)
+            write_meta(tmp_path, 'itemitem', top_k=self.top_k, shrinkage=self.shrinkage, num_playlists=self.num_playlists,
+                       num_tracks=len(self.track_ids), track_ids=track_ids, model_version=self.model_version)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        This function loads a recommender written by save, memory-mapping the similarity matrix by default.
+
+        Parameters:
+            path (str): Directory the recommender was saved to.
+            mmap (bool): Memory-map the arrays instead of reading them into memory.
+
+        Returns:
+            ItemItemRecSys: The loaded recommender.
+        """
+        meta = read_meta(path, 'itemitem')
+        model = cls(top_k=meta['top_k'], shrinkage=meta['shrinkage'])
+        model.track_ids = load_values(path, 'track_ids', meta['track_ids'])
+        model.similarity = load_csr(path, 'similarity', (meta['num_tracks'], meta['num_tracks']), mmap)
+        model.num_playlists = meta['num_playlists']
+        model.model_version = meta.get('model_version') or new_model_version()
+        return model
@@ -1,40 +1,86 @@
-from config import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+import os
+from artifacts import catalog_meta, check_catalog, new_model_version, read_meta, staging, write_meta
+from catalog import catalog_version
+from genre_index import GenreIndex
+from instrumentation import stage
+from spotify_metadata import default_fetcher, lookup_errors
 
-SCOPE = "user-library-read user-top-read"
 ### Source for all Spotipy related functionality (where it was learned from): https://spotipy.readthedocs.io/en/2.22.1/
 class PopularRec:
-    def __init__(self, data):
+    def __init__(self, data, fetcher=None, index=None):
         self.data = data
+        self.fetcher = fetcher # SpotifyMetadataFetcher for tracks missing from data, the shared one if None
+        self.index = index if index is not None else GenreIndex(data) # genre -> rows sorted by popularity, built once
+        self.model_version = catalog_version(data) or new_model_version() # the index only depends on the catalog
 
     def recommend(self, track_id, num_recs=30):
-        if track_id in self.data['track_id'].values:
-            target_song = self.data.loc[self.data['track_id'] == track_id]
-            song_name = target_song['track_name'].values[0]
-            artist = target_song['artist_name'].values[0]
-            target_genre = target_song['genre'].values[0]
+        row = self.index.lookup([track_id])[0]
+        if row >= 0:
+            song_name = self.data['track_name'].iat[row]
+            artist = self.data['artist_name'].iat[row]
+            target_genre = self.data['genre'].iat[row]
         else:
             # If track_id is not in the dataset, use Spotipy API to get the track features
             try:
-                SPOT_CLIENT =  spotipy.Spotify(auth_manager=SpotifyOAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT, scope=SCOPE))
-                track = SPOT_CLIENT.track(track_id)
-                song_name = track['name']
-                artist = track['artists'][0]['name']
-                target_genre = SPOT_CLIENT.artist(track['artists'][0]['id'])['genres'][0]
-            except:
+                with stage('popular.spotify', items=1):
+                    song_name, artist, target_genre = (self.fetcher or default_fetcher()).track_summary(track_id) # pooled client, cached lookups
+            except lookup_errors():
                 print("The specified track_id is invalid or not found on Spotify.")
                 return
         
-        same_genre_songs = self.data[self.data['genre'] == target_genre]
-        same_genre_songs = same_genre_songs[same_genre_songs['track_id'] != track_id]  # make sure we do not recommend the song sent by the user
-        same_genre_songs = same_genre_songs.sort_values('popularity', ascending=False)
+        # the top of the genre's popularity ordering, without the song sent by the user. Genres from Spotify are a
+        # list, they are matched partially against the catalog's genres (best match first, see genres.py)
+        with stage('popular.select', items=1):
+            if row >= 0:
+                recommended_rows = self.index.top(self.index.genre_code(target_genre), num_recs, exclude_row=row)
+            else:
+                recommended_rows = self.index.top_matching(target_genre, num_recs)
+        recommended_songs = self.data.iloc[recommended_rows]
         
         results = []
         print("Recommendations for:", song_name, "by", artist)
-        for i, (_, row) in enumerate(same_genre_songs.head(num_recs).iterrows(), start=1): # print out and return results of reocmmendations
-            song_title = row['track_name']
-            artist = row['artist_name']
+        for i, (song_title, artist) in enumerate(zip(recommended_songs['track_name'], recommended_songs['artist_name']), start=1): # print out and return results of reocmmendations
             print(f"Recommendation #{i}: {song_title} by {artist}")
-        results.append(f"Recommendation #{i}: {song_title} by {artist}")
-        return results
\ No newline at end of file
+            results.append(f"Recommendation #{i}: {song_title} by {artist}")
+        return results
+
+    def recommend_many(self, track_ids, num_recs=30):
+        """
+        This function recommends the most popular same-genre songs for many seed tracks in one call.
+
+        Parameters:
+            track_ids (list): Seed track ids. Seeds that are not in the dataset get no recommendations.
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in track_ids), rank, row (in self.data) and track_id.
+        """
+        with stage('popular.select', items=len(track_ids)):
+            return self.index.to_records(*self.index.top_many(self.index.lookup(track_ids), num_recs))
+
+    def save(self, path):
+        # Write the genre index as a versioned artifact (see artifacts.py)
+        with staging(path) as tmp_path:
+            self.index.save(os.path.join(tmp_path, 'index'))
+            write_meta(tmp_path, 'popular', **catalog_meta(self.data))
+
+    @classmethod
+    def load(cls, path, data, fetcher=None, mmap=True):
+        """
+        This function loads a recommender written by save, memory-mapping its arrays by default.
+
+        Parameters:
+            path (str): Directory the recommender was saved to.
+            data (pandas.DataFrame): The catalog it was built on.
+            fetcher (SpotifyMetadataFetcher): Fetcher for tracks missing from data, the shared one if None.
+            mmap (bool): Memory-map the arrays instead of reading them into memory.
+
+        Returns:
+            PopularRec: The loaded recommender.
+
+        Raises:
+            ValueError: If the artifact was built on another catalog.
+        """
+        meta = read_meta(path, 'popular')
+        check_catalog(meta, data, path)
+        return cls(data, fetcher=fetcher, index=GenreIndex.load(os.path.join(path, 'index'), data, mmap))
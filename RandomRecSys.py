@@ -1,43 +1,87 @@
-import random as rand
-from config import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-
-SCOPE = "user-library-read user-top-read"
+import numpy as np
+import os
+from artifacts import catalog_meta, check_catalog, new_model_version, read_meta, staging, write_meta
+from catalog import catalog_version
+from genre_index import GenreIndex
+from instrumentation import stage
+from spotify_metadata import default_fetcher, lookup_errors
 
 class RandomRec:
-    def __init__(self, data):
+    def __init__(self, data, seed=None, fetcher=None, index=None):
         self.data = data
+        self.fetcher = fetcher # SpotifyMetadataFetcher for tracks missing from data, the shared one if None
+        self.index = index if index is not None else GenreIndex(data) # genre -> rows, built once
+        self.model_version = catalog_version(data) or new_model_version() # the index only depends on the catalog
+        self.rng = np.random.default_rng(seed) # pass a seed for reproducible recommendations
 
     def recommend(self, track_id, num_recs=30):
-        if track_id in self.data['track_id'].values: # first check if the track is in the data set, if not we need to access its features using the spotify api
-            target_song = self.data.loc[self.data['track_id'] == track_id]
-            song_name = target_song['track_name'].values[0]
-            artist = target_song['artist_name'].values[0]
-            target_genre = target_song['genre'].values[0]
+        row = self.index.lookup([track_id])[0]
+        if row >= 0: # first check if the track is in the data set, if not we need to access its features using the spotify api
+            song_name = self.data['track_name'].iat[row]
+            artist = self.data['artist_name'].iat[row]
+            target_genre = self.data['genre'].iat[row]
         else:
             # If track_id is not in the dataset, use Spotipy API to get the track features
             try:
-                SPOT_CLIENT =  spotipy.Spotify(auth_manager=SpotifyOAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT, scope=SCOPE))
-                track = SPOT_CLIENT.track(track_id)
-                song_name = track['name']
-                artist = track['artists'][0]['name']
-                target_genre = SPOT_CLIENT.artist(track['artists'][0]['id'])['genres'][0]
-            except:
+                with stage('random.spotify', items=1):
+                    song_name, artist, target_genre = (self.fetcher or default_fetcher()).track_summary(track_id) # pooled client, cached lookups
+            except lookup_errors():
                 print("The specified track_id is invalid or not found on Spotify.")
                 return
         
-        same_genre_songs = self.data[self.data['genre'] == target_genre]
-        same_genre_songs = same_genre_songs[same_genre_songs['track_id'] != track_id]  # need to make sure we do not use the exact song
-        
-        num_songs = len(same_genre_songs)
-        random_indices = rand.sample(range(num_songs), min(num_songs, num_recs)) # sample random songs from dataset
-        recommended_songs = same_genre_songs.iloc[random_indices]
+        # sample random songs from the same genre, need to make sure we do not use the exact song. Genres from Spotify
+        # are a list, songs of every catalog genre sharing one of them are candidates (see genres.py)
+        with stage('random.select', items=1):
+            if row >= 0:
+                random_rows = self.index.sample(self.index.genre_code(target_genre), num_recs, self.rng, exclude_row=row)
+            else:
+                random_rows = self.index.sample_matching(target_genre, num_recs, self.rng)
+        recommended_songs = self.data.iloc[random_rows]
         results = []
         print("Recommendations for:", song_name, "by", artist)
-        for i, (_, row) in enumerate(recommended_songs.iterrows(), start=1): # print out recommendations
-            song_title = row['track_name']
-            artist = row['artist_name']
+        for i, (song_title, artist) in enumerate(zip(recommended_songs['track_name'], recommended_songs['artist_name']), start=1): # print out recommendations
             print(f"Recommendation #{i}: {song_title} by {artist}")
             results.append(f"Recommendation #{i}: {song_title} by {artist}")
-        return results
\ No newline at end of file
+        return results
+
+    def recommend_many(self, track_ids, num_recs=30):
+        """
+        This function recommends random same-genre songs for many seed tracks in one call.
+
+        Parameters:
+            track_ids (list): Seed track ids. Seeds that are not in the dataset get no recommendations.
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in track_ids), rank, row (in self.data) and track_id.
+        """
+        with stage('random.select', items=len(track_ids)):
+            return self.index.to_records(*self.index.sample_many(self.index.lookup(track_ids), num_recs, self.rng))
+
+    def save(self, path):
+        # Write the genre index as a versioned artifact (see artifacts.py)
+        with staging(path) as tmp_path:
+            self.index.save(os.path.join(tmp_path, 'index'))
+            write_meta(tmp_path, 'random', **catalog_meta(self.data))
+
+    @classmethod
+    def load(cls, path, data, seed=None, fetcher=None, mmap=True):
+        """
+        This function loads a recommender written by save, memory-mapping its arrays by default.
+
+        Parameters:
+            path (str): Directory the recommender was saved to.
+            data (pandas.DataFrame): The catalog it was built on.
+            seed (int): Seed of the random draws.
+            fetcher (SpotifyMetadataFetcher): Fetcher for tracks missing from data, the shared one if None.
+            mmap (bool): Memory-map the arrays instead of reading them into memory.
+
+        Returns:
+            RandomRec: The loaded recommender.
+
+        Raises:
+            ValueError: If the artifact was built on another catalog.
+        """
+        meta = read_meta(path, 'random')
+        check_catalog(meta, data, path)
+        return cls(data, seed=seed, fetcher=fetcher, index=GenreIndex.load(os.path.join(path, 'index'), data, mmap))
@@ -0,0 +1,341 @@
+import json
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+from artifacts import load_array, load_csr, save_array, save_csr
+
+### Nearest neighbour indexes over song feature vectors (cosine distance).
+# ExactIndex is brute-force KNN and serves as the reference. LSHIndex is random-projection LSH in
+# the LSH Forest style: every table hashes a song to the signs of n_bits random projections and
+# keeps the songs sorted by that code. A query reads a fixed window of songs around its own code
+# (and a few probed codes) in every table and re-ranks them by exact cosine distance, so its cost
+# does not grow with the catalog.
+
+PROJECTION_CHUNK = 8192 # rows hashed at a time, bounds the memory of the projection step
+QUERY_CHUNK = 32 # queries re-ranked together, bounds the (candidates x queries) similarity block
+
+def _as_csr(features):
+    return sp.csr_matrix(features, dtype=np.float32)
+
+def _normalize(features):
+    # Rows scaled to unit length. scikit-learn is imported on first use, it is the slowest import of the package
+    from sklearn.preprocessing import normalize
+    return normalize(features)
+
+def _brute_force(features):
+    # Exact cosine KNN over the rows of features
+    from sklearn.neighbors import NearestNeighbors
+    return NearestNeighbors(metric='cosine', algorithm='brute').fit(features)
+
+def _widen(features, num_cols):
+    # The same rows with more (empty) columns, the arrays are shared
+    return sp.csr_matrix((features.data, features.indices, features.indptr), shape=(features.shape[0], num_cols), copy=False)
+
+def _unique(values):
+    # Sorted distinct values and the position of every value among them (sort based, fast on large int arrays)
+    order = np.argsort(values, kind='stable')
+    ordered = values[order]
+    first = np.concatenate(([True], ordered[1:] != ordered[:-1])) if len(ordered) else np.zeros(0, dtype=bool)
+    inverse = np.empty(len(values), dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    return ordered[first], inverse
+
+def _random_signs(columns, num_bits, seed):
+    # Pseudo-random +/-1 entries of a (num_features x num_bits) projection, computed from a hash of
+    # (column, bit) so the projection never has to be stored (one-hot catalogs have millions of columns)
+    keys = (columns.astype(np.uint64)[:, None] * np.uint64(num_bits) + np.arange(num_bits, dtype=np.uint64)[None, :])
+    keys += np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+    with np.errstate(over='ignore'): # splitmix64 finalizer, wraps around on purpose
+        keys ^= keys >> np.uint64(30)
+        keys *= np.uint64(0xBF58476D1CE4E5B9)
+        keys ^= keys >> np.uint64(27)
+        keys *= np.uint64(0x94D049BB133111EB)
+        keys ^= keys >> np.uint64(31)
+    return np.where(keys & np.uint64(1), 1.0, -1.0).astype(np.float32)
+
+class ExactIndex:
+    kind = 'exact'
+
+    def __init__(self):
+        self.features = None
+        self.model = None
+        self.deleted = None # tombstones: rows removed from the index, None while there are none
+
+    def fit(self, features):
+        self.features = _normalize(_as_csr(features))
+        self.model = _brute_force(self.features)
+        self.deleted = None
+        return self
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def num_live(self):
+        return len(self) - (int(self.deleted.sum()) if self.deleted is not None else 0)
+
+    def _widen_to(self, num_cols):
+        # New rows may use feature columns added after fit (see FeaturePipeline.extend), older rows have zeros there
+        if num_cols < self.features.shape[1]:
+            raise ValueError(f"Rows have {num_cols} features, the index has {self.features.shape[1]}.")
+        return _widen(self.features, num_cols)
+
+    def add(self, features):
+        """
+        This function inserts rows into a fitted index, they get the next row numbers.
+
+        Parameters:
+            features (scipy.sparse.spmatrix): Features of the new rows, with at least as many columns as the index.
+
+        Returns:
+            numpy.ndarray: Row numbers of the new rows.
+        """
+        features = _normalize(_as_csr(features))
+        rows = np.arange(len(self), len(self) + features.shape[0])
+        self.features = sp.vstack([self._widen_to(features.shape[1]), features], format='csr')
+        self.model = _brute_force(self.features)
+        if self.deleted is not None:
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(rows), dtype=bool)])
+        return rows
+
+    def remove(self, rows):
+        # Tombstone rows: they stay in the arrays (row numbers are stable) but are never returned again
+        if self.deleted is None:
+            self.deleted = np.zeros(len(self), dtype=bool)
+        self.deleted[np.asarray(rows, dtype=np.int64)] = True
+
+    def _query(self, queries):
+        # Queries can be narrower than the index (features transformed before an extension)
+        queries = _as_csr(queries)
+        return _widen(queries, self.features.shape[1]) if queries.shape[1] < self.features.shape[1] else queries
+
+    def kneighbors(self, queries, k):
+        # Same output as NearestNeighbors.kneighbors: (distances, indices), one row per query
+        k = min(k, self.num_live())
+        if self.deleted is None:
+            return self.model.kneighbors(self._query(queries), n_neighbors=k)
+        # Ask for enough neighbours to skip every tombstone, then keep the first k live ones of every query
+        extra = len(self) - self.num_live()
+        distances, indices = self.model.kneighbors(self._query(queries), n_neighbors=min(k + extra, len(self)))
+        live = np.argsort(self.deleted[indices], axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, live, axis=1), np.take_along_axis(indices, live, axis=1)
+
+    def params(self):
+        return {}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        save_csr(path, 'features', self.features)
+        if self.deleted is not None:
+            save_array(path, 'deleted', self.deleted)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'kind': self.kind, 'shape': list(self.features.shape), 'params': self.params(),
+                       'deleted': self.deleted is not None}, f)
+
+    def _load_arrays(self, path, meta, mmap):
+        self.features = load_csr(path, 'features', tuple(meta['shape']), mmap)
+        self.model = _brute_force(self.features)
+        self._load_deleted(path, meta)
+
+    def _load_deleted(self, path, meta):
+        # Tombstones are copied into memory, remove writes to them
+        self.deleted = load_array(path, 'deleted', mmap=False) if meta.get('deleted') else None
+
+class LSHIndex(ExactIndex):
+    kind = 'lsh'
+
+    def __init__(self, n_tables=8, n_bits=32, window=32, n_probes=2, seed=0):
+        """
+        Parameters:
+            n_tables (int): Number of hash tables. More tables raise recall and query cost.
+            n_bits (int): Length of the hash code of every table (at most 56).
+            window (int): Songs read around the query's code in every table and probe. Raises recall and query cost.
+            n_probes (int): Extra codes looked up per table, reached by flipping the query's least certain bits.
+            seed (int): Seed of the random projections.
+        """
+        super().__init__()
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.window = window
+        self.n_probes = n_probes
+        self.seed = seed
+        self.keys = None # sorted (table, code) keys, n_tables * n of them
+        self.order = None # row behind every key
+
+    def params(self):
+        return {'n_tables': self.n_tables, 'n_bits': self.n_bits, 'window': self.window,
+                'n_probes': self.n_probes, 'seed': self.seed}
+
+    def _project(self, features):
+        # Random projections of a (small) block of rows, shape (rows, n_tables, n_bits)
+        columns, local = _unique(features.indices)
+        features = sp.csr_matrix((features.data, local, features.indptr), shape=(features.shape[0], len(columns)))
+        projections = features @ _random_signs(columns, self.n_tables * self.n_bits, self.seed)
+        return projections.reshape(-1, self.n_tables, self.n_bits)
+
+    def _codes(self, features):
+        # Hash codes of every row, (rows, n_tables), computed a chunk at a time to bound memory
+        codes = np.empty((features.shape[0], self.n_tables), dtype=np.uint64)
+        for start in range(0, features.shape[0], PROJECTION_CHUNK):
+            codes[start:start + PROJECTION_CHUNK] = self._hash(self._project(features[start:start + PROJECTION_CHUNK]))
+        return codes
+
+    def _bit_weights(self):
+        # The first projection is the most significant bit, so sorted codes group songs by shared prefix
+        return np.left_shift(np.uint64(1), np.arange(self.n_bits - 1, -1, -1, dtype=np.uint64))
+
+    def _hash(self, projections):
+        return ((projections > 0).astype(np.uint64) * self._bit_weights()).sum(axis=-1, dtype=np.uint64)
+
+    def _table_keys(self, codes):
+        # All tables live in one sorted array, the table number goes in the bits above the code
+        tables = np.left_shift(np.arange(self.n_tables, dtype=np.uint64), np.uint64(self.n_bits))
+        return codes | tables.reshape((1, -1) + (1,) * (codes.ndim - 2))
+
+    def fit(self, features):
+        if not 1 <= self.n_bits <= 56 or self.n_tables > 256:
+            raise ValueError("LSHIndex supports 1 to 56 bits and at most 256 tables.")
+        self.features = _normalize(_as_csr(features))
+        self.deleted = None
+        keys = self._table_keys(self._codes(self.features)).T.ravel() # table-major
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.order = (self.order % len(self)).astype(np.int64) # position -> row
+        return self
+
+    def add(self, features):
+        # Hash only the new rows and merge their keys into the sorted keys, the existing codes stay valid because
+        # the projection signs of every column come from a hash (new columns are zero in the old rows)
+        features = _normalize(_as_csr(features))
+        rows = np.arange(len(self), len(self) + features.shape[0])
+        keys = self._table_keys(self._codes(features)).T.ravel() # table-major, like fit
+        new_order = np.tile(rows, self.n_tables)
+        sort = np.argsort(keys, kind='stable')
+        keys, new_order = keys[sort], new_order[sort]
+        positions = np.searchsorted(self.keys, keys, side='right')
+        self.keys = np.insert(self.keys, positions, keys)
+        self.order = np.insert(self.order, positions, new_order)
+        self.features = sp.vstack([self._widen_to(features.shape[1]), features], format='csr')
+        if self.deleted is not None:
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(rows), dtype=bool)])
+        return rows
+
+    def _candidates(self, projections):
+        # (query, row) pairs for the songs whose codes sort next to the query's codes in any table. Songs next
+        # to each other share the longest code prefixes, and the fixed window keeps the candidate count (and
+        # so the latency) independent of the catalog size
+        codes = self._hash(projections)[:, :, None] # (queries, tables, 1)
+        probe_bits = np.argsort(np.abs(projections), axis=2)[:, :, :self.n_probes] # least certain bits first
+        flips = np.take(self._bit_weights(), probe_bits)
+        keys = self._table_keys(np.concatenate([codes, codes ^ flips], axis=2))
+        tables = np.broadcast_to(np.arange(self.n_tables)[None, :, None], keys.shape).ravel()
+        positions = np.searchsorted(self.keys, keys.ravel())
+
+        # Clip every window to its own table
+        lo = np.clip(positions - self.window // 2, tables * len(self), (tables + 1) * len(self) - self.window)
+        lo = np.maximum(lo, tables * len(self))
+        width = min(self.window, len(self))
+        positions = (lo[:, None] + np.arange(width)[None, :]).reshape(len(projections), -1)
+        owners = np.repeat(np.arange(len(projections)), positions.shape[1])
+        pairs = np.sort(owners * len(self) + self.order[positions.ravel()])
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))] if len(pairs) else pairs
+        return pairs // len(self), pairs % len(self)
+
+    def kneighbors(self, queries, k):
+        """
+        This function answers a batch of queries: candidates come from the hash tables and are re-ranked by exact cosine distance.
+
+        Parameters:
+            queries (scipy.sparse.spmatrix or numpy.ndarray): One feature row per query.
+            k (int): Number of neighbours per query.
+
+        Returns:
+            tuple: (distances, indices) arrays of shape (num_queries, k). Missing neighbours are padded with inf and -1.
+        """
+        queries = _normalize(self._query(queries))
+        k = min(k, self.num_live())
+        num_queries = queries.shape[0]
+        distances = np.full((num_queries, k), np.inf)
+        indices = np.full((num_queries, k), -1, dtype=np.int64)
+        for start in range(0, num_queries, QUERY_CHUNK):
+            chunk = queries[start:start + QUERY_CHUNK]
+            owners, rows = self._candidates(self._project(chunk))
+            if self.deleted is not None:
+                live = ~self.deleted[rows]
+                owners, rows = owners[live], rows[live]
+
+            # Exact cosine similarity against the distinct candidates of the chunk in one sparse product
+            candidates, local = _unique(rows)
+            similarity = (self.features[candidates] @ chunk.T).toarray()[local, owners]
+
+            # Keep the k most similar candidates of every query
+            order = np.lexsort((-similarity, owners))
+            owners, rows, similarity = owners[order], rows[order], similarity[order]
+            rank = np.arange(len(owners)) - np.searchsorted(owners, owners)
+            top = rank < k
+            distances[start + owners[top], rank[top]] = 1 - similarity[top]
+            indices[start + owners[top], rank[top]] = rows[top]
+        return distances, indices
+
+    def save(self, path):
+        super().save(path)
+        np.save(os.path.join(path, 'keys.npy'), self.keys)
+        np.save(os.path.join(path, 'order.npy'), self.order)
+
+    def _load_arrays(self, path, meta, mmap):
+        self.features = load_csr(path, 'features', tuple(meta['shape']), mmap)
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r' if mmap else None)
+        self.order = np.load(os.path.join(path, 'order.npy'), mmap_mode='r' if mmap else None)
+        self._load_deleted(path, meta)
+
+INDEXES = {'exact': ExactIndex, 'lsh': LSHIndex}
+
+def build_index(kind='exact', **params):
+    if kind not in INDEXES:
+        raise ValueError(f"Unknown index {kind}, expected one of {sorted(INDEXES)}.")
+    return INDEXES[kind](**params)
+
+def load_index(path, mmap=True):
+    """
+    This helper function loads an index written by save, memory-mapping its arrays by default.
+
+    Parameters:
+        path (str): Directory the index was saved to.
+        mmap (bool): Memory-map the arrays instead of reading them into memory.
+
+    Returns:
+        ExactIndex or LSHIndex: The loaded index.
+    """
+    with open(os.path.join(path, 'index.json')) as f:
+        meta = json.load(f)
+    index = build_index(meta['kind'], **meta['params'])
+    index._load_arrays(path, meta, mmap)
+    return index
+
+def recall_at_k(approx_indices, exact_indices):
+    # Mean fraction of the exact neighbours that the approximate index also returned
+    hits = [len(np.intersect1d(a[a >= 0], e[e >= 0])) / max((e >= 0).sum(), 1) for a, e in zip(approx_indices, exact_indices)]
+    return float(np.mean(hits)) if hits else 1.0
+
+def check_recall(features, queries, k=10, **lsh_params):
+    """
+    This function compares an LSH index with exact KNN on the same features.
+
+    Parameters:
+        features (scipy.sparse.spmatrix): Features of the indexed songs.
+        queries (scipy.sparse.spmatrix): Features of the query songs.
+        k (int): Number of neighbours per query.
+        **lsh_params: Parameters for LSHIndex.
+
+    Returns:
+        dict: recall@k of the LSH index and the batch query time of both indexes in seconds.
+    """
+    exact = ExactIndex().fit(features)
+    approx = LSHIndex(**lsh_params).fit(features)
+    start = time.perf_counter()
+    _, exact_indices = exact.kneighbors(queries, k)
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    _, approx_indices = approx.kneighbors(queries, k)
+    approx_time = time.perf_counter() - start
+    return {'recall': recall_at_k(approx_indices, exact_indices), 'exact_seconds': exact_time, 'lsh_seconds': approx_time}
@@ -0,0 +1,118 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from catalog import catalog_version
+
+### Versioned on-disk format of fitted recommenders.
+# An artifact is a directory holding meta.json (format version, kind, parameters and the catalog
+# it was fitted on) and one .npy file per array. Arrays are memory-mapped on load, so a serving
+# process starts without refitting and processes on the same machine share the pages of the
+# page cache. String vocabularies use the catalog's dictionary layout: one '\x00' separated
+# utf-8 file per vocabulary.
+
+FORMAT_VERSION = 1
+DICT_SEPARATOR = '\x00'
+
+@contextlib.contextmanager
+def staging(path):
+    # Write an artifact into a temporary directory and move it into place once it is complete
+    tmp_path = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    yield tmp_path
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def write_meta(path, kind, **meta):
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, format=FORMAT_VERSION, kind=kind), f, indent=2)
+
+def read_meta(path, kind):
+    """
+    This helper function reads the meta.json of an artifact and checks that it can be loaded.
+
+    Parameters:
+        path (str): Artifact directory.
+        kind (str): Kind of artifact the caller expects.
+
+    Returns:
+        dict: The metadata.
+
+    Raises:
+        ValueError: If the artifact has another format version or kind.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT_VERSION:
+        raise ValueError(f"Artifact {path} has format {meta.get('format')}, expected {FORMAT_VERSION}. Save the model again.")
+    if meta.get('kind') != kind:
+        raise ValueError(f"Artifact {path} holds a {meta.get('kind')} model, expected {kind}.")
+    return meta
+
+def new_model_version():
+    # Identifies one fit (or update) of a model and is saved with it, result caches key on it (see result_cache.py)
+    return uuid.uuid4().hex
+
+def catalog_fingerprint(song_dataset):
+    # Hash of the track ids in row order, identifies a catalog that did not come from the store (no catalog_version).
+    # Object, string and categorical columns of the same ids hash the same
+    hashes = pd.util.hash_pandas_object(song_dataset['track_id'], index=False).to_numpy()
+    return hashlib.sha1(hashes.tobytes()).hexdigest()[:12]
+
+def catalog_meta(song_dataset):
+    # What identifies the catalog a model was fitted on
+    return {'catalog_version': catalog_version(song_dataset), 'catalog_fingerprint': catalog_fingerprint(song_dataset),
+            'num_rows': len(song_dataset)}
+
+def check_catalog(meta, song_dataset, path):
+    # A model is only valid for the catalog it was fitted on: rows are referred to by position. The store's versions
+    # are compared when both sides have one, the track id fingerprints otherwise
+    version = catalog_version(song_dataset)
+    if meta['catalog_version'] is not None and version is not None and meta['catalog_version'] != version:
+        raise ValueError(f"Artifact {path} was fitted on catalog version {meta['catalog_version']}, got version {version}.")
+    if meta['num_rows'] != len(song_dataset):
+        raise ValueError(f"Artifact {path} was fitted on a catalog of {meta['num_rows']} songs, got {len(song_dataset)}.")
+    if (meta['catalog_version'] is None or version is None) and meta.get('catalog_fingerprint') is not None:
+        fingerprint = catalog_fingerprint(song_dataset)
+        if meta['catalog_fingerprint'] != fingerprint:
+            raise ValueError(f"Artifact {path} was fitted on a catalog with fingerprint {meta['catalog_fingerprint']}, "
+                             f"got {fingerprint}: the track ids differ.")
+
+def save_array(path, name, array):
+    np.save(os.path.join(path, f'{name}.npy'), np.asarray(array))
+
+def load_array(path, name, mmap=True):
+    return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+
+def save_csr(path, name, matrix):
+    for part in ('data', 'indices', 'indptr'):
+        save_array(path, f'{name}.{part}', getattr(matrix, part))
+
+def load_csr(path, name, shape, mmap=True):
+    parts = [load_array(path, f'{name}.{part}', mmap) for part in ('data', 'indices', 'indptr')]
+    return sp.csr_matrix(tuple(parts), shape=shape, copy=False)
+
+def save_values(path, name, values):
+    # Distinct values of a vocabulary, strings in dictionary layout and anything else as an array
+    values = pd.Index(values)
+    if values.inferred_type in ('string', 'empty'):
+        if any(DICT_SEPARATOR in value for value in values):
+            raise ValueError(f"Vocabulary {name} contains the dictionary separator and cannot be stored.")
+        with open(os.path.join(path, f'{name}.dict'), 'wb') as f:
+            f.write(DICT_SEPARATOR.join(values).encode('utf-8'))
+        return {'type': 'dictionary', 'size': len(values)}
+    save_array(path, name, values.to_numpy())
+    return {'type': 'array', 'size': len(values)}
+
+def load_values(path, name, info):
+    if info['type'] == 'array':
+        return pd.Index(load_array(path, name, mmap=False))
+    with open(os.path.join(path, f'{name}.dict'), 'rb') as f:
+        data = f.read().decode('utf-8')
+    return pd.Index(data.split(DICT_SEPARATOR) if info['size'] else [], dtype=object)
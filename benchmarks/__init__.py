@@ -0,0 +1 @@
+### Benchmarks of the four recommender systems on synthetic catalogs, see benchmarks/run.py.
@@ -0,0 +1,281 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import write_dataset
+
+### Benchmark of the four recommender systems on synthetic catalogs.
+# Every (recommender, catalog size) pair runs in its own subprocess, so its peak RSS (ru_maxrss) is
+# its own and nothing is shared between runs. A run measures the fit time, the latency of single
+# recommendations (p50/p99), the throughput of batched recommendations and the peak RSS. Spotify is
+# replaced by fake_spotify.FakeSpotify. Results are written to a JSON file and compared with a
+# stored baseline, a metric that got worse by more than the tolerance is reported as a regression.
+#
+#   python -m benchmarks.run --sizes 10000 100000 1000000
+#   python -m benchmarks.run --sizes 10000 --update-baseline
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECOMMENDERS = ('popular', 'random', 'collab', 'content')
+SIZES = (10_000, 100_000, 1_000_000)
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+MODULES = {'popular': 'PopularRecSys', 'random': 'RandomRecSys', 'collab': 'CollaborativeFilteringRecSys', 'content': 'ContentRecSys'}
+# scikit-learn modules the recommenders import on first use, imported before the fit is timed
+LAZY_MODULES = {'collab': ('sklearn.neighbors', 'sklearn.preprocessing'),
+                'content': ('sklearn.linear_model', 'sklearn.model_selection', 'sklearn.preprocessing')}
+CATALOG_COLUMNS = ['artist_name', 'track_name', 'track_id', 'popularity', 'year', 'genre', 'duration_ms']
+
+# Direction of every metric, and the smallest change that counts (timer and allocator noise)
+METRICS = {
+    'fit_seconds': ('lower', 0.05),
+    'p50_ms': ('lower', 1.0),
+    'p99_ms': ('lower', 2.0),
+    'throughput_qps': ('higher', 0.0),
+    'peak_rss_mb': ('lower', 16.0),
+}
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+def _stub_fetcher(playlist, liked_songs):
+    # Metadata fetcher backed by the fake client, it knows every playlist and liked song (including the
+    # ones missing from the catalog) and keeps its cache in memory
+    from fake_spotify import FakeSpotify
+    from spotify_metadata import SpotifyMetadataFetcher
+    client = FakeSpotify.from_songs(pd.concat([playlist, liked_songs]).drop_duplicates('track_id'))
+    return SpotifyMetadataFetcher(client, cache_path=':memory:', requests_per_second=0)
+
+def _fit(recommender, catalog, playlist, liked_songs, num_recs, seed):
+    # Build and train a recommender, returns it with its single and batched query functions
+    fetcher = _stub_fetcher(playlist, liked_songs)
+    if recommender == 'popular':
+        from PopularRecSys import PopularRec
+        model = PopularRec(catalog, fetcher=fetcher)
+        return model, lambda i, track_id: model.recommend(track_id, num_recs), model.recommend_many
+    if recommender == 'random':
+        from RandomRecSys import RandomRec
+        model = RandomRec(catalog, seed=seed, fetcher=fetcher)
+        return model, lambda i, track_id: model.recommend(track_id, num_recs), model.recommend_many
+    if recommender == 'collab':
+        from CollaborativeFilteringRecSys import CollaborativeFilteringRecSys
+        model = CollaborativeFilteringRecSys(playlist, catalog, k=num_recs)
+        model.preprocess_data()
+        model.train_model()
+        # A single query is a one-song playlist
+        single = lambda i, track_id: model.recommend(model.playlist_data.iloc[[i % len(model.playlist_data)]])
+        return model, single, model.recommend_many
+    if recommender == 'content':
+        from ContentRecSys import ContentBasedRecSys
+        model = ContentBasedRecSys(catalog, liked_songs, random_state=seed)
+        model.preprocess_data()
+        model.train_model()
+        return model, lambda i, track_id: model.get_recommendations(track_id, num_recs), model.get_recommendations_many
+    raise ValueError(f"Unknown recommender {recommender}, expected one of {RECOMMENDERS}.")
+
+def measure(recommender, paths, num_queries=200, batch_size=256, num_recs=30, repeats=3, seed=0):
+    """
+    This function benchmarks one recommender on one synthetic dataset, in the calling process.
+
+    Parameters:
+        recommender (str): One of RECOMMENDERS.
+        paths (dict): Dataset files from synthetic.write_dataset.
+        num_queries (int): Single recommendations timed for the latency percentiles.
+        batch_size (int): Seed tracks per batched call.
+        num_recs (int): Recommendations per seed.
+        repeats (int): Batched calls timed, the median is reported.
+        seed (int): Seed of the query sample and of the recommenders.
+
+    Returns:
+        dict: Load and fit time, latency percentiles, batch throughput and peak RSS.
+    """
+    from catalog import load_catalog
+    start = time.perf_counter()
+    catalog = load_catalog(paths['catalog'], columns=CATALOG_COLUMNS, cache_dir=_cache_dir(paths))
+    playlist = pd.read_csv(paths['playlist'])
+    liked_songs = pd.read_csv(paths['liked_songs'])
+    load_seconds = time.perf_counter() - start
+    load_rss = _peak_rss_mb()
+    for module in (MODULES[recommender],) + LAZY_MODULES.get(recommender, ()):
+        importlib.import_module(module) # import time (sklearn) is not fit time
+
+    # The recommenders print their recommendations, which would only measure the terminal
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        model, single, batch = _fit(recommender, catalog, playlist, liked_songs, num_recs, seed)
+        fit_seconds = time.perf_counter() - start
+
+        # Single queries cycle through the playlist, which includes songs only the Spotify stub knows
+        seeds = playlist['track_id'].tolist()
+        single(0, seeds[0]) # warm up
+        latencies = []
+        for i in range(num_queries):
+            start = time.perf_counter()
+            single(i, seeds[i % len(seeds)])
+            latencies.append(time.perf_counter() - start)
+
+        rng = np.random.default_rng(seed)
+        track_ids = np.asarray(catalog['track_id'], dtype=object)
+        batch_seconds = []
+        for _ in range(repeats):
+            batch_seeds = track_ids[rng.choice(len(track_ids), size=batch_size)].tolist()
+            start = time.perf_counter()
+            batch(batch_seeds, num_recs)
+            batch_seconds.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'recommender': recommender,
+        'size': len(catalog),
+        'load_seconds': load_seconds,
+        'fit_seconds': fit_seconds,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'throughput_qps': batch_size / float(np.median(batch_seconds)),
+        'catalog_rss_mb': load_rss,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+def prepare(size, data_dir, seed=0):
+    """
+    This function writes the synthetic dataset of one catalog size and builds its columnar catalog cache.
+    It runs in a subprocess: Linux children inherit the peak RSS of their parent, so the benchmark
+    process itself must never hold a large catalog.
+
+    Returns:
+        dict: Dataset files from synthetic.write_dataset.
+    """
+    process = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--prepare', json.dumps([size, data_dir, seed])],
+                             cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def _prepare(size, data_dir, seed):
+    from catalog import load_catalog
+    paths = write_dataset(size, data_dir, seed=seed)
+    load_catalog(paths['catalog'], columns=CATALOG_COLUMNS, cache_dir=_cache_dir(paths))
+    return paths
+
+def _cache_dir(paths):
+    return os.path.join(os.path.dirname(paths['catalog']), 'catalog_cache')
+
+def run_job(job, timeout=None):
+    # Run measure in a fresh interpreter, so peak RSS and caches belong to this job alone
+    try:
+        process = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--job', json.dumps(job)], cwd=ROOT,
+                                 capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'recommender': job['recommender'], 'size': job['size'], 'error': [f'timed out after {timeout}s']}
+    if process.returncode != 0:
+        return {'recommender': job['recommender'], 'size': job['size'], 'error': process.stderr.strip().splitlines()[-1:]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def compare(results, baseline, tolerance=0.5):
+    """
+    This function compares benchmark results with a baseline.
+
+    Parameters:
+        results (list): Results of run_job.
+        baseline (list): Results of an earlier run.
+        tolerance (float): Relative change a metric may get worse by before it counts as a regression.
+
+    Returns:
+        list: One dictionary per regression (recommender, size, metric, baseline, current, change).
+    """
+    reference = {(entry['recommender'], entry['size']): entry for entry in baseline if 'error' not in entry}
+    regressions = []
+    for entry in results:
+        base = reference.get((entry['recommender'], entry['size']))
+        if base is None or 'error' in entry:
+            continue
+        for metric, (better, min_delta) in METRICS.items():
+            old, new = base[metric], entry[metric]
+            worse = new - old if better == 'lower' else old - new
+            if worse > max(tolerance * abs(old), min_delta):
+                regressions.append({'recommender': entry['recommender'], 'size': entry['size'], 'metric': metric,
+                                    'baseline': old, 'current': new, 'change': (new - old) / old if old else float('inf')})
+    return regressions
+
+COLUMNS = ['recommender', 'size'] + list(METRICS)
+
+def _print_header():
+    print(' '.join(f'{name:>14}' for name in COLUMNS))
+
+def _print_results(results):
+    for entry in results:
+        if 'error' in entry:
+            print(f"{entry['recommender']:>14} {entry['size']:>14} failed: {' '.join(entry['error'])}")
+        else:
+            print(' '.join(f'{entry[name]:>14.2f}' if isinstance(entry[name], float) else f'{entry[name]:>14}' for name in COLUMNS))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the recommender systems on synthetic catalogs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='catalog sizes')
+    parser.add_argument('--recommenders', nargs='+', default=list(RECOMMENDERS), choices=RECOMMENDERS)
+    parser.add_argument('--queries', type=int, default=200, help='single recommendations timed per run')
+    parser.add_argument('--batch-size', type=int, default=256, help='seed tracks per batched call')
+    parser.add_argument('--num-recs', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default='.benchmark_data', help='where the synthetic datasets are kept')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='relative slowdown reported as a regression')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds a single run may take')
+    parser.add_argument('--job', help=argparse.SUPPRESS) # internal: run one job and print its result
+    parser.add_argument('--prepare', help=argparse.SUPPRESS) # internal: write one dataset and print its paths
+    args = parser.parse_args(argv)
+
+    if args.job:
+        job = json.loads(args.job)
+        result = measure(job['recommender'], job['paths'], job['queries'], job['batch_size'], job['num_recs'], seed=job['seed'])
+        print(json.dumps(result))
+        return 0
+    if args.prepare:
+        print(json.dumps(_prepare(*json.loads(args.prepare))))
+        return 0
+
+    results = []
+    _print_header()
+    for size in args.sizes:
+        paths = prepare(size, os.path.abspath(args.data_dir), seed=args.seed)
+        for recommender in args.recommenders:
+            job = {'recommender': recommender, 'size': size, 'paths': paths, 'queries': args.queries,
+                   'batch_size': args.batch_size, 'num_recs': args.num_recs, 'seed': args.seed}
+            results.append(run_job(job, args.timeout))
+            _print_results(results[-1:])
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'params': {'queries': args.queries, 'batch_size': args.batch_size, 'num_recs': args.num_recs, 'seed': args.seed},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline written to {args.baseline}.')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, nothing to compare with.')
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f)['results'], args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression['recommender']} at {regression['size']} rows, {regression['metric']} "
+              f"{regression['baseline']:.2f} -> {regression['current']:.2f} ({regression['change']:+.0%})")
+    failed = [entry for entry in results if 'error' in entry]
+    return 1 if regressions or failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
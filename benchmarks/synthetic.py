@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pandas as pd
+
+### Synthetic datasets in the schema of spotify_data.csv and the Playlists/*.csv files.
+# Artists follow a power law (a few artists have many songs, most have few) and every artist has
+# one main genre, so genre sizes are skewed the way they are in the real catalog. Playlists and
+# liked songs are drawn from the catalog, plus a share of tracks the catalog does not contain,
+# which the recommenders have to look up through the (stubbed) Spotify client.
+
+NUM_GENRES = 82 # distinct genres of the Spotify 1 Million dataset
+SONGS_PER_ARTIST = 15
+ID_ALPHABET = np.frombuffer(b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz', dtype='S1')
+
+def _track_ids(rng, num_rows):
+    # Random 22 character base62 ids, like Spotify's
+    chars = ID_ALPHABET[rng.integers(0, len(ID_ALPHABET), size=(num_rows, 22))]
+    return chars.view('S22').ravel().astype(str)
+
+def _names(prefix, values):
+    return np.char.add(prefix, values.astype(str))
+
+def make_catalog(num_rows, seed=0):
+    """
+    This function generates a song catalog with the columns of spotify_data.csv.
+
+    Parameters:
+        num_rows (int): Number of songs.
+        seed (int): Seed of the generator, the same seed always gives the same catalog.
+
+    Returns:
+        pandas.DataFrame: The catalog.
+    """
+    rng = np.random.default_rng(seed)
+    num_artists = max(1, num_rows // SONGS_PER_ARTIST)
+    weights = 1.0 / np.arange(1, num_artists + 1) ** 1.1
+    artists = rng.choice(num_artists, size=num_rows, p=weights / weights.sum())
+    artist_genres = rng.integers(0, NUM_GENRES, size=num_artists)
+    return pd.DataFrame({
+        'Unnamed: 0': np.arange(num_rows),
+        'artist_name': _names('Artist ', artists),
+        'track_name': _names('Track ', np.arange(num_rows)),
+        'track_id': _track_ids(rng, num_rows),
+        'popularity': np.clip(rng.gamma(2.0, 10.0, size=num_rows), 0, 100).astype(int),
+        'year': rng.integers(2000, 2024, size=num_rows),
+        'genre': _names('genre ', artist_genres[artists]),
+        'danceability': rng.random(num_rows).round(3),
+        'energy': rng.random(num_rows).round(3),
+        'key': rng.integers(0, 12, size=num_rows),
+        'loudness': (-60 * rng.random(num_rows) ** 3).round(3),
+        'mode': rng.integers(0, 2, size=num_rows),
+        'speechiness': (rng.random(num_rows) ** 3).round(4),
+        'acousticness': rng.random(num_rows).round(4),
+        'instrumentalness': (rng.random(num_rows) ** 4).round(4),
+        'liveness': (rng.random(num_rows) ** 2).round(4),
+        'valence': rng.random(num_rows).round(4),
+        'tempo': rng.uniform(60, 200, size=num_rows).round(3),
+        'duration_ms': np.clip(rng.normal(230000, 60000, size=num_rows), 30000, None).astype(int),
+        'time_signature': rng.choice([3, 4, 5], size=num_rows, p=[0.1, 0.85, 0.05]),
+    })
+
+def make_playlist(catalog, num_songs, new_fraction=0.1, seed=0):
+    """
+    This function generates a playlist (or liked songs) with the columns written by utils.get_playlist_songs.
+
+    Parameters:
+        catalog (pandas.DataFrame): Catalog from make_catalog.
+        num_songs (int): Number of songs.
+        new_fraction (float): Share of the songs that are not in the catalog.
+        seed (int): Seed of the generator.
+
+    Returns:
+        pandas.DataFrame: The playlist.
+    """
+    rng = np.random.default_rng(seed)
+    num_new = int(round(num_songs * new_fraction))
+    songs = catalog.iloc[rng.choice(len(catalog), size=num_songs - num_new, replace=False)]
+    new = catalog.iloc[rng.choice(len(catalog), size=num_new)].copy()
+    new['track_id'] = _track_ids(rng, num_new)
+    new['track_name'] = _names('New Track ', np.arange(num_new))
+    songs = pd.concat([songs, new]).sample(frac=1, random_state=rng)
+    return pd.DataFrame({
+        'track_id': songs['track_id'].to_numpy(),
+        'track_name': songs['track_name'].to_numpy(),
+        'artist_names': songs['artist_name'].to_numpy(),
+        'popularity': songs['popularity'].to_numpy(),
+        'duration_ms': songs['duration_ms'].to_numpy(),
+        'explicit': rng.random(len(songs)) < 0.2,
+        'album': _names('Album ', rng.integers(0, max(1, len(catalog) // 10), size=len(songs))),
+        'release_date': np.char.add(songs['year'].to_numpy().astype(str), '-01-01'),
+        'uri': np.char.add('spotify:track:', songs['track_id'].to_numpy().astype(str)),
+        'genre': songs['genre'].to_numpy(),
+    })
+
+def write_dataset(num_rows, directory, playlist_size=200, liked_size=500, seed=0):
+    """
+    This function writes a catalog, a playlist and a liked songs CSV, reusing the files of an earlier call.
+
+    Parameters:
+        num_rows (int): Number of catalog songs.
+        directory (str): Directory the datasets are written to, one subdirectory per size and seed.
+        playlist_size (int): Songs in the playlist.
+        liked_size (int): Songs in the liked songs list.
+        seed (int): Seed of the generator.
+
+    Returns:
+        dict: Paths of the 'catalog', 'playlist' and 'liked_songs' CSV files.
+    """
+    path = os.path.join(directory, f'{num_rows}_{seed}')
+    paths = {name: os.path.join(path, f'{name}.csv') for name in ('catalog', 'playlist', 'liked_songs')}
+    if all(os.path.exists(file) for file in paths.values()):
+        return paths
+    os.makedirs(path, exist_ok=True)
+    catalog = make_catalog(num_rows, seed)
+    make_playlist(catalog, playlist_size, seed=seed + 1).to_csv(paths['playlist'], index=False)
+    make_playlist(catalog, liked_size, seed=seed + 2).to_csv(paths['liked_songs'], index=False)
+    # The catalog goes last, so a dataset with a catalog file is complete
+    tmp = paths['catalog'] + '.tmp'
+    catalog.to_csv(tmp, index=False)
+    os.replace(tmp, paths['catalog'])
+    return paths
@@ -0,0 +1,315 @@
+import json
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from instrumentation import stage
+
+### Columnar cache for the song catalog (spotify_data.csv).
+# The CSV is parsed once and written to a directory of .npy files, one per column:
+#   - string columns are dictionary encoded: int32 codes + a '\x00' separated utf-8 dictionary
+#   - integer columns are stored as int32 (or narrower when the values fit), floats as float32
+# Later loads memory-map only the columns that are asked for. The cache is rebuilt when the
+# size or modification time of the source CSV changes. The catalog version is a hash of the CSV's
+# contents, so a rebuild of an unchanged file keeps it and saved models stay valid.
+
+FORMAT_VERSION = 1
+CACHE_DIR = '.catalog_cache'
+DICT_SEPARATOR = '\x00'
+
+# Storage types for the known spotify_data.csv columns, anything else is inferred from pandas
+COLUMN_TYPES = {
+    'artist_name': 'dictionary',
+    'track_name': 'dictionary',
+    'track_id': 'dictionary',
+    'genre': 'dictionary',
+    'popularity': 'int32',
+    'year': 'int32',
+    'duration_ms': 'int32',
+    'key': 'int8',
+    'mode': 'int8',
+    'time_signature': 'int8',
+}
+
+def _source_signature(csv_path):
+    stat = os.stat(csv_path)
+    return {'source': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _content_hash(csv_path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(csv_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _column_type(name, series):
+    if name in COLUMN_TYPES:
+        return COLUMN_TYPES[name]
+    if series.dtype == object or isinstance(series.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(series.dtype):
+        return 'dictionary'
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return 'int32'
+    return 'float32'
+
+def _file_name(column):
+    # Column names can be anything (e.g. 'Unnamed: 0'), so keep file names safe
+    return hashlib.sha1(column.encode('utf-8')).hexdigest()[:16]
+
+class CatalogStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.columns = [col['name'] for col in self.meta['columns']]
+        self.num_rows = self.meta['num_rows']
+        self.version = self.meta['version']
+        self._column_meta = {col['name']: col for col in self.meta['columns']}
+        self._dictionaries = {}
+
+    @classmethod
+    def build(cls, csv_path, path):
+        """
+        This function parses the catalog CSV once and writes it to a columnar store at `path`.
+
+        Parameters:
+            csv_path (str): Path to the catalog CSV (spotify_data.csv).
+            path (str): Directory the store is written to (replaced if it exists).
+
+        Returns:
+            CatalogStore: The freshly built store.
+        """
+        signature = _source_signature(csv_path)
+        dictionary_cols = [name for name, kind in COLUMN_TYPES.items() if kind == 'dictionary']
+        with stage('catalog.read_csv') as run:
+            df = pd.read_csv(csv_path, dtype={name: str for name in dictionary_cols}) # keep ids like '0123' as strings
+            run.items = len(df)
+        with stage('catalog.hash'):
+            content_hash = _content_hash(csv_path)
+        # A directory of its own next to the store, so concurrent builds of the same CSV do not write into each other
+        tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            columns = cls._write_columns(df, tmp_path)
+            version_key = f"{FORMAT_VERSION}:{content_hash}"
+            meta = dict(signature, format=FORMAT_VERSION, sha1=content_hash, num_rows=len(df), columns=columns,
+                        version=hashlib.sha1(version_key.encode('utf-8')).hexdigest()[:12])
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump(meta, f, indent=2)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, path)
+        except OSError: # another build of the same CSV put its store in place first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cls(path)
+
+    @staticmethod
+    def _write_columns(df, tmp_path):
+        # One file per column (two for dictionary columns), returns the column entries of meta.json
+        columns = []
+        for name in df.columns:
+            series = df[name]
+            kind = _column_type(name, series)
+            file_name = _file_name(name)
+            if kind == 'dictionary':
+                codes, uniques = pd.factorize(series) # codes are -1 for missing values
+                uniques = [str(value) for value in uniques]
+                if any(DICT_SEPARATOR in value for value in uniques):
+                    raise ValueError(f"Column {name} contains the dictionary separator and cannot be stored.")
+                np.save(os.path.join(tmp_path, file_name + '.codes.npy'), codes.astype(np.int32))
+                with open(os.path.join(tmp_path, file_name + '.dict'), 'wb') as f:
+                    f.write(DICT_SEPARATOR.join(uniques).encode('utf-8'))
+                columns.append({'name': name, 'type': kind, 'file': file_name, 'size': len(uniques)})
+            else:
+                if kind.startswith('int') and series.isna().any():
+                    kind = 'float32' # integers with gaps cannot be represented without a sentinel
+                np.save(os.path.join(tmp_path, file_name + '.npy'), series.to_numpy().astype(kind))
+                columns.append({'name': name, 'type': kind, 'file': file_name})
+        return columns
+
+    @classmethod
+    def open(cls, csv_path, cache_dir=CACHE_DIR):
+        """
+        This function opens the columnar store for `csv_path`, building or rebuilding it when it is missing or stale.
+
+        Parameters:
+            csv_path (str): Path to the catalog CSV.
+            cache_dir (str): Directory holding the columnar stores.
+
+        Returns:
+            CatalogStore: A store that matches the current contents of the CSV.
+        """
+        # Named after the file and a hash of its absolute path, so CSVs with the same name in different directories get their own store
+        source = hashlib.sha1(os.path.abspath(csv_path).encode('utf-8')).hexdigest()[:8]
+        path = os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(csv_path))[0]}-{source}')
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            store = cls(path)
+            if store.is_current(csv_path):
+                return store
+        os.makedirs(cache_dir, exist_ok=True)
+        return cls.build(csv_path, path)
+
+    def is_current(self, csv_path):
+        signature = _source_signature(csv_path)
+        return (self.meta.get('format') == FORMAT_VERSION and
+                all(self.meta.get(key) == value for key, value in signature.items()))
+
+    def column_type(self, column):
+        return self._column_meta[column]['type']
+
+    def _file(self, column, suffix):
+        return os.path.join(self.path, self._column_meta[column]['file'] + suffix)
+
+    def codes(self, column, mmap=True):
+        # Dictionary codes of a string column (int32, -1 for missing)
+        return np.load(self._file(column, '.codes.npy'), mmap_mode='r' if mmap else None)
+
+    def dictionary(self, column):
+        # The distinct values of a string column, in code order
+        if column not in self._dictionaries:
+            with open(self._file(column, '.dict'), 'rb') as f:
+                data = f.read().decode('utf-8')
+            values = data.split(DICT_SEPARATOR) if self._column_meta[column]['size'] else []
+            self._dictionaries[column] = pd.Index(values, dtype=object)
+        return self._dictionaries[column]
+
+    def array(self, column, mmap=True):
+        if self.column_type(column) == 'dictionary':
+            return self.codes(column, mmap=mmap)
+        return np.load(self._file(column, '.npy'), mmap_mode='r' if mmap else None)
+
+    def scan_dictionary(self, column, block_size=1 << 20):
+        # (code, value) pairs of a string column's dictionary, read a block at a time instead of loading it whole
+        if column in self._dictionaries:
+            yield from enumerate(self._dictionaries[column])
+            return
+        if not self._column_meta[column]['size']:
+            return
+        code, rest = 0, b''
+        with open(self._file(column, '.dict'), 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                values = (rest + block).split(DICT_SEPARATOR.encode('utf-8'))
+                rest = values.pop()
+                for value in values:
+                    yield code, value.decode('utf-8')
+                    code += 1
+        yield code, rest.decode('utf-8')
+
+    def lookup(self, column, values):
+        """
+        This function finds the dictionary codes of a few values of a string column without loading its dictionary.
+
+        Parameters:
+            column (str): String column.
+            values (list): Values to look up.
+
+        Returns:
+            numpy.ndarray: int64 code of every value, -1 for values that are not in the column.
+        """
+        wanted = {value: None for value in values}
+        for code, value in self.scan_dictionary(column):
+            if value in wanted and wanted[value] is None:
+                wanted[value] = code
+        return np.array([-1 if wanted[value] is None else wanted[value] for value in values], dtype=np.int64)
+
+    def decode(self, column, codes):
+        # Values of a few dictionary codes of a string column (None for -1), without loading the dictionary
+        wanted = {int(code): None for code in codes if code >= 0}
+        for code, value in self.scan_dictionary(column):
+            if code in wanted:
+                wanted[code] = value
+        return np.array([wanted.get(int(code)) for code in codes], dtype=object)
+
+    def read(self, columns=None, start=None, stop=None, mmap=True, codes=()):
+        """
+        This function reads columns of the store into a DataFrame. String columns come back as pandas categoricals.
+
+        Parameters:
+            columns (list): Columns to read, all columns if None.
+            start (int): First row to read.
+            stop (int): Row to stop before.
+            mmap (bool): Memory-map the column files instead of reading them into memory.
+            codes (list): String columns to return as their int32 dictionary codes, their dictionary is not loaded.
+
+        Returns:
+            pandas.DataFrame: The requested slice of the catalog.
+        """
+        columns = self.columns if columns is None else list(columns)
+        rows = slice(start, stop)
+        data = {}
+        for column in columns:
+            if column not in self._column_meta:
+                raise KeyError(f"Column {column} is not in the catalog.")
+            values = self.array(column, mmap=mmap)[rows]
+            if self.column_type(column) == 'dictionary' and column not in codes:
+                values = pd.Categorical.from_codes(np.asarray(values), categories=self.dictionary(column))
+            data[column] = values
+        index = pd.RangeIndex(*rows.indices(self.num_rows))
+        df = pd.DataFrame(data, index=index, columns=columns, copy=False)
+        df.attrs['catalog_version'] = self.version
+        df.attrs['catalog_source'] = self.meta['source']
+        return df
+
+    def iter_chunks(self, columns=None, chunksize=100000, codes=()):
+        # Yield the catalog in row chunks so callers can stream over it with bounded memory
+        for start in range(0, self.num_rows, chunksize):
+            yield self.read(columns, start, min(start + chunksize, self.num_rows), codes=codes)
+
+def load_catalog(csv_path='spotify_data.csv', columns=None, cache_dir=CACHE_DIR, mmap=True):
+    """
+    This helper function loads the song catalog through the columnar cache, parsing the CSV only when the cache is stale.
+
+    Parameters:
+        csv_path (str): Path to the catalog CSV.
+        columns (list): Columns to load, all columns if None.
+        cache_dir (str): Directory holding the columnar stores.
+        mmap (bool): Memory-map the column files instead of reading them into memory.
+
+    Returns:
+        pandas.DataFrame: The catalog, with string columns as categoricals and `attrs['catalog_version']` set.
+    """
+    with stage('catalog.load') as run:
+        df = CatalogStore.open(csv_path, cache_dir).read(columns, mmap=mmap)
+        run.items = len(df)
+    return df
+
+def catalog_version(df):
+    # Version of the catalog a DataFrame was loaded from, None if it did not come from the store
+    return df.attrs.get('catalog_version')
+
+def append_rows(df, rows):
+    """
+    This helper function appends rows to a catalog DataFrame. Categorical columns stay categorical: the new values
+    are added after the existing categories, so the codes of the existing rows do not change.
+
+    Parameters:
+        df (pandas.DataFrame): Catalog, for example from load_catalog.
+        rows (pandas.DataFrame): Rows to append, columns of df they do not have are left missing.
+
+    Returns:
+        pandas.DataFrame: The catalog with the rows appended (positions of the existing rows are kept) and the same attrs.
+    """
+    rows = rows.reindex(columns=df.columns)
+    data = {}
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories
+            new = pd.unique(rows[column].dropna())
+            categories = categories.append(pd.Index(new[categories.get_indexer(new) < 0], dtype=categories.dtype))
+            codes = np.concatenate([np.asarray(values.cat.codes), categories.get_indexer(rows[column])]) # -1 for missing
+            data[column] = pd.Categorical.from_codes(codes, categories=categories)
+        elif rows[column].isna().any() or not isinstance(values.dtype, np.dtype) or values.dtype == object:
+            # Extension dtypes (pandas strings, nullable integers) cannot go through np.concatenate
+            data[column] = pd.concat([values, rows[column]], ignore_index=True)
+        else:
+            data[column] = np.concatenate([np.asarray(values), np.asarray(rows[column], dtype=values.dtype)])
+    result = pd.DataFrame(data, columns=df.columns)
+    result.attrs.update(df.attrs)
+    return result
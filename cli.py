@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+### Command-line entry point: python cli.py {recommend,fit,evaluate,ingest,serve,startup} ...
+# Only the standard library is imported at the top. Every command imports what it needs when it
+# runs: pandas and the catalog for all of them, scikit-learn only for the collab and content
+# engines, spotipy and config.py only when a track missing from the catalog is looked up online
+# (recommend --online). So --help answers at once and offline use needs no Spotify credentials.
+# `startup` measures what importing every module costs in a fresh interpreter.
+#
+#   python cli.py fit --models models --engines popular collab
+#   python cli.py recommend 6EtAJUmBqj57hkiBxDy27I --engine collab --models models --timings
+#   python cli.py startup
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENGINES = ('popular', 'random', 'collab', 'itemitem', 'content', 'audio') # server.ENGINES, repeated so that --help does not import the server
+ONLINE_ENGINES = ('popular', 'random') # engines that can look up tracks missing from the catalog on Spotify
+DELEGATED = {'evaluate': 'evaluation', 'ingest': 'mpd_ingest', 'serve': 'server'} # commands run by another module's main
+STARTUP_MODULES = ('cli', 'PopularRecSys', 'RandomRecSys', 'ItemItemRecSys', 'CollaborativeFilteringRecSys', 'ContentRecSys',
+                   'HybridRecSys', 'embeddings', 'server', 'evaluation', 'mpd_ingest')
+HEAVY_MODULES = ('sklearn', 'spotipy', 'config') # should only be imported by the code paths that use them
+
+class Timings:
+    # Wall time of the steps of a command, printed to stderr with --timings
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.last = time.perf_counter()
+
+    def step(self, name):
+        now = time.perf_counter()
+        if self.enabled:
+            print(f'{name}: {(now - self.last) * 1000:.0f} ms', file=sys.stderr)
+        self.last = now
+
+def _load_catalog(args):
+    from catalog import load_catalog
+    from server import CATALOG_COLUMNS
+    return load_catalog(args.catalog, columns=CATALOG_COLUMNS)
+
+def _load_engine(catalog, name, models_dir, args, cache=None):
+    from server import PLAYLISTS, load_engines
+    return load_engines(catalog, [name], models_dir, args.playlist, args.liked_songs, seed=args.seed,
+                        playlists=args.playlists or PLAYLISTS, cache=cache)[name]
+
+def recommend(args):
+    timings = Timings(args.timings)
+    from server import batch_runner
+    timings.step('import')
+    catalog = _load_catalog(args)
+    timings.step('catalog')
+    cache = None
+    if args.cache_path:
+        # Results of earlier runs are read back from the SQLite file, only the new seeds are computed
+        from result_cache import ResultCache
+        cache = ResultCache(ttl=args.cache_ttl, path=args.cache_path)
+    engine = _load_engine(catalog, args.engine, args.models, args, cache)
+    timings.step('engine')
+    results = batch_runner(engine, catalog)([(track_id, args.num_recs) for track_id in args.track_ids])
+    timings.step('recommend')
+    if cache is not None:
+        cache.close()
+
+    for track_id, recommendations in zip(args.track_ids, results):
+        if not recommendations and args.online and args.engine in ONLINE_ENGINES:
+            # The only path that needs spotipy and config.py: the single-track recommend fetches the seed from Spotify
+            recommendations = getattr(engine, 'recommend_many_uncached', engine).__self__.recommend(track_id, args.num_recs) or []
+            timings.step('spotify')
+        if args.json:
+            print(json.dumps({'engine': args.engine, 'track_id': track_id, 'recommendations': recommendations}))
+        elif not recommendations:
+            print(f'{track_id}: not in the catalog' + ('' if args.online else ' (--online looks it up on Spotify)'), file=sys.stderr)
+        elif isinstance(recommendations[0], dict):
+            print(f'Recommendations for {track_id}:')
+            for rec in recommendations:
+                print(f"{rec['rank']}. {rec['track_name']} by {rec['artist_name']} ({rec['track_id']})")
+
+def fit(args):
+    timings = Timings(True)
+    catalog = _load_catalog(args)
+    timings.step('catalog')
+    for name in args.engines:
+        # Fitted from scratch even when a saved model exists, the new one replaces it
+        model = _load_engine(catalog, name, None, args).__self__
+        path = os.path.join(args.models, name)
+        model.save(path)
+        timings.step(f'{name} (saved to {path})')
+
+def measure_import(module, repeat=5):
+    """
+    This function measures the cold start of a module: the time to import it in a fresh interpreter.
+
+    Parameters:
+        module (str): Module name, imported from the repository root.
+        repeat (int): Interpreters started, the fastest one counts (the others paid for a cold disk cache).
+
+    Returns:
+        dict: Import and whole-process milliseconds and the heavy modules (HEAVY_MODULES) the import loaded.
+    """
+    code = ('import sys, time; start = time.perf_counter(); import {0}; seconds = time.perf_counter() - start; '
+            'print(seconds, *[name for name in {1!r} if name in sys.modules])').format(module, HEAVY_MODULES)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True).stdout.split()
+        process = time.perf_counter() - start
+        if best is None or float(out[0]) < best['import_ms'] / 1000:
+            best = {'module': module, 'import_ms': float(out[0]) * 1000, 'process_ms': process * 1000, 'heavy': out[1:]}
+    return best
+
+def slowest_imports(module, top=10):
+    # The top slowest imports (own time, without their children) of a module, from python -X importtime
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                         capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in err.splitlines()[1:]: # header: import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and line.startswith('import time:'):
+            rows.append((int(fields[0].split(':')[1]), fields[2].strip()))
+    return sorted(rows, reverse=True)[:top]
+
+def startup(args):
+    print(f"{'module':<30} {'import ms':>10} {'process ms':>11}  heavy modules loaded")
+    for module in args.modules:
+        result = measure_import(module, args.repeat)
+        print(f"{module:<30} {result['import_ms']:>10.0f} {result['process_ms']:>11.0f}  {', '.join(result['heavy']) or '-'}")
+        for self_us, name in (slowest_imports(module, args.top) if args.top else []):
+            print(f'    {self_us / 1000:>8.1f} ms  {name}')
+
+def _add_data_arguments(parser):
+    parser.add_argument('--catalog', default='spotify_data.csv')
+    parser.add_argument('--playlist', default='Playlists/Pico_songs.csv', help='playlist the collaborative model is fitted on')
+    parser.add_argument('--playlists', nargs='+', default=None, help='playlists the item-item model is fitted on (default: Playlists/*.csv)')
+    parser.add_argument('--liked-songs', default='ahhhhhhhhhhhhhhhhhhhhhlejandro_liked_songs.csv', help='liked songs the content model is fitted on')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random recommender and the content model')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recommend, fit, evaluate and ingest from the command line.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('recommend', help='recommend songs for seed tracks')
+    command.add_argument('track_ids', nargs='+')
+    command.add_argument('--engine', default='popular', choices=ENGINES)
+    command.add_argument('--num-recs', type=int, default=10)
+    command.add_argument('--models', default=None, help='directory of saved models, missing ones are fitted')
+    command.add_argument('--online', action='store_true', help='look up tracks missing from the catalog on Spotify (popular, random)')
+    command.add_argument('--json', action='store_true', help='one JSON object per seed')
+    command.add_argument('--timings', action='store_true', help='print the time of every step (cold start) to stderr')
+    command.add_argument('--cache-path', default=None, help='SQLite file that keeps the results across runs (not for random)')
+    command.add_argument('--cache-ttl', type=float, default=300.0, help='seconds a cached result stays valid')
+    _add_data_arguments(command)
+
+    command = commands.add_parser('fit', help='fit models and save them')
+    command.add_argument('--models', required=True, help='directory the models are saved to, one subdirectory per engine')
+    command.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+    _add_data_arguments(command)
+
+    for name, module in DELEGATED.items():
+        # Their arguments are parsed by the module's own main, `cli.py <command> --help` shows them
+        commands.add_parser(name, add_help=False, help=f'run {module}.py (see --help)')
+
+    command = commands.add_parser('startup', help='measure the import time of the modules in fresh interpreters')
+    command.add_argument('modules', nargs='*', default=list(STARTUP_MODULES))
+    command.add_argument('--repeat', type=int, default=5, help='interpreters per module, the fastest counts')
+    command.add_argument('--top', type=int, default=0, help='also list the slowest imports of every module (python -X importtime)')
+
+    args, rest = parser.parse_known_args(argv)
+    if args.command in DELEGATED:
+        import importlib
+        return importlib.import_module(DELEGATED[args.command]).main(rest)
+    if rest:
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    {'recommend': recommend, 'fit': fit, 'startup': startup}[args.command](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# Lets the tests under tests/ import the modules of the repository root, however pytest is started
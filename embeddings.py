@@ -0,0 +1,248 @@
+import numpy as np
+import pandas as pd
+from artifacts import catalog_meta, check_catalog, load_array, new_model_version, read_meta, save_array, staging, write_meta
+from instrumentation import stage
+from records import make_records
+
+### Compact song embeddings for low-memory similarity search.
+# Every song becomes a fixed-width vector of its audio features and numeric columns: each column is
+# standardized (heavy-tailed ones after a log), clipped and weighted, the key becomes a point on a
+# circle (B sits next to C), and the vector is scaled to unit length so dot products are cosine
+# similarities. Vectors are quantized to int8 with one scale per dimension: 16 bytes per song, 16MB
+# for a million songs, in one contiguous array that is memory-mapped on load, so all serving
+# processes share it through the page cache. A search scores the int8 codes against the query a
+# chunk of the catalog at a time, keeps the `rerank` best candidates and re-ranks them with the
+# float vectors, which stay on disk: only the candidates' rows are read.
+
+AUDIO_COLS = ['danceability', 'energy', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness',
+              'liveness', 'valence', 'tempo', 'time_signature']
+NUMERIC_COLS = ['popularity', 'year', 'duration_ms']
+KEY_COL = 'key' # pitch class 0-11
+LOG_COLS = ('duration_ms',)
+EMBEDDING_COLS = AUDIO_COLS + NUMERIC_COLS + [KEY_COL] # catalog columns the embeddings are built from
+DIMENSIONS = AUDIO_COLS + NUMERIC_COLS + ['key_sin', 'key_cos']
+CLIP = 4.0 # standardized values are clipped to this many standard deviations
+ENCODE_CHUNK = 1 << 17 # rows encoded at a time, bounds the float64 temporaries of fit
+SEARCH_CHUNK = 1 << 16 # catalog rows scored at a time
+QUERY_CHUNK = 64 # queries scored together, with SEARCH_CHUNK bounds the (rows x queries) score block
+
+def quantize(vectors, scales):
+    # int8 codes of float vectors, code * scale approximates the value of every dimension
+    return np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+
+class SongEmbeddings:
+    def __init__(self, song_dataset, weights=None, rerank=100):
+        """
+        Parameters:
+            song_dataset (pandas.DataFrame): The catalog, with the columns in EMBEDDING_COLS plus track_id.
+            weights (dict): Column -> weight of its dimensions (KEY_COL weighs both key dimensions), 1.0 for the others.
+            rerank (int): Candidates per query re-ranked with the float vectors, more is slower and closer to exact.
+        """
+        self.song_dataset = song_dataset
+        self.weights = {col: float((weights or {}).get(col, 1.0)) for col in EMBEDDING_COLS}
+        self.rerank = rerank
+        self.mean = None # per standardized column, after the log of LOG_COLS
+        self.std = None
+        self.codes = None # (songs, dimensions) int8
+        self.scales = None # (dimensions,) float32
+        self.vectors = None # (songs, dimensions) float32 unit vectors, only read for the re-ranking
+        self.model_version = None
+        self._index_tracks()
+
+    def _index_tracks(self):
+        # Map every track_id to its first row (the catalog can list a track more than once)
+        track_ids = self.song_dataset['track_id']
+        if isinstance(track_ids.dtype, pd.CategoricalDtype):
+            self.track_codes, self.track_ids = np.asarray(track_ids.cat.codes), pd.Index(track_ids.cat.categories)
+        else:
+            self.track_codes, self.track_ids = pd.factorize(track_ids)
+            self.track_ids = pd.Index(self.track_ids)
+        rows = np.flatnonzero(self.track_codes >= 0) # songs without a track id are never looked up
+        self.track_rows = np.full(len(self.track_ids), -1, dtype=np.int64)
+        self.track_rows[self.track_codes[rows][::-1]] = rows[::-1]
+        self.track_counts = np.bincount(self.track_codes[rows], minlength=len(self.track_ids)) # copies of every track
+
+    def __len__(self):
+        return len(self.song_dataset)
+
+    def _raw(self, data, col):
+        values = np.asarray(data[col], dtype=np.float64)
+        return np.log1p(np.maximum(values, 0)) if col in LOG_COLS else values
+
+    def fit(self):
+        """
+        This function computes the embeddings of every song in the catalog, a chunk of rows at a time, and quantizes them.
+
+        Returns:
+            SongEmbeddings: The fitted embeddings.
+        """
+        columns = AUDIO_COLS + NUMERIC_COLS
+        with stage('embeddings.fit', items=len(self)):
+            # One column at a time, so the catalog is never copied into a float64 frame
+            raw = [self._raw(self.song_dataset, col) for col in columns]
+            self.mean = np.array([np.nanmean(values) if len(values) else 0.0 for values in raw])
+            self.std = np.array([np.nanstd(values) if len(values) else 0.0 for values in raw])
+            self.std[~(self.std > 0)] = 1.0 # constant (or empty) columns
+            self.mean[np.isnan(self.mean)] = 0.0
+            del raw
+            self.vectors = np.empty((len(self), len(DIMENSIONS)), dtype=np.float32)
+            for start in range(0, len(self), ENCODE_CHUNK):
+                self.vectors[start:start + ENCODE_CHUNK] = self.transform(self.song_dataset.iloc[start:start + ENCODE_CHUNK])
+            top = np.abs(self.vectors).max(axis=0) if len(self) else np.zeros(len(DIMENSIONS), dtype=np.float32)
+            self.scales = np.where(top > 0, top / 127, 1.0).astype(np.float32)
+            self.codes = np.empty(self.vectors.shape, dtype=np.int8)
+            for start in range(0, len(self), ENCODE_CHUNK):
+                self.codes[start:start + ENCODE_CHUNK] = quantize(self.vectors[start:start + ENCODE_CHUNK], self.scales)
+        self.model_version = new_model_version()
+        return self
+
+    def transform(self, data):
+        """
+        This function embeds songs with the fitted statistics, e.g. songs that are not in the catalog.
+
+        Parameters:
+            data (pandas.DataFrame): Songs with the columns in EMBEDDING_COLS. Missing values count as the mean.
+
+        Returns:
+            numpy.ndarray: float32 array of shape (len(data), len(DIMENSIONS)), rows of unit length (zero for songs
+            without any known value).
+        """
+        vectors = np.zeros((len(data), len(DIMENSIONS)), dtype=np.float64)
+        for i, col in enumerate(AUDIO_COLS + NUMERIC_COLS):
+            values = np.clip((self._raw(data, col) - self.mean[i]) / self.std[i], -CLIP, CLIP)
+            vectors[:, i] = np.nan_to_num(values) * self.weights[col]
+        angle = self._raw(data, KEY_COL) * (2 * np.pi / 12)
+        vectors[:, -2] = np.nan_to_num(np.sin(angle)) * self.weights[KEY_COL]
+        vectors[:, -1] = np.nan_to_num(np.cos(angle)) * self.weights[KEY_COL]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+    def search(self, queries, k):
+        """
+        This function finds the songs most similar to query vectors: the int8 codes of the whole catalog are scored
+        first, then the best candidates of every query are re-ranked by their exact cosine similarity.
+
+        Parameters:
+            queries (numpy.ndarray): (num_queries, len(DIMENSIONS)) unit vectors, from transform or self.vectors.
+            k (int): Number of songs per query.
+
+        Returns:
+            tuple: (similarities, rows) arrays of shape (num_queries, k), most similar first. Missing songs (catalogs
+            smaller than k) are padded with -inf and -1.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        num_candidates = min(max(self.rerank, k), len(self))
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        if num_candidates == 0:
+            return similarities, rows
+        for first in range(0, len(queries), QUERY_CHUNK):
+            chunk = queries[first:first + QUERY_CHUNK]
+            with stage('embeddings.scan', items=len(chunk)):
+                candidates = self._candidates(chunk, num_candidates)
+            with stage('embeddings.rerank', items=len(chunk)):
+                exact = np.einsum('qcd,qd->qc', self.vectors[candidates], chunk) # only the candidates' rows are read
+                order = np.argsort(-exact, axis=1, kind='stable')[:, :k]
+                width = order.shape[1]
+                similarities[first:first + len(chunk), :width] = np.take_along_axis(exact, order, axis=1)
+                rows[first:first + len(chunk), :width] = np.take_along_axis(candidates, order, axis=1)
+        return similarities, rows
+
+    def _candidates(self, queries, num_candidates):
+        # Rows of the num_candidates best approximate scores of every query, query . code * scale, ascending
+        weighted = queries * self.scales
+        threshold = None
+        found_queries, found_rows, found_scores = [], [], []
+        for start in range(0, len(self), SEARCH_CHUNK):
+            # (queries, rows): every query's scores are contiguous, so comparing them with its threshold is one long loop
+            scores = weighted @ self.codes[start:start + SEARCH_CHUNK].astype(np.float32).T
+            if threshold is None and scores.shape[1] > num_candidates:
+                # The num_candidates-th best score of the first chunk bounds the final one from below, so every chunk
+                # only keeps the few scores at or above it instead of partitioning all of them
+                threshold = np.partition(scores, scores.shape[1] - num_candidates, axis=1)[:, -num_candidates, None]
+            kept = np.flatnonzero(scores >= threshold) if threshold is not None else np.arange(scores.size)
+            query_pos, rows = np.divmod(kept, scores.shape[1])
+            found_queries.append(query_pos)
+            found_rows.append(rows + start)
+            found_scores.append(scores.ravel()[kept])
+        query_pos, rows, scores = np.concatenate(found_queries), np.concatenate(found_rows), np.concatenate(found_scores)
+
+        # Best num_candidates per query (every query has at least that many)
+        order = np.lexsort((-scores, query_pos))
+        query_pos = query_pos[order]
+        position = np.arange(len(order)) - np.searchsorted(query_pos, query_pos)
+        best = rows[order][position < num_candidates].reshape(len(queries), num_candidates)
+        return np.sort(best, axis=1) # ascending rows read the float vectors in file order
+
+    def lookup(self, track_ids):
+        # Rows of the given track ids, -1 for tracks that are not in the catalog
+        codes = self.track_ids.get_indexer(pd.Index(track_ids, dtype=object))
+        return np.where(codes >= 0, self.track_rows[codes], -1)
+
+    def recommend_many(self, track_ids, num_recs=30):
+        """
+        This function recommends the songs that sound most like many seed tracks in one batched search.
+
+        Parameters:
+            track_ids (list): Seed track ids. Seeds that are not in the catalog get no recommendations.
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            numpy.ndarray: Structured array with fields seed (position in track_ids), rank, row (in song_dataset) and track_id.
+        """
+        seed_rows = self.lookup(track_ids)
+        found = np.flatnonzero(seed_rows >= 0)
+        if len(found) == 0:
+            return make_records([], [], [], [])
+        seed_rows = seed_rows[found]
+        # Every copy of a seed can come before the first other song
+        _, rows = self.search(self.vectors[seed_rows], num_recs + int(self.track_counts[self.track_codes[seed_rows]].max()))
+
+        # Drop the seed itself (and any other copy of it) and missing songs, then keep num_recs per seed
+        neighbour_codes = self.track_codes[np.maximum(rows, 0)]
+        keep = (rows >= 0) & (neighbour_codes != self.track_codes[seed_rows][:, None])
+        keep &= np.cumsum(keep, axis=1) <= num_recs
+        seed_pos, _ = np.nonzero(keep)
+        ranks = np.cumsum(keep, axis=1)[keep]
+        return make_records(found[seed_pos], ranks, rows[keep], np.asarray(self.track_ids[neighbour_codes[keep]], dtype=object))
+
+    def memory_footprint(self):
+        # Bytes of what a search keeps in memory (codes and scales) next to the float vectors it leaves on disk
+        return {'songs': len(self), 'dimensions': len(DIMENSIONS), 'code_bytes': int(self.codes.nbytes + self.scales.nbytes),
+                'vector_bytes': int(self.vectors.nbytes), 'bytes_per_song': self.codes.shape[1] * self.codes.itemsize}
+
+    def save(self, path):
+        # Write the codes, scales, float vectors and statistics as a versioned artifact (see artifacts.py)
+        with staging(path) as tmp_path:
+            for name in ('codes', 'scales', 'vectors', 'mean', 'std'):
+                save_array(tmp_path, name, getattr(self, name))
+            write_meta(tmp_path, 'embeddings', dimensions=DIMENSIONS, weights=self.weights, rerank=self.rerank,
+                       model_version=self.model_version, **catalog_meta(self.song_dataset))
+
+    @classmethod
+    def load(cls, path, song_dataset, mmap=True):
+        """
+        This function loads embeddings written by save.
+
+        Parameters:
+            path (str): Directory the embeddings were saved to.
+            song_dataset (pandas.DataFrame): The catalog they were fitted on, only its track_id column is used.
+            mmap (bool): Memory-map the codes and vectors instead of reading them into memory.
+
+        Returns:
+            SongEmbeddings: The loaded embeddings.
+
+        Raises:
+            ValueError: If the artifact was fitted on another catalog or with other dimensions.
+        """
+        meta = read_meta(path, 'embeddings')
+        check_catalog(meta, song_dataset, path)
+        if meta['dimensions'] != DIMENSIONS:
+            raise ValueError(f"Artifact {path} has dimensions {meta['dimensions']}, expected {DIMENSIONS}.")
+        model = cls(song_dataset, weights=meta['weights'], rerank=meta['rerank'])
+        model.codes = load_array(path, 'codes', mmap)
+        model.vectors = load_array(path, 'vectors', mmap)
+        for name in ('scales', 'mean', 'std'):
+            setattr(model, name, load_array(path, name, mmap=False))
+        model.model_version = meta.get('model_version') or new_model_version()
+        return model
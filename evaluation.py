@@ -0,0 +1,317 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+### Offline evaluation of the recommenders on held-out playlist tracks.
+# Playlists are a playlist x track CSR matrix (ItemItemRecSys.playlist_matrix, or
+# InteractionStore.playlist_matrix for the Million Playlist Dataset). A fraction of every playlist
+# is held out, the rest are its seeds. Every engine is asked for all the seeds of a chunk of
+# playlists in batched recommend_many calls, and the recommendations of a playlist's seeds are fused
+# by reciprocal rank (sum of 1 / (RRF_K + rank)) into its top k, leaving out the seeds themselves.
+# Recommendations are padded (playlists, k) arrays of track numbers, so the metrics are computed with
+# a few array operations over all playlists at once. Chunks of playlists run on worker processes
+# that inherit the fitted engines (fork), and bootstrap resampling of the playlists gives confidence
+# intervals.
+#
+#   python evaluation.py --catalog spotify_data.csv --playlists Playlists/*.csv --engines popular collab
+#   python evaluation.py --catalog spotify_data.csv --store mpd_store --max-playlists 5000
+
+RRF_K = 60 # same fusion as HybridRecSys
+METRICS = ('precision', 'recall', 'ndcg', 'hit_rate', 'novelty')
+
+_worker_state = None # what forked workers evaluate, set by evaluate before the pool starts
+
+def split_holdout(matrix, fraction=0.2, seed=0, min_tracks=2):
+    """
+    This function holds out a random fraction of every playlist's tracks.
+
+    Parameters:
+        matrix (scipy.sparse.spmatrix): Playlist x track matrix, non-zero where a track is in a playlist.
+        fraction (float): Share of every playlist held out, at least one track and never all of them.
+        seed (int): Seed of the draw.
+        min_tracks (int): Playlists with fewer tracks hold out nothing and are not evaluated.
+
+    Returns:
+        tuple: (train, test) CSR matrices of the same shape with the seed and the held-out tracks of every playlist.
+    """
+    if not 0 < fraction < 1:
+        raise ValueError(f"The held-out fraction must be between 0 and 1, got {fraction}.")
+    matrix = sp.csr_matrix(matrix, dtype=np.float32, copy=True)
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    lengths = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(matrix.shape[0]), lengths)
+    num_test = np.where(lengths >= max(min_tracks, 2), np.clip(np.floor(lengths * fraction), 1, lengths - 1), 0)
+
+    # A random order within every row, its first num_test entries are held out
+    order = np.lexsort((np.random.default_rng(seed).random(matrix.nnz), rows))
+    rank = np.empty(matrix.nnz, dtype=np.int64)
+    rank[order] = np.arange(matrix.nnz) - matrix.indptr[rows[order]]
+    test = rank < num_test[rows]
+    part = lambda keep: sp.csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
+    return part(~test), part(test)
+
+def recommend_playlists(recommend_many, train, track_ids, k=10, per_seed=None, max_seeds=None, batch_size=1024, seed=0):
+    """
+    This function recommends k tracks for every playlist of train from the recommendations of its seeds.
+
+    Parameters:
+        recommend_many (callable): recommend_many of an engine, takes track ids and num_recs and returns records.
+        train (scipy.sparse.csr_matrix): Playlist x track matrix of the seeds.
+        track_ids (pandas.Index): Track id of every column. Recommended tracks that are not in it are dropped.
+        k (int): Recommendations per playlist.
+        per_seed (int): Recommendations asked per seed, 2 * k if None.
+        max_seeds (int): Most seeds used per playlist (a random subset), all if None.
+        batch_size (int): Seeds per recommend_many call.
+        seed (int): Seed of the max_seeds subset.
+
+    Returns:
+        numpy.ndarray: int64 array of shape (playlists, k) with the column of every recommended track, best first,
+        padded with -1.
+    """
+    num_playlists, num_tracks = train.shape
+    rows = np.repeat(np.arange(num_playlists), np.diff(train.indptr))
+    columns = train.indices
+    if max_seeds is not None:
+        order = np.lexsort((np.random.default_rng(seed).random(len(rows)), rows))
+        keep = np.empty(len(rows), dtype=bool)
+        keep[order] = np.arange(len(rows)) - train.indptr[rows[order]] < max_seeds
+        rows, columns = rows[keep], columns[keep]
+
+    # Every distinct seed is asked once, however many playlists it is in
+    seeds = np.unique(columns)
+    seed_ids = list(track_ids[seeds])
+    per_seed = per_seed or 2 * k
+    positions, recommended, scores = [], [], []
+    for start in range(0, len(seeds), batch_size):
+        records = recommend_many(seed_ids[start:start + batch_size], per_seed)
+        found = track_ids.get_indexer(pd.Index(np.asarray(records['track_id'], dtype=object)))
+        known = found >= 0
+        positions.append(start + records['seed'][known].astype(np.int64))
+        recommended.append(found[known])
+        scores.append(1.0 / (RRF_K + records['rank'][known]))
+    if not seeds.size or not sum(len(part) for part in positions):
+        return np.full((num_playlists, k), -1, dtype=np.int64)
+    by_seed = sp.csr_matrix((np.concatenate(scores), (np.concatenate(positions), np.concatenate(recommended))),
+                            shape=(len(seeds), num_tracks))
+    membership = sp.csr_matrix((np.ones(len(rows)), (rows, np.searchsorted(seeds, columns))), shape=(num_playlists, len(seeds)))
+
+    # Fused scores of every playlist, without its own seeds, then the best k of every row
+    fused = (membership @ by_seed).tocsr()
+    fused = fused - fused.multiply(train > 0)
+    fused.eliminate_zeros()
+    fused_rows = np.repeat(np.arange(num_playlists), np.diff(fused.indptr))
+    order = np.lexsort((fused.indices, -fused.data, fused_rows))
+    rank = np.arange(len(order)) - fused.indptr[fused_rows[order]]
+    top = order[rank < k]
+    result = np.full((num_playlists, k), -1, dtype=np.int64)
+    result[fused_rows[top], rank[rank < k]] = fused.indices[top]
+    return result
+
+def ranking_metrics(recommended, test, popularity=None, num_playlists=None):
+    """
+    This function computes the ranking metrics of every playlist from padded recommendation arrays.
+
+    Parameters:
+        recommended (numpy.ndarray): (playlists, k) columns of the recommended tracks, -1 for missing ones.
+        test (scipy.sparse.csr_matrix): Playlist x track matrix of the held-out tracks.
+        popularity (numpy.ndarray): Number of training playlists of every track, for novelty.
+        num_playlists (int): Number of training playlists popularity was counted over.
+
+    Returns:
+        dict: Metric name -> array with one value per playlist: precision@k, recall@k, NDCG@k, hit rate and
+        novelty (mean self-information -log2 p of the recommended tracks, NaN without recommendations).
+    """
+    num_rows, k = recommended.shape
+    test = sp.csr_matrix(test)
+    test.sort_indices()
+    num_tracks = test.shape[1]
+    num_test = np.diff(test.indptr)
+    valid = recommended >= 0
+
+    # A recommendation is a hit when (row, track) is a held-out pair, the pairs are sorted as CSR keeps them
+    test_keys = np.repeat(np.arange(num_rows, dtype=np.int64), num_test) * num_tracks + test.indices
+    keys = np.arange(num_rows, dtype=np.int64)[:, None] * num_tracks + recommended
+    positions = np.minimum(np.searchsorted(test_keys, keys), max(len(test_keys) - 1, 0))
+    hits = valid & (test_keys[positions] == keys) if len(test_keys) else np.zeros_like(valid)
+
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal = np.concatenate([[0.0], np.cumsum(discounts)])[np.minimum(num_test, k)]
+    num_hits = hits.sum(axis=1)
+    metrics = {
+        'precision': num_hits / k,
+        'recall': num_hits / np.maximum(num_test, 1),
+        'ndcg': (hits * discounts).sum(axis=1) / np.where(ideal > 0, ideal, 1),
+        'hit_rate': (num_hits > 0).astype(np.float64),
+    }
+    if popularity is not None:
+        information = -np.log2((np.asarray(popularity, dtype=np.float64) + 1) / (num_playlists + 1)) # add-one smoothed
+        counts = valid.sum(axis=1)
+        total = np.where(valid, information[np.maximum(recommended, 0)], 0).sum(axis=1)
+        metrics['novelty'] = np.where(counts > 0, total / np.maximum(counts, 1), np.nan)
+    return metrics
+
+def bootstrap(values, num_samples=1000, confidence=0.95, seed=0):
+    """
+    This function computes percentile bootstrap confidence intervals of column means, resampling the rows.
+
+    Parameters:
+        values (numpy.ndarray): (rows, columns) array, one row per playlist and one column per metric. NaNs are skipped.
+        num_samples (int): Bootstrap resamples.
+        confidence (float): Coverage of the interval.
+        seed (int): Seed of the resampling.
+
+    Returns:
+        tuple: Lower and upper bound of every column mean.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rows, columns = values.shape
+    if rows == 0:
+        return np.full(columns, np.nan), np.full(columns, np.nan)
+    rng = np.random.default_rng(seed)
+    block = max(1, (1 << 22) // max(rows * columns, 1)) # resamples drawn at once, about 32MB of float64
+    means = []
+    for start in range(0, num_samples, block):
+        sample = values[rng.integers(0, rows, size=(min(block, num_samples - start), rows))]
+        means.append(np.nanmean(sample, axis=1))
+    means = np.concatenate(means)
+    alpha = (1 - confidence) / 2
+    return np.nanquantile(means, alpha, axis=0), np.nanquantile(means, 1 - alpha, axis=0)
+
+def _evaluate_chunk(name, start, stop, state=None):
+    # Recommendations and metrics of the playlists start to stop for one engine (in a forked worker: its inherited state)
+    state = state or _worker_state
+    train, test = state['train'][start:stop], state['test'][start:stop]
+    recommended = recommend_playlists(state['engines'][name], train, state['track_ids'], **state['options'])
+    metrics = ranking_metrics(recommended, test, state['popularity'], state['num_playlists'])
+    return metrics, np.unique(recommended[recommended >= 0])
+
+def evaluate(engines, matrix, track_ids, k=10, holdout=0.2, catalog_track_ids=None, workers=None, chunk_size=1000,
+             num_samples=1000, confidence=0.95, seed=0, **options):
+    """
+    This function evaluates every engine on the same held-out playlist tracks.
+
+    Parameters:
+        engines (dict): Engine name -> recommend_many function, e.g. from server.load_engines.
+        matrix (scipy.sparse.spmatrix): Playlist x track matrix.
+        track_ids (list): Track id of every column.
+        k (int): Recommendations per playlist.
+        holdout (float): Share of every playlist held out (see split_holdout).
+        catalog_track_ids (list): Track ids the engines recommend from (the catalog). They are added as columns, so
+        their recommendations count for coverage and novelty, and coverage is measured against them. If None,
+        coverage is measured against the playlists' tracks and recommendations of other tracks are dropped.
+        workers (int): Worker processes evaluating chunks of playlists (default: one per core, 0 runs in this process).
+        chunk_size (int): Playlists per chunk.
+        num_samples (int): Bootstrap resamples for the confidence intervals, 0 for none.
+        confidence (float): Coverage of the confidence intervals.
+        seed (int): Seed of the hold-out split and of the bootstrap.
+        **options: per_seed, max_seeds and batch_size, see recommend_playlists.
+
+    Returns:
+        pandas.DataFrame: One row per engine with the mean of every metric and its confidence interval
+        (<metric>_low, <metric>_high), the catalog coverage, the number of playlists evaluated and the seconds it took.
+    """
+    global _worker_state
+    track_ids = pd.Index(track_ids, dtype=object)
+    matrix = sp.csr_matrix(matrix)
+    num_recommendable = matrix.shape[1]
+    if catalog_track_ids is not None:
+        catalog_track_ids = pd.Index(pd.unique(np.asarray(catalog_track_ids, dtype=object)))
+        extra = catalog_track_ids[track_ids.get_indexer(catalog_track_ids) < 0]
+        track_ids = track_ids.append(extra)
+        matrix = sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], len(track_ids)))
+        num_recommendable = len(catalog_track_ids)
+    train, test = split_holdout(matrix, holdout, seed)
+    evaluated = np.flatnonzero(np.diff(test.indptr) > 0)
+    train, test = train[evaluated], test[evaluated]
+    state = {'engines': engines, 'train': train, 'test': test, 'track_ids': track_ids,
+             'popularity': np.bincount(train.indices, minlength=train.shape[1]), 'num_playlists': train.shape[0],
+             'options': dict(options, k=k, seed=seed)}
+    chunks = [(start, min(start + chunk_size, len(evaluated))) for start in range(0, len(evaluated), chunk_size)]
+    workers = os.cpu_count() if workers is None else workers
+    forkable = 'fork' in multiprocessing.get_all_start_methods()
+
+    summary = []
+    for name in engines:
+        started = time.perf_counter()
+        if workers > 1 and len(chunks) > 1 and forkable:
+            # Forked workers inherit the fitted engines and the matrices instead of receiving pickled copies
+            _worker_state = state
+            try:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                    results = list(pool.map(_evaluate_chunk, *zip(*[(name, start, stop) for start, stop in chunks])))
+            finally:
+                _worker_state = None
+        else:
+            results = [_evaluate_chunk(name, start, stop, state) for start, stop in chunks]
+
+        values = {metric: np.concatenate([result[0][metric] for result in results]) if results else np.zeros(0) for metric in METRICS}
+        table = np.column_stack([values[metric] for metric in METRICS])
+        row = {'engine': name}
+        low, high = bootstrap(table, num_samples, confidence, seed) if num_samples else (None, None)
+        for i, metric in enumerate(METRICS):
+            row[metric] = float(np.nanmean(values[metric])) if len(values[metric]) else np.nan
+            if num_samples:
+                row[metric + '_low'], row[metric + '_high'] = float(low[i]), float(high[i])
+        covered = np.unique(np.concatenate([result[1] for result in results])) if results else []
+        row['coverage'] = len(covered) / max(num_recommendable, 1)
+        row['playlists'] = len(evaluated)
+        row['seconds'] = time.perf_counter() - started
+        summary.append(row)
+    return pd.DataFrame(summary).set_index('engine')
+
+def main(argv=None):
+    from catalog import load_catalog
+    from server import CATALOG_COLUMNS, ENGINES, load_engines
+    parser = argparse.ArgumentParser(description='Evaluate the recommenders on held-out playlist tracks.')
+    parser.add_argument('--catalog', default='spotify_data.csv')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--playlists', nargs='+', help='playlist CSVs (the Playlists/*.csv schema)')
+    source.add_argument('--store', help='interaction store written by mpd_ingest.py')
+    parser.add_argument('--max-playlists', type=int, default=None, help='evaluate a random sample of this many playlists')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+    parser.add_argument('--models', default=None, help='directory of saved models, one subdirectory per engine')
+    parser.add_argument('--playlist', default='Playlists/Pico_songs.csv', help='playlist the collaborative model is fitted on')
+    parser.add_argument('--liked-songs', default='ahhhhhhhhhhhhhhhhhhhhhlejandro_liked_songs.csv', help='liked songs the content model is fitted on')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--holdout', type=float, default=0.2)
+    parser.add_argument('--max-seeds', type=int, default=None, help='seeds used per playlist')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core, 0 runs in this process)')
+    parser.add_argument('--bootstrap', type=int, default=1000, help='bootstrap resamples, 0 for no confidence intervals')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='CSV file the summary is written to')
+    args = parser.parse_args(argv)
+
+    if args.store:
+        from mpd_ingest import InteractionStore
+        matrix, _, track_ids = InteractionStore(args.store).playlist_matrix()
+    else:
+        from ItemItemRecSys import playlist_matrix, read_playlists
+        matrix, track_ids = playlist_matrix(read_playlists(args.playlists))
+    if args.max_playlists is not None and args.max_playlists < matrix.shape[0]:
+        rows = np.sort(np.random.default_rng(args.seed).choice(matrix.shape[0], args.max_playlists, replace=False))
+        matrix = matrix[rows]
+
+    catalog = load_catalog(args.catalog, columns=CATALOG_COLUMNS)
+    engines = load_engines(catalog, [name for name in args.engines if name != 'itemitem'], args.models, args.playlist,
+                           args.liked_songs, seed=args.seed)
+    if 'itemitem' in args.engines:
+        # Fitted here on the seeds of the evaluated playlists (the split evaluate makes), never on their held-out tracks.
+        # Not tied to the catalog: it recommends any playlist track, the metrics only need track ids
+        from ItemItemRecSys import ItemItemRecSys
+        train, _ = split_holdout(matrix, args.holdout, args.seed)
+        engines['itemitem'] = ItemItemRecSys().fit_matrix(train, track_ids).recommend_many
+        engines = {name: engines[name] for name in args.engines}
+    summary = evaluate(engines, matrix, track_ids, k=args.k, holdout=args.holdout, catalog_track_ids=catalog['track_id'],
+                       workers=args.workers, num_samples=args.bootstrap, seed=args.seed, max_seeds=args.max_seeds)
+    print(summary.to_string(float_format=lambda value: f'{value:.4f}'))
+    if args.output:
+        summary.to_csv(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -1,80 +1,32 @@
-import pandas as pd
-from ContentRecSys import ContentBasedRecSys
-from RandomRecSys import RandomRec
-from PopularRecSys import PopularRec
-from CollaborativeFilteringRecSys import CollaborativeFilteringRecSys
+import argparse
+from experiment_runner import run_grid, ResultStore
 
 track_ids = ['6EtAJUmBqj57hkiBxDy27I', '3yZdQkCzLVKXDEsr9672Db', '0zmitk2ty065TMAvEtGWQ6', '4NOdVqCo6n2Bzsyhl00oB5', '6XdMns9ysH61ngwt7wMh0u']
 playlist_ds = ['Playlists/200_songs.csv', 'Playlists/Digital Desert_songs.csv', 'Playlists/Pico_songs.csv','Playlists/Resolve._songs.csv', 'Playlists/Tizón_songs.csv']
 
-num_recs = 10
-num_training_songs = 25
-
-for i in range(len(track_ids)): 
-    spotify_data = pd.read_csv('spotify_data.csv')
-    track_id = track_ids[i]
-    print('====Popular Recommendation System====')
-    popular_rec = PopularRec(spotify_data)
-    recommendations = popular_rec.recommend(track_id, num_recs)
-    pd.DataFrame(recommendations).to_csv(f'Results/{i}_popular_recs.csv', index=False) # Save the DataFrame to a CSV file before returning
-
-    print('')
-    print('====Random Recommendation System====')
-    random_rec = RandomRec(spotify_data)
-    random_rec.recommend(track_id, num_recs)
-    pd.DataFrame(recommendations).to_csv(f'Results/{i}_random_recs.csv', index=False) # Save the DataFrame to a CSV file before returning
-    
-    print('')
-    print('====Collaborative Filtering Recommendation System====')
-    playlist_df = pd.read_csv(playlist_ds[i])
-    song_df = pd.read_csv('spotify_data.csv')
-
-    collab_rec = CollaborativeFilteringRecSys(playlist_df, song_df, k=num_recs)
-    collab_rec.preprocess_data()
-    collab_rec.train_model()
-    playlist_data = playlist_df.iloc[0]  # Example: Get recommendations for the first playlist
-    recommendations = collab_rec.recommend(playlist_data)
-    print(recommendations)
-    pd.DataFrame(recommendations).to_csv(f'Results/{i}_collab_recs.csv', index=False) # Save the DataFrame to a CSV file before returning
-
-    num_recs+=5
-    num_training_songs += 10
-
-num_recs = 10
-num_training_songs = 25
-for i in range(len(track_ids)): 
-    
-    print('')
-    print('====Content Filtering Recommendation System====')
-
-    liked_songs_dataset = pd.read_csv('ahhhhhhhhhhhhhhhhhhhhhlejandro_liked_songs.csv')
-    song_df = pd.read_csv('spotify_data.csv')
-
-    # Create an instance of the ContentBasedRecSys class
-    rec_sys = ContentBasedRecSys(
-        song_dataset=song_df,
-        liked_songs_dataset=liked_songs_dataset,
-        n_songs=num_training_songs,
-        test_size=0.2
-    )
-
-    # Preprocess the data
-    rec_sys.preprocess_data()
-
-    # Train the model
-    rec_sys.train_model()
-
-    # Get recommendations for a specific song
-    song_id = track_ids[i]  # Turn off the lights track id 
-    recommendations = rec_sys.recommend(song_id, num_recs)
-
-    # Print the recommendations
-    if recommendations is not None:
-        print(f"Recommendations for song ID {song_id}:")
-        print(recommendations[['track_id', 'track_name', 'artist_names']])
-
-        # Convert the list of dictionaries to a DataFrame
-    pd.DataFrame(recommendations).to_csv(f'Results/{i}_content_recs.csv', index=False) # Save the DataFrame to a CSV file before returning
-
-    num_recs+=5
-    num_training_songs += 10
\ No newline at end of file
+# Every recommender is run for every combination of the values it uses (see experiment_runner.expand_grid)
+grid = {
+    'recommenders': ['popular', 'random', 'collab', 'content'],
+    'seeds': track_ids,
+    'playlists': playlist_ds,
+    'num_recs': [10, 15, 20, 25, 30],
+    'training_sizes': [25, 35, 45, 55, 65],
+    'liked_songs': 'ahhhhhhhhhhhhhhhhhhhhhlejandro_liked_songs.csv',
+    'random_seed': 0,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the recommender experiment grid.')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core, 0 runs in this process)')
+    parser.add_argument('--store', default='experiment_results.sqlite', help='SQLite file the results are written to')
+    parser.add_argument('--no-resume', action='store_true', help='rerun configurations that are already in the store')
+    args = parser.parse_args()
+
+    num_run = run_grid(grid, store_path=args.store, workers=args.workers, resume=not args.no_resume)
+    print(f'Ran {num_run} configurations.')
+
+    store = ResultStore(args.store)
+    results = store.recommendations()
+    store.close()
+    if not results.empty:
+        print(results.groupby('recommender')['config_id'].nunique().rename('configurations'))
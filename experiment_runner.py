@@ -0,0 +1,276 @@
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from catalog import load_catalog
+
+### Parallel experiment harness.
+# A declarative grid (recommenders x seeds x playlists x num_recs x training sizes) is expanded into
+# configurations, which are grouped so every fitted model is reused by all the configurations that
+# need it. Groups run on a process pool. The catalog's numeric columns, dictionary codes and category
+# strings are put in shared memory once and every worker maps them instead of receiving a pickled
+# copy. Results go to one SQLite store, and a configuration that is already in the store is skipped
+# on resume.
+
+CATALOG_COLUMNS = ['artist_name', 'track_name', 'track_id', 'popularity', 'year', 'genre', 'duration_ms']
+RECOMMENDERS = ('popular', 'random', 'collab', 'content')
+
+_worker_catalog = None # catalog DataFrame of a worker process, backed by shared memory
+_worker_memory = [] # keeps the worker's shared memory blocks open
+
+def expand_grid(grid):
+    """
+    This function expands a grid into the configurations it describes. Each recommender only varies the
+    parameters it uses: popular/random (seed, num_recs), collab (playlist, num_recs) and content
+    (seed, num_recs, training_size).
+
+    Parameters:
+        grid (dict): 'recommenders', 'seeds', 'playlists', 'num_recs', 'training_sizes' lists, plus the
+            optional 'liked_songs' path and 'random_seed'.
+
+    Returns:
+        list: One dictionary per configuration, each with a stable 'config_id'.
+    """
+    axes = {
+        'popular': ('seeds', 'num_recs'),
+        'random': ('seeds', 'num_recs'),
+        'collab': ('playlists', 'num_recs'),
+        'content': ('seeds', 'num_recs', 'training_sizes'),
+    }
+    names = {'seeds': 'seed', 'playlists': 'playlist', 'num_recs': 'num_recs', 'training_sizes': 'training_size'}
+    configs = []
+    for recommender in grid['recommenders']:
+        if recommender not in axes:
+            raise ValueError(f"Unknown recommender {recommender}, expected one of {RECOMMENDERS}.")
+        for values in itertools.product(*(grid[axis] for axis in axes[recommender])):
+            config = {'recommender': recommender, 'random_seed': grid.get('random_seed', 0)}
+            config.update((names[axis], value) for axis, value in zip(axes[recommender], values))
+            if recommender == 'content':
+                config['liked_songs'] = grid['liked_songs']
+            key = json.dumps(config, sort_keys=True)
+            config['config_id'] = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+            configs.append(config)
+    return configs
+
+def _model_key(config):
+    # Configurations with the same key share one fitted recommender
+    if config['recommender'] == 'collab':
+        return ('collab', config['playlist'], config['num_recs'], config['random_seed'])
+    if config['recommender'] == 'content':
+        return ('content', config['liked_songs'], config['training_size'], config['random_seed'])
+    return (config['recommender'],)
+
+def _config_seed(config):
+    # Deterministic per-configuration seed, independent of which worker runs it or in what order
+    return zlib.crc32(config['config_id'].encode('utf-8')) ^ config['random_seed']
+
+class SharedCatalog:
+    def __init__(self, catalog):
+        # Copy the catalog's arrays, category strings included, into shared memory blocks. One more block holds a
+        # JSON manifest of the others, its name is all a worker is passed
+        self.blocks = []
+        columns = []
+        for column in catalog.columns:
+            values = catalog[column]
+            if values.dtype == object or not isinstance(values.dtype, (np.dtype, pd.CategoricalDtype)):
+                values = values.astype('category') # strings of a catalog that did not come from the store
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                categories = values.cat.categories
+                entry = {'codes': self._share(np.asarray(values.cat.codes))}
+                if categories.dtype.kind in 'biuf':
+                    entry['categories'] = self._share(np.asarray(categories))
+                else:
+                    # Strings as one UTF-8 buffer plus the character offset where every category starts
+                    lengths = np.fromiter(map(len, categories), dtype=np.int64, count=len(categories))
+                    entry['text'] = self._share(np.frombuffer(''.join(categories).encode('utf-8'), dtype=np.uint8))
+                    entry['offsets'] = self._share(np.concatenate(([0], np.cumsum(lengths))))
+            else:
+                entry = {'values': self._share(np.asarray(values))}
+            entry['column'] = column
+            columns.append(entry)
+        manifest = json.dumps({'columns': columns, 'attrs': dict(catalog.attrs)}).encode('utf-8')
+        self.name = self._share(np.frombuffer(manifest, dtype=np.uint8))['name']
+
+    def _share(self, array):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        self.blocks.append(block)
+        return {'name': block.name, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+def _attach(spec):
+    # Workers share the parent's resource tracker, so attaching never unlinks the block, the parent does
+    block = shared_memory.SharedMemory(name=spec['name'])
+    _worker_memory.append(block)
+    array = np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+def _attach_catalog(name):
+    global _worker_catalog
+    block = shared_memory.SharedMemory(name=name)
+    manifest = json.loads(bytes(block.buf).rstrip(b'\0')) # the block can be larger than the JSON, the rest is zeros
+    block.close()
+    data = {}
+    for entry in manifest['columns']:
+        if 'values' in entry:
+            data[entry['column']] = _attach(entry['values'])
+            continue
+        if 'categories' in entry:
+            categories = _attach(entry['categories'])
+        else:
+            text, offsets = bytes(_attach(entry['text'])).decode('utf-8'), _attach(entry['offsets']).tolist()
+            categories = [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        data[entry['column']] = pd.Categorical.from_codes(_attach(entry['codes']), categories=categories)
+    _worker_catalog = pd.DataFrame(data, copy=False)
+    _worker_catalog.attrs.update(manifest['attrs'])
+
+def _song_rows(songs):
+    # (rank, track_id, track_name, artist) tuples from a DataFrame of recommended songs
+    artists = songs['artist_names'] if 'artist_names' in songs else songs['artist_name']
+    return [(rank, str(track_id), str(name), str(artist))
+            for rank, (track_id, name, artist) in enumerate(zip(songs['track_id'], songs['track_name'], artists), start=1)]
+
+def _fit(key, catalog):
+    # Build and fit the recommender a group of configurations shares
+    recommender = key[0]
+    if recommender == 'popular':
+        from PopularRecSys import PopularRec
+        return PopularRec(catalog)
+    if recommender == 'random':
+        from RandomRecSys import RandomRec
+        return RandomRec(catalog)
+    if recommender == 'collab':
+        from CollaborativeFilteringRecSys import CollaborativeFilteringRecSys
+        model = CollaborativeFilteringRecSys(pd.read_csv(key[1]), catalog, k=key[2])
+    else:
+        from ContentRecSys import ContentBasedRecSys
+        model = ContentBasedRecSys(catalog, pd.read_csv(key[1]), n_songs=key[2], random_state=key[3])
+    model.preprocess_data()
+    model.train_model()
+    return model
+
+def _run(model, config, catalog):
+    recommender = config['recommender']
+    if recommender in ('popular', 'random'):
+        if recommender == 'random':
+            model.rng = np.random.default_rng(_config_seed(config))
+        records = model.recommend_many([config['seed']], config['num_recs'])
+        return _song_rows(catalog.iloc[records['row']])
+    if recommender == 'collab':
+        return _song_rows(model.recommend(model.playlist_data))
+    songs = model.get_recommendations(config['seed'], config['num_recs'])
+    return [] if songs is None else _song_rows(songs)
+
+def run_group(key, configs, catalog=None):
+    """
+    This function fits one recommender and runs every configuration of its group.
+
+    Parameters:
+        key (tuple): Model key shared by the configurations.
+        configs (list): Configurations to run.
+        catalog (pandas.DataFrame): Song catalog, the worker's shared catalog if None.
+
+    Returns:
+        list: (config, seconds, recommendation rows) for every configuration.
+    """
+    catalog = _worker_catalog if catalog is None else catalog
+    start = time.perf_counter()
+    model = _fit(key, catalog)
+    fit_seconds = time.perf_counter() - start
+    results = []
+    for config in configs:
+        start = time.perf_counter()
+        rows = _run(model, config, catalog)
+        results.append((config, fit_seconds + time.perf_counter() - start, rows))
+        fit_seconds = 0.0 # charge the fit to the first configuration of the group
+    return results
+
+class ResultStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (config_id TEXT PRIMARY KEY, recommender TEXT, params TEXT, seconds REAL, finished_at REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS recommendations (config_id TEXT, rank INTEGER, track_id TEXT, track_name TEXT, artist TEXT, PRIMARY KEY (config_id, rank))')
+
+    def finished(self):
+        return {row[0] for row in self.connection.execute('SELECT config_id FROM runs')}
+
+    def add(self, config, seconds, rows):
+        # A configuration and its recommendations are written in one transaction, so resume never sees half a result
+        with self.connection:
+            self.connection.execute('DELETE FROM recommendations WHERE config_id = ?', (config['config_id'],))
+            self.connection.executemany('INSERT INTO recommendations VALUES (?, ?, ?, ?, ?)',
+                                        [(config['config_id'],) + row for row in rows])
+            self.connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)',
+                                    (config['config_id'], config['recommender'], json.dumps(config, sort_keys=True), seconds, time.time()))
+
+    def recommendations(self):
+        # Every stored recommendation joined with the parameters of its configuration
+        query = 'SELECT runs.params, rank, track_id, track_name, artist FROM recommendations JOIN runs USING (config_id) ORDER BY config_id, rank'
+        rows = [dict(json.loads(params), rank=rank, track_id=track_id, track_name=name, artist=artist)
+                for params, rank, track_id, name, artist in self.connection.execute(query)]
+        return pd.DataFrame(rows)
+
+    def close(self):
+        self.connection.close()
+
+def run_grid(grid, store_path='experiment_results.sqlite', catalog_path='spotify_data.csv', workers=None, resume=True, catalog=None):
+    """
+    This function runs every configuration of a grid on a process pool and stores the results.
+
+    Parameters:
+        grid (dict): Experiment grid, see expand_grid.
+        store_path (str): SQLite file the results are written to.
+        catalog_path (str): Song catalog CSV, loaded through the columnar cache.
+        workers (int): Worker processes, one per core if None. 0 runs everything in this process.
+        resume (bool): Skip configurations that are already in the store.
+        catalog (pandas.DataFrame): Catalog to use instead of loading catalog_path.
+
+    Returns:
+        int: Number of configurations run.
+    """
+    store = ResultStore(store_path)
+    configs = expand_grid(grid)
+    if resume:
+        done = store.finished()
+        configs = [config for config in configs if config['config_id'] not in done]
+    groups = {}
+    for config in configs:
+        groups.setdefault(_model_key(config), []).append(config)
+    if catalog is None:
+        catalog = load_catalog(catalog_path, columns=CATALOG_COLUMNS)
+
+    try:
+        if workers == 0:
+            for key, group in groups.items():
+                for result in run_group(key, group, catalog):
+                    store.add(*result)
+            return len(configs)
+
+        shared = SharedCatalog(catalog)
+        try:
+            with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_attach_catalog,
+                                     initargs=(shared.name,)) as pool:
+                # Large groups first so the pool is not left waiting on one long group at the end
+                ordered = sorted(groups.items(), key=lambda item: -len(item[1]))
+                futures = [pool.submit(run_group, key, group) for key, group in ordered]
+                for future in as_completed(futures):
+                    for result in future.result():
+                        store.add(*result)
+        finally:
+            shared.close()
+        return len(configs)
+    finally:
+        store.close()
@@ -0,0 +1,101 @@
+import threading
+
+### In-memory stand-in for spotipy.Spotify.
+# It serves tracks, artists and playlists built from local song rows (the CSV schema written by
+# utils) and counts every call, so metadata fetching can be exercised and measured offline.
+
+class FakeSpotify:
+    def __init__(self, tracks=None, artists=None, playlists=None, page_size=100):
+        self.tracks_by_id = dict(tracks or {})
+        self.artists_by_id = dict(artists or {})
+        self.playlists = dict(playlists or {}) # playlist id -> (name, list of track ids)
+        self.page_size = page_size
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_songs(cls, songs, playlist_name='Fake Playlist', playlist_id='fakeplaylist'):
+        """
+        This function builds a fake client from song rows, one fake artist per distinct main artist.
+
+        Parameters:
+            songs (pandas.DataFrame): Songs with the columns written by utils.get_playlist_songs.
+            playlist_name (str): Name of the playlist holding all the songs.
+            playlist_id (str): Id of that playlist.
+
+        Returns:
+            FakeSpotify: The fake client.
+        """
+        tracks, artists = {}, {}
+        for song in songs.to_dict('records'):
+            names = str(song['artist_names']).split(', ')
+            artist_refs = []
+            for name in names:
+                artist_id = 'artist_' + name.replace(' ', '_')
+                artist_refs.append({'id': artist_id, 'name': name})
+                if artist_id not in artists:
+                    genre = song.get('genre') if name == names[0] else None
+                    genres = [] if not isinstance(genre, str) or genre == 'No Genre' else genre.split(', ')
+                    artists[artist_id] = {'id': artist_id, 'name': name, 'genres': genres}
+            tracks[song['track_id']] = {
+                'id': song['track_id'], 'name': song['track_name'], 'artists': artist_refs,
+                'popularity': int(song['popularity']), 'duration_ms': int(song['duration_ms']),
+                'explicit': bool(song.get('explicit', False)), 'uri': song.get('uri', 'spotify:track:' + song['track_id']),
+                'album': {'name': song.get('album', ''), 'release_date': str(song.get('release_date', '2000'))},
+            }
+        return cls(tracks, artists, {playlist_id: (playlist_name, list(tracks))})
+
+    def _count(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def track(self, track_id):
+        self._count('track')
+        return self.tracks_by_id[track_id]
+
+    def tracks(self, track_ids):
+        self._count('tracks')
+        if len(track_ids) > 50:
+            raise ValueError('Spotify accepts at most 50 ids per request.')
+        return {'tracks': [self.tracks_by_id.get(track_id) for track_id in track_ids]}
+
+    def artist(self, artist_id):
+        self._count('artist')
+        return self.artists_by_id[artist_id]
+
+    def artists(self, artist_ids):
+        self._count('artists')
+        if len(artist_ids) > 50:
+            raise ValueError('Spotify accepts at most 50 ids per request.')
+        return {'artists': [self.artists_by_id.get(artist_id) for artist_id in artist_ids]}
+
+    def search(self, q, type='artist'):
+        self._count('search')
+        name = q.split('artist:')[-1]
+        return {'artists': {'items': [artist for artist in self.artists_by_id.values() if artist['name'] == name]}}
+
+    def _page(self, items, offset):
+        page = items[offset:offset + self.page_size]
+        has_next = offset + self.page_size < len(items)
+        return {'items': page, 'next': (items, offset + self.page_size) if has_next else None}
+
+    def next(self, results):
+        self._count('next')
+        items, offset = results['next']
+        return self._page(items, offset)
+
+    def playlist(self, playlist_id):
+        self._count('playlist')
+        return {'id': playlist_id, 'name': self.playlists[playlist_id][0]}
+
+    def playlist_tracks(self, playlist_id):
+        self._count('playlist_tracks')
+        return self._page([{'track': self.tracks_by_id[track_id]} for track_id in self.playlists[playlist_id][1]], 0)
+
+    def current_user_saved_tracks(self):
+        self._count('current_user_saved_tracks')
+        return self._page([{'track': track} for track in self.tracks_by_id.values()], 0)
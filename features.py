@@ -0,0 +1,225 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from artifacts import load_array, load_values, read_meta, save_array, save_values, write_meta
+from genres import GenreVocabulary
+
+### Shared feature pipeline for the KNN and logistic regression recommenders.
+# Songs are featurized into a scipy.sparse CSR matrix (float32): the scaled numerical columns
+# come first, followed by one one-hot block per categorical column. Nothing is densified, so the
+# matrix can be fed straight to NearestNeighbors, LogisticRegression and cosine_similarity.
+# Multi-label columns (comma-separated genre lists, see genres.py) get one column per single
+# genre instead of one per combination, with a 1 for every genre of a song.
+
+def _category_codes(column, vocabulary):
+    # Position of every value of `column` in `vocabulary`, -1 for unknown values
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # Look up the (few) categories instead of every row, then map the row codes through them
+        lookup = np.append(vocabulary.get_indexer(column.cat.categories), -1)
+        return lookup[np.asarray(column.cat.codes)]
+    return vocabulary.get_indexer(column)
+
+def _scaler():
+    # scikit-learn is imported on first use, so importing the recommenders stays cheap (see cli.py)
+    from sklearn.preprocessing import StandardScaler
+    return StandardScaler()
+
+class FeaturePipeline:
+    def __init__(self, categorical_cols, numerical_cols, dtype=np.float32, multi_label_cols=()):
+        self.categorical_cols = list(categorical_cols)
+        self.numerical_cols = list(numerical_cols)
+        self.multi_label_cols = list(multi_label_cols) # categorical columns holding comma-separated lists
+        self.dtype = dtype
+        self.scaler = _scaler()
+        self.vocabularies = {} # categorical column -> pandas Index of the values seen in fit
+        self.offsets = {} # categorical column -> first feature column of its one-hot block
+        self.extensions = [] # (column, first code, end code) of the values added by extend, their columns come last
+        self.num_features = 0
+
+    def fit(self, df):
+        # Numerical features take the first columns, one-hot blocks follow in categorical_cols order
+        self.scaler.fit(df[self.numerical_cols])
+        offset = len(self.numerical_cols)
+        for col in self.categorical_cols:
+            values = df[col].dropna()
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.cat.remove_unused_categories()
+            if col in self.multi_label_cols:
+                self.vocabularies[col] = GenreVocabulary().fit(values).genres
+            else:
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    values = values.cat.categories
+                self.vocabularies[col] = pd.Index(pd.unique(np.asarray(values, dtype=object)))
+            self.offsets[col] = offset
+            offset += len(self.vocabularies[col])
+        self.extensions = []
+        self.num_features = offset
+        return self
+
+    def fit_chunks(self, chunks):
+        """
+        This function fits the pipeline on data too big for memory, one chunk at a time: the scaler statistics are
+        streamed and only the distinct categorical values are kept.
+
+        Parameters:
+            chunks (iterable): DataFrames with the pipeline's columns, e.g. from CatalogStore.iter_chunks.
+
+        Returns:
+            FeaturePipeline: The fitted pipeline, the same as fit on all chunks concatenated.
+        """
+        self.scaler = _scaler()
+        seen = {col: {} for col in self.categorical_cols} # insertion ordered sets of the values seen so far
+        for chunk in chunks:
+            self.scaler.partial_fit(chunk[self.numerical_cols])
+            for col in self.categorical_cols:
+                values = chunk[col].dropna()
+                if col in self.multi_label_cols:
+                    values = GenreVocabulary().fit(values).genres
+                elif isinstance(values.dtype, pd.CategoricalDtype):
+                    values = values.cat.remove_unused_categories().cat.categories
+                seen[col].update(dict.fromkeys(pd.unique(np.asarray(values, dtype=object))))
+        offset = len(self.numerical_cols)
+        for col in self.categorical_cols:
+            self.vocabularies[col] = pd.Index(list(seen[col]), dtype=object)
+            self.offsets[col] = offset
+            offset += len(self.vocabularies[col])
+        self.extensions = []
+        self.num_features = offset
+        return self
+
+    def extend(self, df):
+        """
+        This function adds the categorical values of df that the pipeline has not seen yet. Their one-hot columns
+        go after all existing feature columns, so rows transformed before keep their features (with zeros in
+        the new columns) and never have to be encoded again.
+
+        Parameters:
+            df (pandas.DataFrame): Songs with the categorical columns of the pipeline.
+
+        Returns:
+            int: The new number of features.
+        """
+        for col in self.categorical_cols:
+            if col in self.multi_label_cols:
+                new = GenreVocabulary(self.vocabularies[col]).new_genres(df[col])
+            else:
+                values = pd.unique(np.asarray(df[col].dropna(), dtype=object))
+                new = values[self.vocabularies[col].get_indexer(values) < 0]
+            if len(new):
+                start = len(self.vocabularies[col])
+                self.vocabularies[col] = self.vocabularies[col].append(pd.Index(new, dtype=object))
+                self.extensions.append((col, start, len(self.vocabularies[col])))
+                self.num_features += len(new)
+        return self.num_features
+
+    def partial_fit(self, df):
+        # Add songs to the scaler statistics (streaming mean and variance), the vocabularies are left alone (see extend)
+        self.scaler.partial_fit(df[self.numerical_cols])
+        return self
+
+    def forget(self, df):
+        # Remove songs from the scaler statistics, the reverse of partial_fit
+        values = np.asarray(df[self.numerical_cols], dtype=np.float64)
+        total = self.scaler.n_samples_seen_
+        count = total - len(values)
+        if count <= 0:
+            raise ValueError("Cannot forget every song the scaler has seen.")
+        removed_mean = values.mean(axis=0)
+        mean = (self.scaler.mean_ * total - removed_mean * len(values)) / count
+        # Chan et al.: M2 of a union is M2_a + M2_b + delta^2 * n_a * n_b / n, solved for M2_a
+        m2 = self.scaler.var_ * total - values.var(axis=0) * len(values) - (removed_mean - mean) ** 2 * count * len(values) / total
+        self.scaler.mean_ = mean
+        self.scaler.var_ = np.maximum(m2 / count, 0)
+        self.scaler.scale_ = np.where(self.scaler.var_ > 0, np.sqrt(self.scaler.var_), 1.0)
+        self.scaler.n_samples_seen_ = count
+        return self
+
+    def transform(self, df):
+        """
+        This function featurizes songs into a sparse matrix. Categorical values (and single genres of multi-label
+        columns) not seen in fit are ignored.
+
+        Parameters:
+            df (pandas.DataFrame): Songs with the categorical and numerical columns of the pipeline.
+
+        Returns:
+            scipy.sparse.csr_matrix: Feature matrix of shape (len(df), num_features).
+        """
+        blocks = [sp.csr_matrix(self.scaler.transform(df[self.numerical_cols]).astype(self.dtype))]
+        encoded = {col: GenreVocabulary(self.vocabularies[col]).multi_hot(df[col], self.dtype) if col in self.multi_label_cols
+                   else _category_codes(df[col], self.vocabularies[col]) for col in self.categorical_cols}
+        ends = {col: start for col, start, _ in reversed(self.extensions)} # end of every column's fitted block
+        for col in self.categorical_cols:
+            blocks.append(self._one_hot(encoded[col], 0, ends.get(col, len(self.vocabularies[col]))))
+        for col, start, end in self.extensions:
+            blocks.append(self._one_hot(encoded[col], start, end))
+        return sp.hstack(blocks, format='csr', dtype=self.dtype)
+
+    def _one_hot(self, codes, start, end):
+        # One-hot block of the vocabulary positions start to end (multi-label columns come already encoded)
+        if sp.issparse(codes):
+            return codes[:, start:end]
+        known = (codes >= start) & (codes < end)
+        return sp.csr_matrix((np.ones(known.sum(), dtype=self.dtype), (np.flatnonzero(known), codes[known] - start)),
+                             shape=(len(codes), end - start))
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def save(self, path):
+        # Vocabularies in dictionary layout plus the scaler statistics, see artifacts.py
+        os.makedirs(path, exist_ok=True)
+        vocabularies = [save_values(path, f'vocabulary{i}', self.vocabularies[col]) for i, col in enumerate(self.categorical_cols)]
+        for name in ('mean_', 'var_', 'scale_', 'n_samples_seen_'):
+            save_array(path, 'scaler.' + name.strip('_'), getattr(self.scaler, name))
+        write_meta(path, 'features', categorical_cols=self.categorical_cols, numerical_cols=self.numerical_cols,
+                   dtype=np.dtype(self.dtype).name, multi_label_cols=self.multi_label_cols, offsets=self.offsets, extensions=self.extensions,
+                   num_features=self.num_features, vocabularies=vocabularies)
+
+    @classmethod
+    def load(cls, path):
+        """
+        This function loads a fitted pipeline written by save.
+
+        Parameters:
+            path (str): Directory the pipeline was saved to.
+
+        Returns:
+            FeaturePipeline: The fitted pipeline, transform gives the same features as before saving.
+        """
+        meta = read_meta(path, 'features')
+        pipeline = cls(meta['categorical_cols'], meta['numerical_cols'], dtype=np.dtype(meta['dtype']),
+                       multi_label_cols=meta.get('multi_label_cols', []))
+        for i, (col, info) in enumerate(zip(pipeline.categorical_cols, meta['vocabularies'])):
+            pipeline.vocabularies[col] = load_values(path, f'vocabulary{i}', info)
+        pipeline.offsets = meta['offsets']
+        pipeline.extensions = [tuple(extension) for extension in meta['extensions']]
+        pipeline.num_features = meta['num_features']
+        # Restore the fitted StandardScaler attributes (fit always sees a DataFrame, so it has feature names)
+        for name in ('mean_', 'var_', 'scale_', 'n_samples_seen_'):
+            value = load_array(path, 'scaler.' + name.strip('_'), mmap=False)
+            setattr(pipeline.scaler, name, value[()] if value.ndim == 0 else value)
+        pipeline.scaler.n_features_in_ = len(pipeline.numerical_cols)
+        pipeline.scaler.feature_names_in_ = np.array(pipeline.numerical_cols, dtype=object)
+        return pipeline
+
+def memory_footprint(features):
+    """
+    This helper function reports how much memory a feature matrix takes, next to what it would take dense.
+
+    Parameters:
+        features (scipy.sparse.spmatrix or numpy.ndarray): Feature matrix.
+
+    Returns:
+        dict: Shape, number of stored values, bytes used and bytes a dense float32 copy would need.
+    """
+    if sp.issparse(features):
+        features = features.tocsr()
+        used = features.data.nbytes + features.indices.nbytes + features.indptr.nbytes
+        nnz = features.nnz
+    else:
+        used = features.nbytes
+        nnz = features.size
+    rows, cols = features.shape
+    return {'rows': rows, 'cols': cols, 'nnz': nnz, 'bytes': used, 'dense_bytes': rows * cols * np.dtype(np.float32).itemsize}
@@ -0,0 +1,283 @@
+import os
+import numpy as np
+import pandas as pd
+from artifacts import load_array, read_meta, save_array, write_meta
+from genres import GenreVocabulary, jaccard
+from records import make_records
+
+# Upper bound on the number of random keys drawn at once by sample_many (bounds its memory)
+SAMPLE_BLOCK_SIZE = 1 << 22
+# sample_many draws indices with rejection when a genre has at least this many times num_recs songs,
+# smaller genres get a random key per song instead
+REJECTION_RATIO = 4
+
+def _codes(column):
+    # Integer codes and distinct values of a (possibly categorical) column
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return np.asarray(column.cat.codes, dtype=np.int64), pd.Index(column.cat.categories)
+    codes, uniques = pd.factorize(column)
+    return codes.astype(np.int64), pd.Index(uniques)
+
+class GenreIndex:
+    def __init__(self, data, genre_col='genre', track_col='track_id', popularity_col='popularity'):
+        # Map every genre to its rows sorted by descending popularity: rows of genre g are
+        # self.order[self.offsets[g]:self.offsets[g + 1]]
+        self.columns = {'genre_col': genre_col, 'track_col': track_col, 'popularity_col': popularity_col}
+        self.genre_codes, self.genres = _codes(data[genre_col])
+        popularity = np.asarray(data[popularity_col], dtype=np.float64)
+        self.order = np.lexsort((-popularity, self.genre_codes)) # genre first, then popularity
+        sorted_genres = self.genre_codes[self.order]
+        self.offsets = np.searchsorted(sorted_genres, np.arange(len(self.genres) + 1))
+        if len(sorted_genres) and sorted_genres[0] < 0: # rows without a genre sort first, skip them
+            self.order = self.order[np.searchsorted(sorted_genres, 0):]
+            self.offsets = self.offsets - self.offsets[0]
+
+        # Map every track_id to its first row (the catalog can list a track more than once)
+        self.track_codes, self.track_ids = _codes(data[track_col])
+        rows = np.arange(len(self.track_codes))
+        self.track_rows = np.full(len(self.track_ids), -1, dtype=np.int64)
+        self.track_rows[self.track_codes[::-1]] = rows[::-1]
+        self.track_counts = np.bincount(self.track_codes[self.track_codes >= 0], minlength=len(self.track_ids))
+        self._encode_genres()
+
+    def _encode_genres(self):
+        # Bitset of the single genres of every distinct genre string (see genres.py), for partial matching
+        self.vocabulary = GenreVocabulary().fit(self.genres)
+        self.genre_bits = self.vocabulary.encode(self.genres)
+
+    def __len__(self):
+        return len(self.track_codes)
+
+    def save(self, path):
+        # Only the sorted arrays are stored, the codes come straight from the catalog's columns on load
+        os.makedirs(path, exist_ok=True)
+        for name in ('order', 'offsets', 'track_rows', 'track_counts'):
+            save_array(path, name, getattr(self, name))
+        write_meta(path, 'genre_index', **self.columns)
+
+    @classmethod
+    def load(cls, path, data, mmap=True):
+        """
+        This function loads an index written by save for the catalog it was built from.
+
+        Parameters:
+            path (str): Directory the index was saved to.
+            data (pandas.DataFrame): The catalog.
+            mmap (bool): Memory-map the arrays instead of reading them into memory.
+
+        Returns:
+            GenreIndex: The loaded index.
+        """
+        meta = read_meta(path, 'genre_index')
+        index = cls.__new__(cls)
+        index.columns = {name: meta[name] for name in ('genre_col', 'track_col', 'popularity_col')}
+        index.genre_codes, index.genres = _codes(data[meta['genre_col']])
+        index.track_codes, index.track_ids = _codes(data[meta['track_col']])
+        for name in ('order', 'offsets', 'track_rows', 'track_counts'):
+            setattr(index, name, load_array(path, name, mmap))
+        index._encode_genres()
+        return index
+
+    def lookup(self, track_ids):
+        # Rows of the given track ids, -1 for tracks that are not in the catalog
+        codes = self.track_ids.get_indexer(pd.Index(track_ids, dtype=object))
+        return np.where(codes >= 0, self.track_rows[codes], -1)
+
+    def genre_code(self, genre):
+        # Code of a genre name, -1 if no song in the catalog has it
+        return self.genres.get_indexer([genre])[0]
+
+    def matching_genres(self, genres):
+        """
+        This function ranks the catalog's genres by how well they match a list of genres.
+
+        Parameters:
+            genres (list or str): Single genres, or a comma-separated genre string.
+
+        Returns:
+            tuple: Codes of the genres sharing at least one single genre with the query, best Jaccard similarity first,
+            and their similarities.
+        """
+        scores = jaccard(self.genre_bits, self.vocabulary.query(genres))
+        codes = np.flatnonzero(scores > 0)
+        codes = codes[np.argsort(-scores[codes], kind='stable')]
+        return codes, scores[codes]
+
+    def row_bits(self):
+        # Genre bitset of every catalog row (no bits for rows without a genre)
+        return np.vstack([self.genre_bits, np.zeros((1, self.vocabulary.num_words), dtype=np.uint64)])[self.genre_codes]
+
+    def genre_rows(self, genre_code):
+        if genre_code < 0:
+            return self.order[:0]
+        return self.order[self.offsets[genre_code]:self.offsets[genre_code + 1]]
+
+    def _duplicates(self, exclude_row):
+        return self.track_counts[self.track_codes[exclude_row]] if exclude_row >= 0 else 0
+
+    def top(self, genre_code, num_recs, exclude_row=-1):
+        """
+        This function returns the most popular rows of a genre, leaving out every copy of the track at `exclude_row`.
+
+        Parameters:
+            genre_code (int): Code of the genre (see genre_code).
+            num_recs (int): Number of rows to return.
+            exclude_row (int): Row of the seed track, -1 to exclude nothing.
+
+        Returns:
+            numpy.ndarray: Up to num_recs rows, most popular first.
+        """
+        candidates = self.genre_rows(genre_code)[:num_recs + self._duplicates(exclude_row)]
+        if exclude_row >= 0:
+            candidates = candidates[self.track_codes[candidates] != self.track_codes[exclude_row]]
+        return candidates[:num_recs]
+
+    def top_matching(self, genres, num_recs, exclude_row=-1):
+        """
+        This function returns the most popular rows of the genres matching a list of genres: the best matching genre
+        first, then partial matches.
+
+        Parameters:
+            genres (list or str): Single genres, or a comma-separated genre string.
+            num_recs (int): Number of rows to return.
+            exclude_row (int): Row of the seed track, -1 to exclude nothing.
+
+        Returns:
+            numpy.ndarray: Up to num_recs rows.
+        """
+        candidates, needed = [], num_recs + self._duplicates(exclude_row)
+        for genre_code in self.matching_genres(genres)[0]:
+            candidates.append(self.genre_rows(genre_code)[:needed])
+            needed -= len(candidates[-1])
+            if needed <= 0:
+                break
+        candidates = np.concatenate(candidates) if candidates else self.order[:0]
+        if exclude_row >= 0:
+            candidates = candidates[self.track_codes[candidates] != self.track_codes[exclude_row]]
+        return candidates[:num_recs]
+
+    def sample_matching(self, genres, num_recs, rng, exclude_row=-1):
+        # Uniform sample without replacement of the rows of every genre sharing a single genre with the query
+        codes, _ = self.matching_genres(genres)
+        candidates = np.concatenate([self.genre_rows(genre_code) for genre_code in codes]) if len(codes) else self.order[:0]
+        if exclude_row >= 0:
+            candidates = candidates[self.track_codes[candidates] != self.track_codes[exclude_row]]
+        return rng.choice(candidates, size=min(num_recs, len(candidates)), replace=False)
+
+    def sample(self, genre_code, num_recs, rng, exclude_row=-1):
+        # Uniform sample without replacement of the rows of a genre (excluding the seed track)
+        candidates = self.genre_rows(genre_code)
+        if exclude_row >= 0:
+            candidates = candidates[self.track_codes[candidates] != self.track_codes[exclude_row]]
+        return rng.choice(candidates, size=min(num_recs, len(candidates)), replace=False)
+
+    def top_many(self, rows, num_recs):
+        """
+        This function answers many popularity queries at once, seeds sharing a genre are served from one slice.
+
+        Parameters:
+            rows (numpy.ndarray): Catalog rows of the seed tracks (-1 entries are skipped).
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            tuple: Arrays (seed, rank, row) where seed indexes into `rows` and rank starts at 1.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        results = []
+        for genre_code, seeds in self._seeds_by_genre(rows):
+            seed_codes = self.track_codes[rows[seeds]]
+            candidates = self.genre_rows(genre_code)[:num_recs + self.track_counts[seed_codes].max()]
+            keep = self.track_codes[candidates][None, :] != seed_codes[:, None]
+            keep &= np.cumsum(keep, axis=1) <= num_recs
+            results.append(self._flatten(seeds, candidates, keep))
+        return self._concat(results)
+
+    def sample_many(self, rows, num_recs, rng):
+        """
+        This function draws random same-genre recommendations for many seeds with one vectorized draw per genre.
+
+        Parameters:
+            rows (numpy.ndarray): Catalog rows of the seed tracks (-1 entries are skipped).
+            num_recs (int): Number of recommendations per seed.
+            rng (numpy.random.Generator): Source of randomness, seed it for reproducible output.
+
+        Returns:
+            tuple: Arrays (seed, rank, row) where seed indexes into `rows` and rank starts at 1.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        results = []
+        for genre_code, seeds in self._seeds_by_genre(rows):
+            candidates = self.genre_rows(genre_code)
+            candidate_codes = self.track_codes[candidates]
+            k = min(num_recs, len(candidates))
+            # Seeds with REJECTION_RATIO * k songs of their genre besides their own track draw with rejection
+            fast = len(candidates) - self.track_counts[self.track_codes[rows[seeds]]] >= REJECTION_RATIO * k
+            results.append(self._sample_rejection(rows, seeds[fast], candidates, k, rng))
+            seeds = seeds[~fast]
+            block = max(1, SAMPLE_BLOCK_SIZE // max(len(candidates), 1))
+            for start in range(0, len(seeds), block):
+                chunk = seeds[start:start + block]
+                # Random keys per (seed, candidate), the k smallest keys are a uniform sample without replacement
+                keys = rng.random((len(chunk), len(candidates)), dtype=np.float32)
+                keys[candidate_codes[None, :] == self.track_codes[rows[chunk]][:, None]] = 2.0 # never pick the seed
+                if k < len(candidates):
+                    picked = np.argpartition(keys, k - 1, axis=1)[:, :k]
+                else:
+                    picked = np.argsort(keys, axis=1)[:, :k] # every candidate, still in a random order
+                keep = np.take_along_axis(keys, picked, axis=1) < 2.0
+                results.append(self._flatten(chunk, candidates, keep, picked))
+        return self._concat(results)
+
+    def _sample_rejection(self, rows, seeds, candidates, k, rng):
+        # k candidates per seed from a few more than k uniform draws: the first k draws that are neither repeated nor
+        # the seed are a uniform sample without replacement, in a random order. Seeds left short (rare, their genre
+        # has REJECTION_RATIO * k other songs) draw again
+        candidate_codes = self.track_codes[candidates]
+        size = k + k // 2 + 8
+        block = max(1, SAMPLE_BLOCK_SIZE // size)
+        results = []
+        for start in range(0, len(seeds), block):
+            pending = seeds[start:start + block]
+            while len(pending):
+                draws = rng.integers(0, len(candidates), size=(len(pending), size))
+                order = np.argsort(draws, axis=1, kind='stable')
+                repeated = np.zeros(draws.shape, dtype=bool)
+                ordered = np.take_along_axis(draws, order, axis=1)
+                np.put_along_axis(repeated, order[:, 1:], ordered[:, 1:] == ordered[:, :-1], axis=1) # later copies
+                valid = ~repeated & (candidate_codes[draws] != self.track_codes[rows[pending]][:, None])
+                done = valid.sum(axis=1) >= k
+                keep = valid[done] & (np.cumsum(valid[done], axis=1) <= k)
+                results.append(self._flatten(pending[done], candidates, keep, draws[done]))
+                pending = pending[~done]
+        return self._concat(results)
+
+    def _seeds_by_genre(self, rows):
+        valid = np.flatnonzero(rows >= 0)
+        genres = self.genre_codes[rows[valid]]
+        order = np.argsort(genres, kind='stable')
+        valid, genres = valid[order], genres[order]
+        bounds = np.flatnonzero(np.diff(genres)) + 1
+        for seeds in np.split(valid, bounds):
+            if len(seeds) and self.genre_codes[rows[seeds[0]]] >= 0:
+                yield self.genre_codes[rows[seeds[0]]], seeds
+
+    @staticmethod
+    def _flatten(seeds, candidates, keep, picked=None):
+        seed_pos, cand_pos = np.nonzero(keep)
+        if picked is not None:
+            cand_pos = picked[seed_pos, cand_pos]
+        ranks = np.cumsum(keep, axis=1)[keep]
+        return seeds[seed_pos], ranks, candidates[cand_pos]
+
+    @staticmethod
+    def _concat(results):
+        if not results:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        seeds, ranks, rows = (np.concatenate(parts) for parts in zip(*results))
+        order = np.lexsort((ranks, seeds))
+        return seeds[order], ranks[order], rows[order]
+
+    def to_records(self, seeds, ranks, rows):
+        # Pack (seed, rank, row) arrays into a structured array with the recommended track ids
+        return make_records(seeds, ranks, rows, np.asarray(self.track_ids, dtype=object)[self.track_codes[rows]])
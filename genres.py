@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+### Multi-label genres.
+# The genre field of playlists and liked songs lists several genres ("alternative metal, alternative rock"),
+# the catalog has one per song. GenreVocabulary splits these strings into single genres and encodes
+# every song's genres as a bitset: a row of uint64 words, bit g set when the song has genre g. Overlap
+# and Jaccard against a query are then bitwise and/or plus a popcount over the whole catalog.
+
+GENRE_SEPARATOR = ','
+NO_GENRE = 'No Genre' # what utils.process_artist writes for artists without genres
+WORD_BITS = 64
+
+# Number of set bits of every 16-bit value, popcount of a uint64 word is four lookups (numpy < 2.0)
+_POPCOUNT16 = np.unpackbits(np.arange(1 << 16, dtype=np.uint16).view(np.uint8)).reshape(-1, 16).sum(axis=1, dtype=np.uint8)
+
+def split_genres(value):
+    # The single genres of a genre string, [] for missing values and 'No Genre'
+    if not isinstance(value, str) or value == NO_GENRE:
+        return []
+    return [genre.strip() for genre in value.split(GENRE_SEPARATOR) if genre.strip()]
+
+def popcount(bits):
+    # Number of set bits in every row of a (..., words) uint64 array
+    bits = np.ascontiguousarray(bits, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'): # numpy 2.0, the CPU's popcount instruction
+        return np.bitwise_count(bits).sum(axis=-1, dtype=np.int32)
+    return _POPCOUNT16[bits.view(np.uint16)].sum(axis=-1, dtype=np.int32)
+
+def _codes(values):
+    # Integer codes and distinct values of a genre column (categorical columns are not decoded row by row)
+    if isinstance(values, pd.Series) and isinstance(values.dtype, pd.CategoricalDtype):
+        return np.asarray(values.cat.codes, dtype=np.int64), list(values.cat.categories)
+    codes, uniques = pd.factorize(pd.Series(np.asarray(values, dtype=object)))
+    return codes.astype(np.int64), list(uniques)
+
+class GenreVocabulary:
+    def __init__(self, genres=()):
+        self.genres = pd.Index(list(genres), dtype=object) # genre -> bit position
+
+    def __len__(self):
+        return len(self.genres)
+
+    @property
+    def num_words(self):
+        return max(1, -(-len(self.genres) // WORD_BITS))
+
+    def fit(self, values):
+        # Collect the single genres of a genre column, in order of first appearance
+        _, uniques = _codes(values)
+        self.genres = pd.Index(pd.unique(np.array([genre for value in uniques for genre in split_genres(value)] or [], dtype=object)))
+        return self
+
+    def new_genres(self, values):
+        # The single genres of values that are not in the vocabulary yet
+        _, uniques = _codes(values)
+        genres = pd.unique(np.array([genre for value in uniques for genre in split_genres(value)] or [], dtype=object))
+        return genres[self.genres.get_indexer(genres) < 0]
+
+    def positions(self, values):
+        """
+        This function maps genre strings to the positions of their genres, one row per distinct string.
+
+        Parameters:
+            values (pandas.Series or list): Genre strings, categorical columns are looked up per category.
+
+        Returns:
+            tuple: Code of every value (-1 for missing ones) and a CSR matrix of shape (distinct strings, genres)
+            with a 1 for every known genre of a string. Unknown genres are left out.
+        """
+        codes, uniques = _codes(values)
+        genres = [split_genres(value) for value in uniques]
+        rows = np.repeat(np.arange(len(uniques)), [len(row) for row in genres])
+        columns = self.genres.get_indexer(pd.Index([genre for row in genres for genre in row], dtype=object)) # one lookup for all
+        known = columns >= 0
+        matrix = sp.csr_matrix((np.ones(known.sum(), dtype=np.float32), (rows[known], columns[known])), shape=(len(uniques), len(self.genres)))
+        matrix.sum_duplicates()
+        matrix.data[:] = 1 # a genre listed twice counts once
+        return codes, matrix
+
+    def multi_hot(self, values, dtype=np.float32):
+        # Sparse (rows, genres) matrix with a 1 for every genre of every row, the multi-label one-hot encoding
+        codes, matrix = self.positions(values)
+        matrix = sp.vstack([matrix, sp.csr_matrix((1, len(self.genres)))], format='csr', dtype=dtype) # last row: no genre
+        return matrix[np.where(codes >= 0, codes, -1)]
+
+    def encode(self, values):
+        """
+        This function encodes genre strings as bitsets.
+
+        Parameters:
+            values (pandas.Series or list): Genre strings.
+
+        Returns:
+            numpy.ndarray: uint64 array of shape (len(values), num_words), bit g of a row set when it has genre g.
+        """
+        codes, matrix = self.positions(values)
+        bits = np.zeros((matrix.shape[0] + 1, self.num_words), dtype=np.uint64) # last row: no genre
+        coo = matrix.tocoo()
+        np.bitwise_or.at(bits, (coo.row, coo.col // WORD_BITS), np.left_shift(np.uint64(1), (coo.col % WORD_BITS).astype(np.uint64)))
+        return bits[np.where(codes >= 0, codes, -1)]
+
+    def query(self, genres):
+        # Bitset of a list of single genres (or one genre string), unknown genres are ignored
+        if isinstance(genres, str):
+            genres = split_genres(genres)
+        return self.encode([GENRE_SEPARATOR.join(genres)])[0]
+
+def overlap(bits, query):
+    # Number of genres every row shares with the query bitset
+    return popcount(bits & query)
+
+def jaccard(bits, query):
+    # Shared genres / genres of either, for every row against the query bitset (0 when both are empty)
+    union = popcount(bits | query)
+    return np.where(union > 0, overlap(bits, query) / np.maximum(union, 1), 0.0)
@@ -0,0 +1,278 @@
+import functools
+import json
+import math
+import os
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+
+### Per-stage timing and memory instrumentation.
+# Code marks its stages with `with stage('collab.kneighbors', items=len(seeds)):` or the @instrumented
+# decorator. Every run of a stage records its wall time, the CPU time of the calling thread, the
+# number of items it handled and, when memory tracing is on, the peak bytes allocated on top of what
+# was allocated when the stage started. Runs are aggregated in-process into fixed-bucket histograms
+# (a few counters per stage, nothing kept per run) and exported as Prometheus text or JSON.
+#
+# RECSYS_INSTRUMENT=0 turns it all off: stage() hands back a shared no-op context manager and
+# decorators return the function untouched. RECSYS_INSTRUMENT=memory also traces allocations with
+# tracemalloc, which slows down allocation-heavy code, so it is meant for profiling runs.
+
+ENV_VAR = 'RECSYS_INSTRUMENT'
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+BYTES_BUCKETS = tuple(float(1 << shift) for shift in range(10, 36, 2)) + (math.inf,) # 1KiB to 16GiB, times 4
+
+_mode = os.environ.get(ENV_VAR, '1').strip().lower()
+ENABLED = _mode not in ('0', 'off', 'false', 'no')
+_local = threading.local() # stack of the memory peaks of the enclosing stages, per thread
+_tracing = False # whether tracemalloc was started here (and so may be stopped here)
+
+def _quantile(buckets, counts, q):
+    # Prometheus histogram_quantile: linear interpolation inside the bucket holding the q-th value
+    total = sum(counts)
+    if total == 0:
+        return None
+    target = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if seen + count >= target and count:
+            lower = buckets[i - 1] if i else 0.0
+            upper = buckets[i] if math.isfinite(buckets[i]) else lower
+            return lower + (upper - lower) * (target - seen) / count
+        seen += count
+    return buckets[-2]
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.items = 0
+        self.max_wall = 0.0
+        self.max_peak = 0
+        self.peak_sum = 0
+        self.wall_counts = [0] * len(SECONDS_BUCKETS)
+        self.peak_counts = [0] * len(BYTES_BUCKETS)
+
+    def add(self, wall, cpu, items, peak, failed):
+        self.count += 1
+        self.errors += failed
+        self.wall += wall
+        self.cpu += cpu
+        self.items += items or 0
+        self.max_wall = max(self.max_wall, wall)
+        self.wall_counts[bisect_left(SECONDS_BUCKETS, wall)] += 1
+        if peak is not None:
+            self.max_peak = max(self.max_peak, peak)
+            self.peak_sum += peak
+            self.peak_counts[bisect_left(BYTES_BUCKETS, peak)] += 1
+
+    def snapshot(self):
+        traced = sum(self.peak_counts)
+        return {
+            'count': self.count, 'errors': self.errors, 'items': self.items,
+            'wall_seconds': self.wall, 'cpu_seconds': self.cpu, 'max_wall_seconds': self.max_wall,
+            # Estimated from the buckets, never above the largest value seen
+            'p50_ms': min(_quantile(SECONDS_BUCKETS, self.wall_counts, 0.5), self.max_wall) * 1000 if self.count else None,
+            'p99_ms': min(_quantile(SECONDS_BUCKETS, self.wall_counts, 0.99), self.max_wall) * 1000 if self.count else None,
+            'items_per_second': self.items / self.wall if self.wall > 0 else None,
+            'max_peak_bytes': self.max_peak if traced else None,
+            'p99_peak_bytes': min(_quantile(BYTES_BUCKETS, self.peak_counts, 0.99), self.max_peak) if traced else None,
+        }
+
+class StageRegistry:
+    def __init__(self):
+        self.stages = {} # stage name -> StageStats
+        self.lock = threading.Lock()
+
+    def record(self, name, wall, cpu, items=None, peak=None, failed=False):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(wall, cpu, items, peak, failed)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def snapshot(self):
+        # Per stage: run and item counts, summed wall and CPU seconds, estimated p50/p99 and the memory peaks
+        with self.lock:
+            return {name: stats.snapshot() for name, stats in sorted(self.stages.items())}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix='recsys_stage'):
+        """
+        This function renders the histograms in the Prometheus text exposition format.
+
+        Parameters:
+            prefix (str): Prefix of every metric name.
+
+        Returns:
+            str: Metrics text, one histogram of wall seconds (and of peak bytes when traced) per stage plus counters
+            of CPU seconds, items and errors.
+        """
+        with self.lock:
+            stages = sorted((name, stats, list(stats.wall_counts), list(stats.peak_counts)) for name, stats in self.stages.items())
+        lines = []
+        def histogram(metric, help_text, buckets, pick):
+            lines.extend([f'# HELP {prefix}_{metric} {help_text}', f'# TYPE {prefix}_{metric} histogram'])
+            for name, stats, wall_counts, peak_counts in stages:
+                counts, total = pick(stats, wall_counts, peak_counts)
+                if not sum(counts):
+                    continue
+                label = _label(name)
+                cumulative = 0
+                for bound, count in zip(buckets, counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_{metric}_bucket{{stage="{label}",le="{_bound(bound)}"}} {cumulative}')
+                lines.append(f'{prefix}_{metric}_sum{{stage="{label}"}} {total}')
+                lines.append(f'{prefix}_{metric}_count{{stage="{label}"}} {cumulative}')
+        def counter(metric, help_text, value):
+            lines.extend([f'# HELP {prefix}_{metric} {help_text}', f'# TYPE {prefix}_{metric} counter'])
+            lines.extend(f'{prefix}_{metric}{{stage="{_label(name)}"}} {value(stats)}' for name, stats, _, _ in stages)
+
+        histogram('seconds', 'Wall time of a stage.', SECONDS_BUCKETS, lambda stats, wall, peak: (wall, stats.wall))
+        histogram('peak_bytes', 'Peak bytes allocated during a stage (memory tracing only).', BYTES_BUCKETS,
+                  lambda stats, wall, peak: (peak, stats.peak_sum))
+        counter('cpu_seconds_total', 'CPU time of the thread running a stage.', lambda stats: stats.cpu)
+        counter('items_total', 'Items (rows, seeds, tracks) handled by a stage.', lambda stats: stats.items)
+        counter('errors_total', 'Runs of a stage that raised.', lambda stats: stats.errors)
+        return '\n'.join(lines) + '\n'
+
+def _label(name):
+    return name.replace('\\', '\\\\').replace('"', '\\"')
+
+def _bound(bound):
+    return '+Inf' if math.isinf(bound) else repr(bound)
+
+REGISTRY = StageRegistry()
+
+class _Stage:
+    __slots__ = ('name', 'items', 'registry', 'started', 'cpu_started', 'memory_started')
+
+    def __init__(self, name, items, registry):
+        self.name = name
+        self.items = items # can also be set inside the block: `with stage('x') as run: ...; run.items = n`
+        self.registry = registry
+
+    def __enter__(self):
+        self.memory_started = None
+        if tracemalloc.is_tracing():
+            # tracemalloc has a single peak: save the enclosing stage's peak so far, restart it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            stack = getattr(_local, 'peaks', None)
+            if stack is None:
+                stack = _local.peaks = []
+            stack.append(peak)
+            tracemalloc.reset_peak()
+            self.memory_started = current
+        self.cpu_started = time.thread_time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall = time.perf_counter() - self.started
+        cpu = time.thread_time() - self.cpu_started
+        peak = None
+        if self.memory_started is not None and tracemalloc.is_tracing():
+            _, traced_peak = tracemalloc.get_traced_memory()
+            peak = max(traced_peak - self.memory_started, 0)
+            stack = _local.peaks
+            outer_peak = max(stack.pop(), traced_peak)
+            if stack: # the enclosing stage's peak includes this one
+                stack[-1] = max(stack[-1], outer_peak)
+        self.registry.record(self.name, wall, cpu, self.items, peak, exc_type is not None)
+        return False
+
+class _NoStage:
+    # What stage() returns when instrumentation is off: does nothing, takes any attribute
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+_NO_STAGE = _NoStage()
+
+def stage(name, items=None, registry=None):
+    """
+    This function times one run of a named stage, as a context manager.
+
+    Parameters:
+        name (str): Stage name, '<component>.<step>' by convention (e.g. 'collab.kneighbors').
+        items (int): Number of items the stage handles, can also be set on the returned object inside the block.
+        registry (StageRegistry): Where the run is recorded, the module's REGISTRY if None.
+
+    Returns:
+        Context manager recording wall time, CPU time, items and (when tracing memory) peak bytes on exit.
+    """
+    if not ENABLED:
+        return _NO_STAGE
+    return _Stage(name, items, registry or REGISTRY)
+
+def instrumented(name, items=None):
+    """
+    This function decorates a function so that every call is recorded as a run of a stage.
+
+    Parameters:
+        name (str): Stage name.
+        items (callable): Computes the item count from the call's return value, e.g. len.
+
+    Returns:
+        callable: The decorator. With instrumentation off at import time it returns the function itself.
+    """
+    def decorate(function):
+        if not ENABLED:
+            return function
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _Stage(name, None, REGISTRY) as run:
+                result = function(*args, **kwargs)
+                if items is not None and result is not None:
+                    run.items = items(result)
+                return result
+        return wrapper
+    return decorate
+
+def enable(memory=False):
+    # Turn recording on at runtime (functions decorated while it was off stay undecorated), optionally with memory tracing
+    global ENABLED, _tracing
+    ENABLED = True
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _tracing = True
+
+def disable():
+    # Turn recording (and memory tracing) off, stage() becomes a no-op
+    global ENABLED, _tracing
+    ENABLED = False
+    if _tracing:
+        tracemalloc.stop()
+        _tracing = False
+
+def snapshot():
+    return REGISTRY.snapshot()
+
+def to_json(**kwargs):
+    return REGISTRY.to_json(**kwargs)
+
+def to_prometheus(prefix='recsys_stage'):
+    return REGISTRY.to_prometheus(prefix)
+
+def reset():
+    REGISTRY.reset()
+
+if ENABLED and _mode == 'memory':
+    enable(memory=True)
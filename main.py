@@ -1,7 +1,5 @@
-import spotipy
-import sys
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
-from config import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT
+### Spotipy demo: top songs of two artists and the user's most played songs. Needs config.py and network
+# access, so spotipy and the credentials are only imported when the script runs, never on import.
 lz_uri = 'spotify:artist:36QJpDe2go2KgaRleHCDTp'
 
 #results = spotify.artist_top_tracks(lz_uri)
@@ -34,11 +32,19 @@ def print_most_played_songs(username, spotify_client):
     for i, track in enumerate(top_tracks['items']):
         print(f"{i+1}. {track['name']} - {', '.join([artist['name'] for artist in track['artists']])}")
 
-spotify_client = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET))
-print_top_songs('Rage Against The Machine', spotify_client)
-print("")
-print_top_songs('Michael Jackson', spotify_client)
+def main():
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+    from config import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT
 
-scope = 'user-top-read'
-spotify_client = spotipy.Spotify(auth_manager=SpotifyOAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET,SPOTIFY_REDIRECT,scope=scope))
-print_most_played_songs('ahhhhhhhhhhhhhhhhhhhhhlejandro', spotify_client)
\ No newline at end of file
+    spotify_client = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET))
+    print_top_songs('Rage Against The Machine', spotify_client)
+    print("")
+    print_top_songs('Michael Jackson', spotify_client)
+
+    scope = 'user-top-read'
+    spotify_client = spotipy.Spotify(auth_manager=SpotifyOAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET,SPOTIFY_REDIRECT,scope=scope))
+    print_most_played_songs('ahhhhhhhhhhhhhhhhhhhhhlejandro', spotify_client)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+### Streaming ingestion of the Million Playlist Dataset (MPD) into an interaction store.
+# The MPD is 1000 JSON slice files (mpd.slice.0-999.json, ...) of 1000 playlists each. Worker
+# processes parse one slice at a time and intern its strings locally; the parent maps them to
+# global int32 ids and appends the slice as one chunk, so memory depends on the size of a slice
+# and of the vocabularies, never on the whole dataset. Layout of a store directory:
+#   - chunks/<n>.<column>.npy: playlist_id, track_id and position (int32) of every playlist entry
+#   - <vocabulary>.dict: '\x00' separated utf-8 dictionaries (track_uri, artist_name), append only
+#   - chunks/<n>.track_artist.npy: artist id of every track the slice introduced
+#   - manifest.json: the slices ingested so far, written last so an interrupted run resumes cleanly
+# The MPD has no genres, the catalog (catalog.py) has them per track.
+
+FORMAT_VERSION = 1
+DICT_SEPARATOR = '\x00'
+COLUMNS = ('playlist_id', 'track_id', 'position')
+VOCABULARIES = ('track_uri', 'artist_name')
+TRACK_URI_PREFIX = 'spotify:track:'
+
+def slice_paths(directory):
+    # The MPD slice files of a directory in dataset order (mpd.slice.0-999.json, mpd.slice.1000-1999.json, ...)
+    paths = glob.glob(os.path.join(directory, 'mpd.slice.*.json'))
+    return sorted(paths, key=lambda path: [int(part) for part in re.findall(r'\d+', os.path.basename(path))])
+
+def parse_slice(path):
+    """
+    This function reads one MPD slice file into arrays, with its strings interned into slice-local ids.
+
+    Parameters:
+        path (str): The slice file.
+
+    Returns:
+        dict: playlist_id, track_id (local), position (int32 arrays), track_uri and artist_name (the local
+        vocabularies) and track_artist (local artist id of every local track).
+    """
+    with open(path, encoding='utf-8') as f:
+        playlists = json.load(f)['playlists']
+    tracks, artists = {}, {}
+    track_artist = []
+    playlist_ids, track_ids, positions = [], [], []
+    for playlist in playlists:
+        for track in playlist['tracks']:
+            track_id = tracks.get(track['track_uri'])
+            if track_id is None:
+                track_id = tracks[track['track_uri']] = len(tracks)
+                track_artist.append(artists.setdefault(track['artist_name'], len(artists)))
+            playlist_ids.append(playlist['pid'])
+            track_ids.append(track_id)
+            positions.append(track['pos'])
+    return {
+        'playlist_id': np.array(playlist_ids, dtype=np.int32),
+        'track_id': np.array(track_ids, dtype=np.int32),
+        'position': np.array(positions, dtype=np.int32),
+        'track_uri': list(tracks),
+        'artist_name': list(artists),
+        'track_artist': np.array(track_artist, dtype=np.int32),
+    }
+
+def _read_dictionary(path, size):
+    # The first size entries of a dictionary file, entries past them were written by an interrupted run
+    if not size:
+        return []
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8').split(DICT_SEPARATOR)[:size]
+
+class InteractionStore:
+    def __init__(self, path):
+        # An existing store, or an empty one that ingest will write to
+        self.path = path
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get('format') != FORMAT_VERSION:
+                raise ValueError(f"Store {path} has format {self.manifest.get('format')}, expected {FORMAT_VERSION}.")
+        else:
+            self.manifest = {'format': FORMAT_VERSION, 'slices': [], 'num_rows': 0,
+                             'sizes': {name: 0 for name in VOCABULARIES}, 'bytes': {name: 0 for name in VOCABULARIES}}
+        self.vocabularies = {name: _read_dictionary(os.path.join(path, f'{name}.dict'), self.manifest['sizes'][name])
+                             for name in VOCABULARIES}
+        self._track_artist = None
+
+    @property
+    def num_rows(self):
+        return self.manifest['num_rows']
+
+    @property
+    def num_chunks(self):
+        return len(self.manifest['slices'])
+
+    def track_uris(self):
+        return pd.Index(self.vocabularies['track_uri'], dtype=object)
+
+    def track_ids(self):
+        # Track ids as used in the catalog (the URI without 'spotify:track:')
+        return pd.Index([uri[len(TRACK_URI_PREFIX):] if uri.startswith(TRACK_URI_PREFIX) else uri
+                         for uri in self.vocabularies['track_uri']], dtype=object)
+
+    def artist_names(self):
+        return pd.Index(self.vocabularies['artist_name'], dtype=object)
+
+    def track_artist(self):
+        # Artist id of every track id, every chunk holds the artists of the tracks it introduced
+        if self._track_artist is None:
+            chunks = [chunk['track_artist'] for chunk in self.iter_chunks(('track_artist',))]
+            self._track_artist = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+        return self._track_artist
+
+    def _chunk_path(self, chunk, column):
+        return os.path.join(self.path, 'chunks', f'{chunk:05d}.{column}.npy')
+
+    def iter_chunks(self, columns=COLUMNS, mmap=True):
+        # One dict of (memory-mapped) arrays per ingested slice, in ingestion order
+        for chunk in range(self.num_chunks):
+            yield {column: np.load(self._chunk_path(chunk, column), mmap_mode='r' if mmap else None) for column in columns}
+
+    def interactions(self, columns=COLUMNS):
+        # All interactions as one DataFrame of int32 columns
+        chunks = list(self.iter_chunks(columns))
+        return pd.DataFrame({column: np.concatenate([chunk[column] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int32)
+                             for column in columns})
+
+    def playlist_matrix(self):
+        """
+        This function builds the playlist x track matrix of the store, one chunk at a time.
+
+        Returns:
+            tuple: scipy.sparse.csr_matrix of shape (playlists, tracks) with a 1 for every track of a playlist, the
+            playlist id of every row and the track id (see track_ids) of every column, ready for ItemItemRecSys.fit_matrix.
+        """
+        blocks, playlist_ids = [], []
+        num_tracks = len(self.vocabularies['track_uri'])
+        for chunk in self.iter_chunks(('playlist_id', 'track_id')):
+            ids, rows = np.unique(chunk['playlist_id'], return_inverse=True)
+            block = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, chunk['track_id'])), shape=(len(ids), num_tracks))
+            block.sum_duplicates()
+            block.data[:] = 1
+            blocks.append(block)
+            playlist_ids.append(ids)
+        matrix = sp.vstack(blocks, format='csr') if blocks else sp.csr_matrix((0, num_tracks), dtype=np.float32)
+        return matrix, np.concatenate(playlist_ids) if playlist_ids else np.zeros(0, dtype=np.int32), self.track_ids()
+
+    def append(self, name, parsed, lookups):
+        """
+        This function appends one parsed slice to the store and records it in the manifest.
+
+        Parameters:
+            name (str): File name of the slice, what resuming skips.
+            parsed (dict): The slice, see parse_slice.
+            lookups (dict): Vocabulary name -> dict of string -> global id, extended with the slice's new strings.
+
+        Returns:
+            int: Number of rows appended.
+        """
+        # Global ids of the slice's strings, new strings get the next ids in order of appearance
+        remap, new = {}, {}
+        for vocabulary in VOCABULARIES:
+            lookup = lookups[vocabulary]
+            start = len(lookup)
+            remap[vocabulary] = np.array([lookup.setdefault(value, len(lookup)) for value in parsed[vocabulary]], dtype=np.int32)
+            new[vocabulary] = [value for value, i in zip(parsed[vocabulary], remap[vocabulary]) if i >= start]
+
+        # The chunk: its interactions plus the artists of the tracks it introduced (track ids are handed out in order)
+        chunk = self.num_chunks
+        os.makedirs(os.path.join(self.path, 'chunks'), exist_ok=True)
+        np.save(self._chunk_path(chunk, 'playlist_id'), parsed['playlist_id'])
+        np.save(self._chunk_path(chunk, 'track_id'), remap['track_uri'][parsed['track_id']])
+        np.save(self._chunk_path(chunk, 'position'), parsed['position'])
+        is_new = remap['track_uri'] >= self.manifest['sizes']['track_uri']
+        track_artist = np.empty(is_new.sum(), dtype=np.int32)
+        track_artist[remap['track_uri'][is_new] - self.manifest['sizes']['track_uri']] = remap['artist_name'][parsed['track_artist'][is_new]]
+        np.save(self._chunk_path(chunk, 'track_artist'), track_artist)
+
+        # Append the new strings past the committed end of every dictionary (dropping what an interrupted run left)
+        for vocabulary, values in new.items():
+            if not values:
+                continue
+            path = os.path.join(self.path, f'{vocabulary}.dict')
+            data = ((DICT_SEPARATOR if self.manifest['sizes'][vocabulary] else '') + DICT_SEPARATOR.join(values)).encode('utf-8')
+            committed = self.manifest['bytes'][vocabulary]
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                f.truncate(committed)
+                f.seek(committed)
+                f.write(data)
+            self.manifest['bytes'][vocabulary] = committed + len(data)
+            self.vocabularies[vocabulary].extend(values)
+
+        # Commit: the slice counts as ingested once the new manifest is in place
+        rows = len(parsed['playlist_id'])
+        self.manifest['slices'].append({'name': name, 'rows': rows})
+        self.manifest['num_rows'] += rows
+        self.manifest['sizes'] = {vocabulary: len(lookups[vocabulary]) for vocabulary in VOCABULARIES}
+        with open(os.path.join(self.path, 'manifest.tmp.json'), 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(os.path.join(self.path, 'manifest.tmp.json'), os.path.join(self.path, 'manifest.json'))
+        self._track_artist = None
+        return rows
+
+def ingest(slices, store_path, workers=None, resume=True, verbose=True):
+    """
+    This function streams MPD slice files into an interaction store, parsing them on a process pool.
+
+    Parameters:
+        slices (list): Slice files (see slice_paths), ingested in this order.
+        store_path (str): Store directory, created if needed.
+        workers (int): Worker processes (default: one per core, 0 parses in this process).
+        resume (bool): Skip the slices an earlier (possibly interrupted) run already ingested. Otherwise the store is started over.
+        verbose (bool): Print progress and rows/sec after every slice.
+
+    Returns:
+        InteractionStore: The store.
+    """
+    if not resume and os.path.exists(os.path.join(store_path, 'manifest.json')):
+        os.remove(os.path.join(store_path, 'manifest.json'))
+    os.makedirs(store_path, exist_ok=True)
+    store = InteractionStore(store_path)
+    done = {entry['name'] for entry in store.manifest['slices']}
+    todo = [path for path in slices if os.path.basename(path) not in done]
+    lookups = {vocabulary: {value: i for i, value in enumerate(store.vocabularies[vocabulary])} for vocabulary in VOCABULARIES}
+    if verbose and done:
+        print(f'Resuming: {len(done)} slices ({store.num_rows} rows) already ingested, {len(todo)} to go.')
+
+    start = time.perf_counter()
+    num_rows = 0
+
+    def report(path, rows):
+        nonlocal num_rows
+        num_rows += rows
+        if verbose:
+            elapsed = time.perf_counter() - start
+            print(f'{os.path.basename(path)}: {rows} rows, {num_rows} total, {num_rows / max(elapsed, 1e-9):,.0f} rows/sec')
+
+    if workers == 0:
+        for path in todo:
+            report(path, store.append(os.path.basename(path), parse_slice(path), lookups))
+    else:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # At most two slices per worker in flight, so parsed slices never pile up in the parent
+            pending = deque()
+            paths = iter(todo)
+            for path in paths:
+                pending.append((path, pool.submit(parse_slice, path)))
+                if len(pending) >= 2 * workers:
+                    path, future = pending.popleft()
+                    report(path, store.append(os.path.basename(path), future.result(), lookups))
+            while pending:
+                path, future = pending.popleft()
+                report(path, store.append(os.path.basename(path), future.result(), lookups))
+    if verbose and todo:
+        print(f'Ingested {num_rows} rows from {len(todo)} slices in {time.perf_counter() - start:.1f}s.')
+    return store
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest Million Playlist Dataset slices into an interaction store.')
+    parser.add_argument('data_dir', help='directory with the mpd.slice.*.json files')
+    parser.add_argument('store', help='store directory')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core, 0 parses in this process)')
+    parser.add_argument('--no-resume', action='store_true', help='start the store over instead of skipping ingested slices')
+    args = parser.parse_args(argv)
+    ingest(slice_paths(args.data_dir), args.store, workers=args.workers, resume=not args.no_resume)
+
+if __name__ == '__main__':
+    main()
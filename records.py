@@ -0,0 +1,23 @@
+import numpy as np
+
+def make_records(seeds, ranks, rows, track_ids):
+    """
+    This helper function packs batch recommendations into the structured array returned by every recommend_many.
+
+    Parameters:
+        seeds (numpy.ndarray): Position of the seed each recommendation belongs to.
+        ranks (numpy.ndarray): Rank of the recommendation for its seed, starting at 1.
+        rows (numpy.ndarray): Row of the recommended song in the recommender's song data.
+        track_ids (numpy.ndarray): Track id of the recommended song.
+
+    Returns:
+        numpy.ndarray: Structured array with fields seed, rank, row and track_id.
+    """
+    track_ids = np.asarray(track_ids, dtype=object)
+    width = max((len(str(track_id)) for track_id in track_ids), default=1)
+    records = np.zeros(len(rows), dtype=[('seed', np.int32), ('rank', np.int32), ('row', np.int64), ('track_id', f'U{width}')])
+    records['seed'] = seeds
+    records['rank'] = ranks
+    records['row'] = rows
+    records['track_id'] = track_ids
+    return records
@@ -0,0 +1,311 @@
+import asyncio
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+from records import make_records
+
+### Cache of recommendation results.
+# Keys are (engine, seed, num_recs, model version): the seed is a track id or the hash of a playlist
+# (seed_key), the version is the model_version every recommender gets on fit and update. A retrained
+# or updated model has a new version, so its old results are never served; the cache also drops them
+# as soon as it sees the new version. Results live in a bounded in-memory LRU with a TTL and,
+# optionally, in a SQLite file that survives restarts (a disk hit moves back into memory).
+# Concurrent requests for the same key are coalesced: the first one computes, the others wait for
+# its result, from threads (get_or_compute) or from asyncio tasks (get_or_compute_async).
+# The SQLite file has a lock of its own: reads, pickling and commits never hold the lock of the
+# in-memory tier, so memory hits do not wait for the disk.
+
+MISSING = object()
+
+def seed_key(seed):
+    # A track id stays as it is, a playlist (list of track ids or DataFrame with track_id) becomes a hash of its tracks
+    if isinstance(seed, str):
+        return seed
+    if hasattr(seed, 'columns'): # playlist DataFrame
+        seed = seed['track_id']
+    elif hasattr(seed, 'get') and isinstance(seed.get('track_id'), str): # one song (a row), a playlist of one
+        seed = [seed['track_id']]
+    digest = hashlib.sha1('\x00'.join(map(str, seed)).encode('utf-8')).hexdigest()
+    return 'playlist:' + digest
+
+def model_version(function):
+    # model_version of the recommender a bound method (e.g. model.recommend_many) belongs to
+    return getattr(getattr(function, '__self__', None), 'model_version', None)
+
+class ResultCache:
+    def __init__(self, max_entries=10000, ttl=300.0, path=None):
+        """
+        Parameters:
+            max_entries (int): Results kept in memory, the least recently used ones are evicted first.
+            ttl (float): Seconds a result stays valid, in memory and on disk. None keeps results until evicted.
+            path (str): SQLite file of the on-disk tier, None for a memory-only cache.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expiry time, result), least recently used first
+        self.inflight = {} # key -> Future of the computation running for it
+        self.versions = {} # engine -> last model version seen
+        self.lock = threading.Lock() # the LRU, the in-flight computations, the versions and the counters
+        self.disk_lock = threading.Lock() # the SQLite connection
+        self.counters = dict.fromkeys(('hits', 'disk_hits', 'misses', 'coalesced', 'evictions', 'expirations', 'invalidations'), 0)
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            with self.disk_lock, self.connection:
+                self.connection.execute('PRAGMA journal_mode=WAL')
+                self.connection.execute('PRAGMA synchronous=NORMAL') # a lost write is only a lost cache entry
+                self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, engine TEXT, result BLOB, expires_at REAL)')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _expiry(self):
+        return time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+
+    def get(self, key, default=MISSING):
+        # Cached result of key (memory first, then disk), default when there is none or it expired
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return entry[1]
+                del self.entries[key]
+                self.counters['expirations'] += 1
+        if self.connection is None:
+            return default
+        with self.disk_lock:
+            row = self.connection.execute('SELECT result, expires_at FROM results WHERE key = ?', (json.dumps(key),)).fetchone()
+        if row is None or row[1] <= time.time():
+            return default
+        result = pickle.loads(row[0])
+        with self.lock:
+            self.counters['disk_hits'] += 1
+            self._store(key, result, time.monotonic() + (row[1] - time.time()))
+        return result
+
+    def _store(self, key, result, expires_at):
+        # Put a result into the LRU (lock held), evicting the least recently used ones beyond max_entries
+        self.entries[key] = (expires_at, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def put(self, key, result):
+        with self.lock:
+            self._store(key, result, self._expiry())
+        self._write(key, result)
+
+    def _write(self, key, result):
+        # Put a result into the SQLite file, pickled before taking the disk lock
+        if self.connection is None:
+            return
+        expires_at = time.time() + self.ttl if self.ttl is not None else float('inf')
+        blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.disk_lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (json.dumps(key), str(key[0]), blob, expires_at))
+
+    def _claim(self, key):
+        # The future of the computation of key and whether the caller has to run it (the others wait for it)
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.counters['coalesced'] += 1
+                return future, False
+            future = self.inflight[key] = Future()
+            self.counters['misses'] += 1
+            return future, True
+
+    def _settle(self, key, future, result=MISSING, error=None):
+        # Store the leader's result and hand it (or its error) to the waiting requests, they do not wait for the disk
+        with self.lock:
+            if error is None:
+                self._store(key, result, self._expiry())
+            self.inflight.pop(key, None)
+        if error is None:
+            future.set_result(result)
+            self._write(key, result)
+        else:
+            future.set_exception(error)
+
+    def get_or_compute(self, key, compute):
+        """
+        This function returns the cached result of key, or computes it once however many threads ask at the same time.
+
+        Parameters:
+            key (tuple): (engine, seed_key(seed), num_recs, model version), JSON-serializable for the disk tier.
+            compute (callable): Computes the result, called without arguments.
+
+        Returns:
+            The result. Errors of compute are raised to every request that waited for it and are not cached.
+        """
+        result = self.get(key)
+        if result is not MISSING:
+            return result
+        future, leader = self._claim(key)
+        if not leader:
+            return future.result()
+        try:
+            result = compute()
+        except BaseException as error:
+            self._settle(key, future, error=error)
+            raise
+        self._settle(key, future, result)
+        return result
+
+    async def get_or_compute_async(self, key, compute):
+        # get_or_compute for asyncio: compute is a coroutine function, waiting requests do not block the event loop
+        result = self.get(key)
+        if result is not MISSING:
+            return result
+        future, leader = self._claim(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await compute()
+        except BaseException as error:
+            self._settle(key, future, error=error)
+            raise
+        self._settle(key, future, result)
+        return result
+
+    def check_version(self, engine, version):
+        # Drop the results of engine's previous model version the first time a new one is seen
+        with self.lock:
+            previous = self.versions.get(engine, version)
+            self.versions[engine] = version
+        if previous != version:
+            self.invalidate(engine)
+
+    def invalidate(self, engine=None):
+        # Drop the results of one engine (or all of them) from memory and disk, returns how many were in memory
+        with self.lock:
+            keys = [key for key in self.entries if engine is None or key[0] == engine]
+            for key in keys:
+                del self.entries[key]
+            self.counters['invalidations'] += len(keys)
+        if self.connection is not None:
+            with self.disk_lock, self.connection:
+                if engine is None:
+                    self.connection.execute('DELETE FROM results')
+                else:
+                    self.connection.execute('DELETE FROM results WHERE engine = ?', (str(engine),))
+        return len(keys)
+
+    def evict_expired(self):
+        # Delete the expired results from memory and disk, returns how many were removed from memory
+        with self.lock:
+            now = time.monotonic()
+            keys = [key for key, (expires_at, _) in self.entries.items() if expires_at <= now]
+            for key in keys:
+                del self.entries[key]
+            self.counters['expirations'] += len(keys)
+        if self.connection is not None:
+            with self.disk_lock, self.connection:
+                self.connection.execute('DELETE FROM results WHERE expires_at <= ?', (time.time(),))
+        return len(keys)
+
+    def stats(self):
+        # Hit, miss, coalescing and eviction counters plus the hit rate and the number of results in memory
+        with self.lock:
+            stats = dict(self.counters, entries=len(self.entries), inflight=len(self.inflight))
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits'] + stats['coalesced']) / lookups if lookups else None
+        return stats
+
+    def wrap(self, engine, function, version=None):
+        """
+        This function puts the cache in front of a single-seed recommend function, e.g. PopularRec.recommend or
+        CollaborativeFilteringRecSys.recommend.
+
+        Parameters:
+            engine (str): Engine name, the first part of every key.
+            function (callable): Takes a seed (track id or playlist) and further arguments such as num_recs.
+            version (callable): Returns the current model version, model_version(function) if None.
+
+        Returns:
+            callable: Same arguments as function, answered from the cache when possible.
+        """
+        version = version or (lambda: model_version(function))
+        def cached(seed, *args):
+            current = version()
+            self.check_version(engine, current)
+            return self.get_or_compute((engine, seed_key(seed), tuple(args), current), lambda: function(seed, *args))
+        return cached
+
+    def close(self):
+        if self.connection is not None:
+            with self.disk_lock:
+                self.connection.close()
+
+class CachedEngine:
+    def __init__(self, engine, recommend_many, cache, version=None):
+        """
+        Parameters:
+            engine (str): Engine name, the first part of every key.
+            recommend_many (callable): recommend_many of a recommender, returns records (see records.make_records).
+            cache (ResultCache): Where the results of every seed are kept.
+            version (callable): Returns the current model version, model_version(recommend_many) if None.
+        """
+        self.engine = engine
+        self.recommend_many_uncached = recommend_many
+        self.cache = cache
+        self.version = version or (lambda: model_version(recommend_many))
+
+    def __call__(self, track_ids, num_recs=30):
+        return self.recommend_many(track_ids, num_recs)
+
+    def recommend_many(self, track_ids, num_recs=30):
+        """
+        This function answers recommend_many seed by seed from the cache and computes the missing seeds in one call.
+
+        Parameters:
+            track_ids (list): Seed track ids.
+            num_recs (int): Number of recommendations per seed.
+
+        Returns:
+            numpy.ndarray: The records recommend_many would return.
+        """
+        track_ids = list(track_ids)
+        version = self.version()
+        self.cache.check_version(self.engine, version)
+        keys = {track_id: (self.engine, track_id, num_recs, version) for track_id in dict.fromkeys(track_ids)}
+        results, claimed, waiting = {}, {}, {}
+        for track_id, key in keys.items():
+            result = self.cache.get(key)
+            if result is not MISSING:
+                results[track_id] = result
+                continue
+            future, leader = self.cache._claim(key)
+            (claimed if leader else waiting)[track_id] = future
+
+        if claimed:
+            # One call for every seed this request has to compute, split into one result per seed
+            try:
+                records = self.recommend_many_uncached(list(claimed), num_recs)
+            except BaseException as error:
+                for track_id, future in claimed.items():
+                    self.cache._settle(keys[track_id], future, error=error)
+                raise
+            records = records[np.argsort(records['seed'], kind='stable')]
+            bounds = np.searchsorted(records['seed'], np.arange(len(claimed) + 1))
+            for position, (track_id, future) in enumerate(claimed.items()):
+                results[track_id] = records[bounds[position]:bounds[position + 1]].copy() # not a view of the whole batch
+                self.cache._settle(keys[track_id], future, results[track_id])
+        for track_id, future in waiting.items():
+            results[track_id] = future.result()
+
+        parts = [results[track_id] for track_id in track_ids]
+        seeds = np.repeat(np.arange(len(track_ids)), [len(part) for part in parts])
+        if not len(seeds):
+            return make_records([], [], [], [])
+        return make_records(seeds, np.concatenate([part['rank'] for part in parts]), np.concatenate([part['row'] for part in parts]),
+                            np.concatenate([part['track_id'].astype(object) for part in parts]))
@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import pandas as pd
+import instrumentation
+from catalog import catalog_version, load_catalog
+from result_cache import CachedEngine, ResultCache, model_version
+
+### Local HTTP server for the recommender systems.
+# The catalog and the fitted recommenders are loaded once. Requests to /recommend/<engine> are
+# queued per engine and collected into micro-batches: the first request of a batch waits at most
+# max_wait seconds for others to join, then the whole batch runs as one recommend_many call on the
+# engine's own worker thread. Every engine accepts at most max_pending queued requests and the
+# server at most max_connections connections, beyond that requests get a 503 instead of piling up.
+# Only the standard library is used (asyncio streams and a minimal HTTP/1.1 parser).
+#
+#   python server.py --port 8000 --models models
+#   curl 'localhost:8000/recommend/popular?track_id=6EtAJUmBqj57hkiBxDy27I&num_recs=10'
+
+ENGINES = ('popular', 'random', 'collab', 'itemitem', 'content', 'audio')
+CACHED_ENGINES = ('popular', 'collab', 'itemitem', 'content', 'audio') # random recommendations are meant to change from call to call
+# The audio features are embeddings.EMBEDDING_COLS, only read by the audio engine (memory-mapped, untouched otherwise)
+CATALOG_COLUMNS = ['artist_name', 'track_name', 'track_id', 'popularity', 'year', 'genre', 'duration_ms', 'danceability',
+                   'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness', 'liveness',
+                   'valence', 'tempo', 'time_signature']
+PLAYLISTS = sorted(glob.glob('Playlists/*.csv')) # the item-item model's default playlists
+MAX_NUM_RECS = 100
+MAX_HEADER_BYTES = 16384
+LATENCY_SAMPLES = 10000 # latencies kept per engine for the percentiles
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class Overloaded(Exception):
+    pass
+
+class EngineMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.max_batch = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def snapshot(self, pending):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'requests': self.requests, 'rejected': self.rejected, 'errors': self.errors, 'pending': pending,
+            'batches': self.batches, 'max_batch': self.max_batch,
+            'mean_batch': self.batched_requests / self.batches if self.batches else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+class MicroBatcher:
+    def __init__(self, run_batch, max_batch_size=256, max_wait=0.002, max_pending=4096):
+        """
+        Parameters:
+            run_batch (callable): Takes a list of requests and returns one result per request. Runs on a worker thread.
+            max_batch_size (int): Most requests in one batch.
+            max_wait (float): Seconds the first request of a batch waits for others to join.
+            max_pending (int): Most requests queued or running, submit raises Overloaded beyond that.
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.pending = 0
+        self.metrics = EngineMetrics()
+        self.queue = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1) # one batch at a time, the recommenders are not thread-safe
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, request):
+        # Queue one request and wait for its result
+        self.metrics.requests += 1
+        if self.pending >= self.max_pending:
+            self.metrics.rejected += 1
+            raise Overloaded()
+        self.pending += 1
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((request, future))
+            result = await future
+            self.metrics.latencies.append(time.perf_counter() - start)
+            return result
+        finally:
+            self.pending -= 1
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.max_wait > 0 and self.queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_wait) # give concurrent requests the window to join
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            batch = [(request, future) for request, future in batch if not future.done()] # skip cancelled requests
+            if not batch:
+                continue
+            self.metrics.batches += 1
+            self.metrics.batched_requests += len(batch)
+            self.metrics.max_batch = max(self.metrics.max_batch, len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [request for request, _ in batch])
+            except Exception as error:
+                self.metrics.errors += len(batch)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+def batch_runner(recommend_many, catalog):
+    """
+    This function wraps a recommend_many method into a micro-batch function over (track_id, num_recs) requests.
+
+    Parameters:
+        recommend_many (callable): recommend_many (or get_recommendations_many) of a fitted recommender.
+        catalog (pandas.DataFrame): The catalog, the recommenders' rows index into it.
+
+    Returns:
+        callable: Takes a list of (track_id, num_recs) and returns, per request, its recommendations (empty for unknown tracks).
+    """
+    track_names = catalog['track_name']
+    artist_names = catalog['artist_name']
+
+    def run(requests):
+        # One call for the whole batch, with the largest num_recs asked for, then every request keeps its own share
+        limits = np.array([num_recs for _, num_recs in requests])
+        records = recommend_many([track_id for track_id, _ in requests], int(limits.max()))
+        records = records[records['rank'] <= limits[records['seed']]]
+        names = np.asarray(track_names.iloc[records['row']], dtype=object)
+        artists = np.asarray(artist_names.iloc[records['row']], dtype=object)
+        results = [[] for _ in requests]
+        for record, name, artist in zip(records, names, artists):
+            results[record['seed']].append({'rank': int(record['rank']), 'track_id': str(record['track_id']),
+                                            'track_name': name, 'artist_name': artist})
+        return results
+    return run
+
+def load_engines(catalog, names=ENGINES, models_dir=None, playlist=None, liked_songs=None, save=False, seed=None, playlists=None,
+                 cache=None):
+    """
+    This function loads the fitted recommenders from models_dir, or fits them when there is no saved model.
+
+    Parameters:
+        catalog (pandas.DataFrame): The catalog.
+        names (list): Engines to load.
+        models_dir (str): Directory with one saved model per engine (models_dir/<engine>), see the save methods.
+        playlist (str): Playlist CSV the collaborative filtering recommender is fitted on.
+        liked_songs (str): Liked songs CSV the content-based recommender is fitted on.
+        save (bool): Save the models that had to be fitted to models_dir.
+        seed (int): Seed of the random recommender.
+        playlists (list): Playlist CSVs the item-item recommender is fitted on.
+        cache (result_cache.ResultCache): Puts the CACHED_ENGINES behind the cache (result_cache.CachedEngine), keyed by
+        model and catalog version like the server's. The server caches per request and leaves this None.
+
+    Returns:
+        dict: Engine name -> recommend_many function.
+    """
+    engines = {}
+    for name in names:
+        path = os.path.join(models_dir, name) if models_dir else None
+        saved = path is not None and os.path.exists(os.path.join(path, 'meta.json'))
+        if name == 'popular':
+            from PopularRecSys import PopularRec
+            model = PopularRec.load(path, catalog) if saved else PopularRec(catalog)
+            engines[name] = model.recommend_many
+        elif name == 'random':
+            from RandomRecSys import RandomRec
+            model = RandomRec.load(path, catalog, seed=seed) if saved else RandomRec(catalog, seed=seed)
+            engines[name] = model.recommend_many
+        elif name == 'collab':
+            from CollaborativeFilteringRecSys import CollaborativeFilteringRecSys
+            if saved:
+                model = CollaborativeFilteringRecSys.load(path, catalog)
+            else:
+                model = CollaborativeFilteringRecSys(pd.read_csv(playlist), catalog)
+                model.preprocess_data()
+                model.train_model()
+            engines[name] = model.recommend_many
+        elif name == 'itemitem':
+            from ItemItemRecSys import ItemItemRecSys, read_playlists
+            if saved:
+                model = ItemItemRecSys.load(path)
+            elif not playlists:
+                raise ValueError('The itemitem engine is fitted on playlists, none were given.')
+            else:
+                model = ItemItemRecSys().fit(read_playlists(playlists))
+            engines[name] = model.use_catalog(catalog).recommend_many
+        elif name == 'content':
+            from ContentRecSys import ContentBasedRecSys
+            if saved:
+                model = ContentBasedRecSys.load(path, catalog)
+            else:
+                model = ContentBasedRecSys(catalog, pd.read_csv(liked_songs), random_state=seed)
+                model.preprocess_data()
+                model.train_model()
+            engines[name] = model.get_recommendations_many
+        elif name == 'audio':
+            from embeddings import SongEmbeddings
+            model = SongEmbeddings.load(path, catalog) if saved else SongEmbeddings(catalog).fit()
+            engines[name] = model.recommend_many
+        else:
+            raise ValueError(f"Unknown engine {name}, expected one of {ENGINES}.")
+        if save and path is not None and not saved:
+            model.save(path)
+        if cache is not None and name in CACHED_ENGINES:
+            engines[name] = CachedEngine(name, engines[name], cache,
+                                         version=lambda function=engines[name]: (model_version(function), catalog_version(catalog)))
+    return engines
+
+class RecommendationServer:
+    def __init__(self, engines, catalog, host='127.0.0.1', port=8000, max_batch_size=256, max_wait=0.002,
+                 max_pending=4096, max_connections=1024, cache=None, cached_engines=CACHED_ENGINES):
+        """
+        Parameters:
+            engines (dict): Engine name -> recommend_many function, see load_engines.
+            catalog (pandas.DataFrame): The catalog the engines recommend from.
+            host (str): Address to listen on.
+            port (int): Port to listen on, 0 for any free port.
+            max_batch_size (int): Most requests per batch.
+            max_wait (float): Seconds a batch stays open for more requests.
+            max_pending (int): Most queued requests per engine before answering 503.
+            max_connections (int): Most open connections before answering 503.
+            cache (result_cache.ResultCache): Results of earlier requests, keyed by engine, track, num_recs and the
+            model and catalog versions. None to compute every request.
+            cached_engines (list): Engines whose results go through the cache.
+        """
+        self.catalog = catalog
+        track_ids = catalog['track_id']
+        # Tells an unknown seed (404) from a known one the engine has no recommendations for (200, empty list)
+        self.track_ids = track_ids.cat.categories if isinstance(track_ids.dtype, pd.CategoricalDtype) else pd.Index(track_ids)
+        self.engines = engines
+        self.cache = cache
+        self.cached_engines = set(cached_engines) & set(engines) if cache is not None else set()
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.connections = 0
+        self.writers = set()
+        self.started = None
+        self.server = None
+        self.batchers = {name: MicroBatcher(batch_runner(recommend_many, catalog), max_batch_size, max_wait, max_pending)
+                         for name, recommend_many in engines.items()}
+
+    async def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_HEADER_BYTES)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started = time.time()
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.writers): # idle keep-alive connections would otherwise outlive the server
+            writer.close()
+        await self.server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"Serving {', '.join(self.batchers)} on http://{self.host}:{self.port}")
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def _handle(self, reader, writer):
+        # One connection, HTTP/1.1 keep-alive until the client closes it or asks to
+        self.connections += 1
+        self.writers.add(writer)
+        try:
+            if self.connections > self.max_connections:
+                await self._respond(writer, 503, {'error': 'too many connections'}, keep_alive=False)
+                return
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                parts = lines[0].split(' ')
+                headers = dict((key.strip().lower(), value.strip()) for key, _, value in
+                               (line.partition(':') for line in lines[1:] if line))
+                try:
+                    content_length = int(headers.get('content-length', 0))
+                except ValueError:
+                    content_length = -1
+                if content_length < 0:
+                    await self._respond(writer, 400, {'error': 'bad content-length'}, keep_alive=False)
+                    return
+                if content_length:
+                    await reader.readexactly(content_length) # request bodies are not used
+                keep_alive = headers.get('connection', '').lower() != 'close' and parts[-1] == 'HTTP/1.1'
+                if len(parts) != 3:
+                    await self._respond(writer, 400, {'error': 'malformed request line'}, keep_alive=False)
+                    return
+                status, body = await self._route(parts[0], parts[1])
+                await self._respond(writer, status, body, keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, writer, status, body, keep_alive):
+        # Text bodies are Prometheus metrics, everything else is JSON
+        text = isinstance(body, str)
+        payload = body.encode('utf-8') if text else json.dumps(body).encode('utf-8')
+        head = [f'HTTP/1.1 {status} {REASONS[status]}', 'Content-Type: ' + ('text/plain; version=0.0.4' if text else 'application/json'),
+                f'Content-Length: {len(payload)}', 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        if status == 503:
+            head.append('Retry-After: 1')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+        await writer.drain()
+
+    async def _route(self, method, target):
+        url = urlsplit(target)
+        if method != 'GET':
+            return 405, {'error': 'only GET is supported'}
+        if url.path == '/health':
+            return 200, self.health()
+        if url.path == '/metrics':
+            return 200, self.metrics()
+        if url.path == '/metrics/prometheus':
+            return 200, instrumentation.to_prometheus()
+        engine = url.path[len('/recommend/'):] if url.path.startswith('/recommend/') else None
+        if engine not in self.batchers:
+            return 404, {'error': f'unknown path {url.path}'}
+
+        query = parse_qs(url.query)
+        track_id = query.get('track_id', [None])[0]
+        try:
+            num_recs = int(query.get('num_recs', ['30'])[0])
+        except ValueError:
+            num_recs = 0
+        if not track_id or not 1 <= num_recs <= MAX_NUM_RECS:
+            return 400, {'error': f'track_id and num_recs (1 to {MAX_NUM_RECS}) are required'}
+        try:
+            if engine in self.cached_engines:
+                # Repeated seeds are answered from the cache, identical requests in flight share one computation
+                version = (model_version(self.engines[engine]), catalog_version(self.catalog))
+                self.cache.check_version(engine, version)
+                recommendations = await self.cache.get_or_compute_async(
+                    (engine, track_id, num_recs, version), lambda: self.batchers[engine].submit((track_id, num_recs)))
+            else:
+                recommendations = await self.batchers[engine].submit((track_id, num_recs))
+        except Overloaded:
+            return 503, {'error': f'{engine} is overloaded'}
+        except Exception as error:
+            return 500, {'error': f'{type(error).__name__}: {error}'}
+        if not recommendations and track_id not in self.track_ids:
+            return 404, {'error': f'track {track_id} is not in the catalog'}
+        return 200, {'engine': engine, 'track_id': track_id, 'recommendations': recommendations}
+
+    def health(self):
+        return {'status': 'ok', 'engines': list(self.batchers), 'catalog_version': catalog_version(self.catalog),
+                'songs': len(self.catalog), 'uptime_seconds': time.time() - self.started}
+
+    def metrics(self):
+        return {'connections': self.connections,
+                'engines': {name: batcher.metrics.snapshot(batcher.pending) for name, batcher in self.batchers.items()},
+                'cache': self.cache.stats() if self.cache is not None else None,
+                'stages': instrumentation.snapshot()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve recommendations over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--catalog', default='spotify_data.csv')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+    parser.add_argument('--models', default=None, help='directory of saved models, one subdirectory per engine')
+    parser.add_argument('--save-models', action='store_true', help='save the models that had to be fitted to --models')
+    parser.add_argument('--playlist', default='Playlists/Pico_songs.csv', help='playlist the collaborative model is fitted on')
+    parser.add_argument('--playlists', nargs='+', default=PLAYLISTS, help='playlists the item-item model is fitted on')
+    parser.add_argument('--liked-songs', default='ahhhhhhhhhhhhhhhhhhhhhlejandro_liked_songs.csv', help='liked songs the content model is fitted on')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random recommender')
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, help='how long a batch stays open for more requests')
+    parser.add_argument('--max-pending', type=int, default=4096, help='queued requests per engine before answering 503')
+    parser.add_argument('--max-connections', type=int, default=1024)
+    parser.add_argument('--cache-size', type=int, default=10000, help='results kept in memory, 0 turns the result cache off')
+    parser.add_argument('--cache-ttl', type=float, default=300.0, help='seconds a cached result stays valid')
+    parser.add_argument('--cache-path', default=None, help='SQLite file that keeps cached results across restarts')
+    parser.add_argument('--cache-engines', nargs='+', default=list(CACHED_ENGINES), choices=ENGINES)
+    args = parser.parse_args(argv)
+
+    catalog = load_catalog(args.catalog, columns=CATALOG_COLUMNS)
+    engines = load_engines(catalog, args.engines, args.models, args.playlist, args.liked_songs, args.save_models, args.seed,
+                           args.playlists)
+    cache = ResultCache(args.cache_size, args.cache_ttl, args.cache_path) if args.cache_size > 0 else None
+    server = RecommendationServer(engines, catalog, args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000,
+                                  args.max_pending, args.max_connections, cache, args.cache_engines)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
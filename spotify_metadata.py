@@ -0,0 +1,268 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import stage
+
+### Batched, cached access to Spotify track and artist metadata.
+# Tracks and artists are requested 50 ids at a time (the Web API maximum) on a small thread pool
+# that shares one rate limiter, failed calls are retried with exponential backoff, and every
+# result is kept in a SQLite cache so repeated runs do not go back to Spotify. Any object with
+# spotipy's `tracks(ids)` / `artists(ids)` methods can be used as the client (see fake_spotify.py).
+
+SCOPE = "user-library-read user-top-read"
+BATCH_SIZE = 50
+# In the repository's own cache directory (ignored by git), not in whatever directory the process runs in
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.spotify_cache', 'metadata.sqlite')
+DEFAULT_TTL = 7 * 24 * 3600 # seconds
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_clients = {}
+_clients_lock = threading.Lock()
+_default_fetcher = None
+
+def get_spotify_client(scope=SCOPE):
+    """
+    This helper function returns one shared, authenticated Spotify client per scope instead of building a new one per call.
+    spotipy and config.py are only imported here, so offline code paths need neither.
+
+    Parameters:
+        scope (str): OAuth scope of the client.
+
+    Returns:
+        spotipy.Spotify: The pooled client.
+    """
+    with _clients_lock:
+        if scope not in _clients:
+            import spotipy
+            from spotipy.oauth2 import SpotifyOAuth
+            from config import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT
+            auth_manager = SpotifyOAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT, scope=scope)
+            _clients[scope] = spotipy.Spotify(auth_manager=auth_manager, requests_session=True)
+        return _clients[scope]
+
+def _retryable(error):
+    # Rate limits, server errors and network failures are retried, anything else (unknown ids, auth, bugs) is raised at once.
+    # spotipy and requests are only imported when a request failed, and a client that does not use them never raises their errors
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        import requests
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+    except ImportError:
+        pass
+    try:
+        import spotipy
+    except ImportError:
+        return False
+    return isinstance(error, spotipy.SpotifyException) and error.http_status in RETRY_STATUSES
+
+def lookup_errors():
+    # Exceptions of an online lookup that failed: an unknown track (KeyError) and Spotify or network errors the retries
+    # did not get past. Meant for an except clause, so spotipy and requests are only imported once a lookup failed
+    errors = [KeyError, ConnectionError, TimeoutError]
+    try:
+        import requests
+        errors.append(requests.RequestException)
+    except ImportError:
+        pass
+    try:
+        import spotipy
+        errors.append(spotipy.SpotifyException)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+def default_fetcher():
+    # Fetcher shared by the recommenders for their (rare) online lookups, created on first use
+    global _default_fetcher
+    with _clients_lock:
+        if _default_fetcher is None:
+            _default_fetcher = SpotifyMetadataFetcher()
+        return _default_fetcher
+
+def genre_string(genres):
+    # Same format as utils.process_artist: comma-separated genres, or 'No Genre'
+    return ', '.join(genres) if genres else 'No Genre'
+
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Block until the next request slot, slots are spaced evenly across all threads
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+class MetadataCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (kind TEXT, id TEXT, data TEXT, fetched_at REAL, PRIMARY KEY (kind, id))')
+
+    def get_many(self, kind, ids):
+        # Cached, unexpired entries for the ids (a cached None means Spotify did not know the id)
+        found = {}
+        oldest = time.time() - self.ttl
+        with self.lock:
+            for start in range(0, len(ids), 500): # stay under SQLite's bound-parameter limit
+                batch = ids[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.connection.execute(
+                    f'SELECT id, data FROM metadata WHERE kind = ? AND fetched_at >= ? AND id IN ({placeholders})',
+                    [kind, oldest] + batch)
+                found.update((item_id, json.loads(data)) for item_id, data in rows)
+        return found
+
+    def put_many(self, kind, items):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                                        [(kind, item_id, json.dumps(data), now) for item_id, data in items.items()])
+
+    def evict_expired(self):
+        # Delete every entry older than the TTL, returns how many were removed
+        with self.lock, self.connection:
+            return self.connection.execute('DELETE FROM metadata WHERE fetched_at < ?', (time.time() - self.ttl,)).rowcount
+
+    def close(self):
+        self.connection.close()
+
+class SpotifyMetadataFetcher:
+    def __init__(self, client=None, cache_path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_workers=4,
+                 requests_per_second=10, max_retries=5, backoff=0.5):
+        """
+        Parameters:
+            client (spotipy.Spotify): Client to use, the pooled client from get_spotify_client if None.
+            cache_path (str): SQLite file of the cache, ':memory:' for a cache that lives with the fetcher.
+            ttl (float): Seconds a cached entry stays valid.
+            max_workers (int): Concurrent requests.
+            requests_per_second (float): Rate limit shared by all workers, 0 for none.
+            max_retries (int): Retries of a failed request before giving up.
+            backoff (float): First retry delay in seconds, doubled on every retry.
+        """
+        self._client = client
+        self.cache = MetadataCache(cache_path, ttl)
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.requests = 0 # round trips made to Spotify
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_spotify_client()
+        return self._client
+
+    def _call(self, method, *args):
+        # One request, rate limited and retried with exponential backoff (and Retry-After when Spotify sends one)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            with self.lock:
+                self.requests += 1
+            try:
+                with stage('spotify.' + method, items=len(args[0]) if args and isinstance(args[0], list) else 1):
+                    return getattr(self.client, method)(*args)
+            except Exception as error:
+                if attempt == self.max_retries or not _retryable(error):
+                    raise
+                retry_after = (getattr(error, 'headers', None) or {}).get('Retry-After')
+                delay = float(retry_after) if retry_after else self.backoff * (2 ** attempt)
+                time.sleep(delay * (1 + random.random() * 0.1))
+
+    def _fetch(self, kind, method, ids):
+        # Cached entries plus batched, concurrent requests for the rest
+        ids = list(dict.fromkeys(item_id for item_id in ids if item_id))
+        found = self.cache.get_many(kind, ids)
+        missing = [item_id for item_id in ids if item_id not in found]
+        batches = [missing[start:start + BATCH_SIZE] for start in range(0, len(missing), BATCH_SIZE)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+                responses = list(pool.map(lambda batch: self._call(method, batch), batches))
+            fetched = {}
+            for batch, response in zip(batches, responses):
+                fetched.update(zip(batch, response[method])) # unknown ids come back as None
+            self.cache.put_many(kind, fetched)
+            found.update(fetched)
+        return found
+
+    def tracks(self, track_ids):
+        # Track objects by id (None for ids Spotify does not know)
+        return self._fetch('track', 'tracks', track_ids)
+
+    def artists(self, artist_ids):
+        # Artist objects by id (None for ids Spotify does not know)
+        return self._fetch('artist', 'artists', artist_ids)
+
+    def artist_genres(self, artist_ids):
+        return {artist_id: (artist or {}).get('genres', []) for artist_id, artist in self.artists(artist_ids).items()}
+
+    def song_rows(self, tracks):
+        """
+        This function turns track objects into the rows written by utils (track_id, ..., genre), fetching the
+        genres of all main artists with batched requests.
+
+        Parameters:
+            tracks (list): Spotify track objects.
+
+        Returns:
+            list: One dictionary per track.
+        """
+        tracks = [track for track in tracks if track]
+        genres = self.artist_genres([track['artists'][0]['id'] for track in tracks if track['artists']])
+        rows = []
+        for track in tracks:
+            artists = [artist['name'] for artist in track['artists']] # there could be more than one artist
+            main_artist = track['artists'][0]['id'] if track['artists'] else None
+            rows.append({
+                'track_id': track['id'],
+                'track_name': track['name'],
+                'artist_names': ', '.join(artists),
+                'popularity': track['popularity'],
+                'duration_ms': track['duration_ms'],
+                'explicit': track['explicit'],
+                'album': track['album']['name'],
+                'release_date': track['album']['release_date'],
+                'uri': track['uri'],
+                'genre': genre_string(genres.get(main_artist, [])) # genres of the main artist
+            })
+        return rows
+
+    def track_rows(self, track_ids):
+        tracks = self.tracks(track_ids)
+        return self.song_rows([tracks[track_id] for track_id in track_ids if tracks.get(track_id)])
+
+    def track_summary(self, track_id):
+        """
+        This function looks up one track for the recommenders' online fallback.
+
+        Parameters:
+            track_id (str): Spotify track id.
+
+        Returns:
+            tuple: (track name, main artist name, list of the main artist's genres).
+
+        Raises:
+            KeyError: If Spotify does not know the track.
+        """
+        track = self.tracks([track_id]).get(track_id)
+        if not track:
+            raise KeyError(track_id)
+        artist = track['artists'][0]
+        return track['name'], artist['name'], self.artist_genres([artist['id']]).get(artist['id'], [])
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from ann import ExactIndex, LSHIndex, build_index, check_recall, load_index, recall_at_k
+
+NUM_SONGS = 5000
+NUM_QUERIES = 200
+K = 10
+MIN_LSH_RECALL = 0.9
+
+@pytest.fixture(scope='module')
+def features():
+    # Songs around a few clusters in a small feature space, like scaled audio features
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(50, 32))
+    points = centers[rng.integers(0, len(centers), NUM_SONGS)] + 0.3 * rng.normal(size=(NUM_SONGS, 32))
+    return sp.csr_matrix(points.astype(np.float32))
+
+@pytest.fixture(scope='module')
+def queries(features):
+    return features[np.random.default_rng(1).choice(NUM_SONGS, NUM_QUERIES, replace=False)]
+
+def brute_force(features, queries, k):
+    # Reference neighbours: the k largest cosine similarities
+    rows = features.toarray() / np.linalg.norm(features.toarray(), axis=1, keepdims=True)
+    query_rows = queries.toarray() / np.linalg.norm(queries.toarray(), axis=1, keepdims=True)
+    return np.argsort(-(query_rows @ rows.T), axis=1, kind='stable')[:, :k]
+
+def test_recall_at_k():
+    exact = np.array([[0, 1, 2, 3], [4, 5, 6, -1]])
+    assert recall_at_k(exact, exact) == 1.0
+    assert recall_at_k(np.array([[0, 1, 9, 9], [4, -1, -1, -1]]), exact) == pytest.approx((2 / 4 + 1 / 3) / 2)
+    assert recall_at_k([], []) == 1.0
+
+def test_exact_index_matches_brute_force(features, queries):
+    _, indices = ExactIndex().fit(features).kneighbors(queries, K)
+    assert recall_at_k(indices, brute_force(features, queries, K)) >= 0.99
+
+def test_lsh_recall_with_default_params(features, queries):
+    result = check_recall(features, queries, K)
+    assert result['recall'] >= MIN_LSH_RECALL
+    _, indices = LSHIndex().fit(features).kneighbors(queries, K)
+    assert recall_at_k(indices, brute_force(features, queries, K)) >= MIN_LSH_RECALL
+
+@pytest.mark.parametrize('kind', ['exact', 'lsh'])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load_round_trip(kind, mmap, features, queries, tmp_path):
+    index = build_index(kind).fit(features[:NUM_SONGS - 500])
+    index.add(features[NUM_SONGS - 500:])
+    index.remove(np.arange(0, NUM_SONGS, 7))
+    index.save(str(tmp_path / kind))
+
+    loaded = load_index(str(tmp_path / kind), mmap=mmap)
+    assert type(loaded) is type(index)
+    assert loaded.params() == index.params()
+    assert len(loaded) == len(index) and loaded.num_live() == index.num_live()
+    distances, indices = index.kneighbors(queries, K)
+    loaded_distances, loaded_indices = loaded.kneighbors(queries, K)
+    np.testing.assert_array_equal(loaded_indices, indices)
+    np.testing.assert_allclose(loaded_distances, distances, rtol=1e-6, atol=1e-6)
+    assert not np.isin(loaded_indices, np.arange(0, NUM_SONGS, 7)).any()
+
+    # The loaded index keeps taking updates
+    rows = loaded.add(features[:10])
+    np.testing.assert_array_equal(rows, np.arange(NUM_SONGS, NUM_SONGS + 10))
+    loaded.remove(rows)
+    assert loaded.num_live() == index.num_live()
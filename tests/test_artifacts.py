@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from artifacts import catalog_fingerprint, catalog_meta, check_catalog
+from benchmarks.synthetic import make_catalog, make_playlist
+from CollaborativeFilteringRecSys import CollaborativeFilteringRecSys
+from ContentRecSys import ContentBasedRecSys
+from embeddings import SongEmbeddings
+from PopularRecSys import PopularRec
+from RandomRecSys import RandomRec
+
+@pytest.fixture(scope='module')
+def catalog():
+    return make_catalog(500)
+
+def fit_collab(catalog):
+    model = CollaborativeFilteringRecSys(make_playlist(catalog, 40), catalog, k=5)
+    model.preprocess_data()
+    model.train_model()
+    return model
+
+def fit_content(catalog):
+    model = ContentBasedRecSys(catalog, make_playlist(catalog, 150, seed=1), n_songs=50, random_state=0)
+    model.preprocess_data()
+    model.train_model()
+    return model
+
+# name -> (fit, load, recommend_many); the random recommender is seeded so both copies draw the same songs
+RECOMMENDERS = {
+    'popular': (PopularRec, PopularRec.load, lambda model: model.recommend_many),
+    'random': (lambda catalog: RandomRec(catalog, seed=3), lambda path, catalog: RandomRec.load(path, catalog, seed=3),
+               lambda model: model.recommend_many),
+    'collab': (fit_collab, CollaborativeFilteringRecSys.load, lambda model: model.recommend_many),
+    'content': (fit_content, ContentBasedRecSys.load, lambda model: model.get_recommendations_many),
+    'audio': (lambda catalog: SongEmbeddings(catalog).fit(), SongEmbeddings.load, lambda model: model.recommend_many),
+}
+
+@pytest.mark.parametrize('name', sorted(RECOMMENDERS))
+def test_save_load_round_trip(name, catalog, tmp_path):
+    fit, load, recommend_many = RECOMMENDERS[name]
+    model = fit(catalog)
+    model.save(str(tmp_path / name))
+    loaded = load(str(tmp_path / name), catalog)
+    if name not in ('popular', 'random'): # theirs is the catalog version, a new one for catalogs without one
+        assert loaded.model_version == model.model_version
+    track_ids = list(catalog['track_id'][::50]) + ['unknown']
+    expected, records = recommend_many(model)(track_ids, 10), recommend_many(loaded)(track_ids, 10)
+    assert len(records) and records.dtype == expected.dtype
+    assert records.tolist() == expected.tolist()
+
+    # Same number of songs, other track ids: caught by the fingerprint, the catalog did not come from the store
+    other = catalog.copy()
+    other['track_id'] = other['track_id'].iloc[::-1].to_numpy()
+    with pytest.raises(ValueError, match='fingerprint'):
+        load(str(tmp_path / name), other)
+
+def test_check_catalog_compares_versions_then_fingerprints(catalog):
+    versioned = catalog.copy()
+    versioned.attrs['catalog_version'] = 'v1'
+    meta = catalog_meta(versioned)
+    assert meta == {'catalog_version': 'v1', 'catalog_fingerprint': catalog_fingerprint(catalog), 'num_rows': 500}
+    check_catalog(meta, versioned, 'model')
+    check_catalog(meta, catalog, 'model') # no version on one side, same track ids
+    check_catalog(meta, catalog.astype({'track_id': 'category'}), 'model')
+
+    renamed = versioned.copy()
+    renamed.attrs['catalog_version'] = 'v2'
+    with pytest.raises(ValueError, match='catalog version v1, got version v2'):
+        check_catalog(meta, renamed, 'model')
+    with pytest.raises(ValueError, match='500 songs, got 499'):
+        check_catalog(meta, catalog.iloc[1:], 'model')
+    shuffled = catalog.sample(frac=1, random_state=0)
+    with pytest.raises(ValueError, match='fingerprint'):
+        check_catalog(meta, shuffled, 'model')
+    versioned_shuffle = shuffled.copy()
+    versioned_shuffle.attrs['catalog_version'] = 'v1' # the store's version is trusted when both sides have one
+    check_catalog(meta, versioned_shuffle, 'model')
+    check_catalog(dict(meta, catalog_fingerprint=None), shuffled, 'model') # artifacts saved before fingerprints
+    del meta['catalog_fingerprint']
+    check_catalog(meta, shuffled, 'model')
@@ -0,0 +1,87 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+import catalog
+from benchmarks.synthetic import make_catalog
+from catalog import CatalogStore, append_rows, catalog_version, load_catalog
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = str(tmp_path / 'songs.csv')
+    make_catalog(200).to_csv(path, index=False)
+    return path
+
+def store_dirs(cache_dir):
+    return sorted(os.listdir(cache_dir))
+
+def test_build_open_and_rebuild_when_the_csv_changes(csv_path, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    store = CatalogStore.open(csv_path, cache_dir)
+    assert store.is_current(csv_path) and store.num_rows == 200
+    assert len(store_dirs(cache_dir)) == 1 # no temporary directory left behind
+
+    builds = []
+    build = CatalogStore.build.__func__
+    monkeypatch.setattr(CatalogStore, 'build', classmethod(lambda cls, *args: builds.append(args) or build(cls, *args)))
+    assert CatalogStore.open(csv_path, cache_dir).version == store.version and not builds
+
+    # Touched: rebuilt, but the contents and so the version did not change
+    stat = os.stat(csv_path)
+    os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not store.is_current(csv_path)
+    rebuilt = CatalogStore.open(csv_path, cache_dir)
+    assert len(builds) == 1 and rebuilt.is_current(csv_path) and rebuilt.version == store.version
+    assert store_dirs(cache_dir) == [os.path.basename(rebuilt.path)]
+
+    # Same size and modification time, other contents: a new version
+    with open(csv_path, 'rb') as f:
+        data = f.read()
+    first_id = pd.read_csv(csv_path)['track_id'][0]
+    with open(csv_path, 'wb') as f:
+        f.write(data.replace(first_id.encode(), first_id[::-1].encode(), 1))
+    os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    changed = CatalogStore.build(csv_path, rebuilt.path)
+    assert changed.version != store.version and changed.read(['track_id'])['track_id'][0] == first_id[::-1]
+
+def test_the_version_follows_the_contents_not_the_path(csv_path, tmp_path):
+    copy = str(tmp_path / 'copy.csv')
+    shutil.copyfile(csv_path, copy)
+    first, second = CatalogStore.open(csv_path, str(tmp_path / 'cache')), CatalogStore.open(copy, str(tmp_path / 'cache'))
+    assert first.path != second.path and first.version == second.version
+    assert first.meta['source'] == os.path.abspath(csv_path)
+
+def test_a_failed_build_keeps_the_old_store(csv_path, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    store = CatalogStore.open(csv_path, cache_dir)
+    def broken(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(catalog.np, 'save', broken)
+    with pytest.raises(OSError):
+        CatalogStore.build(csv_path, store.path)
+    assert store_dirs(cache_dir) == [os.path.basename(store.path)]
+    assert CatalogStore(store.path).version == store.version
+
+def test_load_catalog_columns(csv_path, tmp_path):
+    expected = make_catalog(200)
+    df = load_catalog(csv_path, columns=['track_id', 'genre', 'popularity', 'energy'], cache_dir=str(tmp_path / 'cache'))
+    assert list(df.columns) == ['track_id', 'genre', 'popularity', 'energy']
+    assert isinstance(df['track_id'].dtype, pd.CategoricalDtype) and df['popularity'].dtype == np.int32
+    assert list(df['track_id']) == list(expected['track_id']) and list(df['genre']) == list(expected['genre'])
+    assert np.allclose(df['energy'], expected['energy'])
+    assert catalog_version(df) == CatalogStore.open(csv_path, str(tmp_path / 'cache')).version
+
+def test_append_rows_keeps_the_existing_codes(csv_path, tmp_path):
+    df = load_catalog(csv_path, columns=['track_id', 'genre', 'popularity'], cache_dir=str(tmp_path / 'cache'))
+    rows = pd.DataFrame({'track_id': ['new track', df['track_id'][3]], 'genre': [df['genre'][0], 'brand new genre']})
+    result = append_rows(df, rows)
+    assert len(result) == 202 and result.attrs == df.attrs
+    for column in ('track_id', 'genre'):
+        assert np.array_equal(result[column].cat.codes[:200], df[column].cat.codes)
+        assert list(result[column].cat.categories[:len(df[column].cat.categories)]) == list(df[column].cat.categories)
+    assert list(result['track_id'][200:]) == ['new track', df['track_id'][3]]
+    assert result['track_id'].cat.codes[201] == df['track_id'].cat.codes[3] # an existing value keeps its code
+    assert result['genre'].cat.codes[200] == df['genre'].cat.codes[0]
+    assert list(result['genre'].cat.categories[-1:]) == ['brand new genre']
+    assert result['popularity'][:200].tolist() == df['popularity'].tolist() and result['popularity'][200:].isna().all()
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic import make_catalog, make_playlist
+from catalog import load_catalog
+from CollaborativeFilteringRecSys import CollaborativeFilteringRecSys
+
+NUM_SONGS = 3000
+MIN_SEED_RECALL = 0.9
+MIN_PLAYLIST_RECALL = 0.9
+
+@pytest.fixture(params=['store', 'dataframe'])
+def catalog(request, tmp_path):
+    # The same songs as a catalog from the columnar store (categoricals) and as a plain DataFrame (pandas strings)
+    df = make_catalog(NUM_SONGS)
+    if request.param == 'dataframe':
+        return df
+    csv_path = tmp_path / 'catalog.csv'
+    df.to_csv(csv_path, index=False)
+    return load_catalog(str(csv_path), cache_dir=str(tmp_path / 'cache'))
+
+def fit(catalog):
+    model = CollaborativeFilteringRecSys(make_playlist(catalog, 50, seed=1), catalog)
+    model.preprocess_data()
+    model.train_model()
+    return model
+
+def test_add_tracks_matches_refit(catalog):
+    model = fit(catalog)
+    songs = make_playlist(catalog, 40, new_fraction=0.5, seed=2)
+    added = model.add_tracks(songs)
+    assert added == (~songs['track_id'].isin(catalog['track_id'])).sum()
+    assert len(model.song_dataset) == NUM_SONGS + added
+    new_id = songs['track_id'][~songs['track_id'].isin(catalog['track_id'])].iloc[0]
+    assert len(model.recommend_many([new_id])) > 0
+
+    agreement = model.refit_agreement(num_queries=100)
+    assert agreement['seed_recall'] >= MIN_SEED_RECALL
+    assert agreement['playlist_recall'] >= MIN_PLAYLIST_RECALL
+
+def test_remove_tracks_matches_refit(catalog):
+    model = fit(catalog)
+    songs = make_playlist(catalog, 40, new_fraction=0.5, seed=2)
+    model.add_tracks(songs)
+    new_ids = songs['track_id'][~songs['track_id'].isin(catalog['track_id'])].to_numpy()
+    removed = model.remove_tracks(list(new_ids[:10]))
+    assert removed == 10
+    assert not model.playlist_data['track_id'].isin(new_ids[:10]).any()
+    assert len(model.recommend_many(list(new_ids[:10]))) == 0
+    recommended = model.recommend_many(list(np.asarray(catalog['track_id'][:20], dtype=object)))
+    assert not np.isin(recommended['track_id'], new_ids[:10]).any()
+
+    agreement = model.refit_agreement(num_queries=100)
+    assert agreement['seed_recall'] >= MIN_SEED_RECALL
+    assert agreement['playlist_recall'] >= MIN_PLAYLIST_RECALL
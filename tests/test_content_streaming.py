@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import ContentRecSys
+from benchmarks.synthetic import make_catalog, make_playlist
+from catalog import CatalogStore
+from ContentRecSys import STREAMING_COLUMNS, ContentBasedRecSys
+
+@pytest.fixture(scope='module')
+def trained(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('catalog')
+    catalog = make_catalog(600)
+    catalog.to_csv(directory / 'songs.csv', index=False)
+    store = CatalogStore.build(str(directory / 'songs.csv'), str(directory / 'store'))
+    liked = make_playlist(catalog, 80, new_fraction=0.1)
+    model = ContentBasedRecSys(None, liked, random_state=0).train_streaming(store, chunk_size=128, negative_fraction=0.3)
+    return model, store, catalog
+
+def test_in_memory_methods_need_the_cached_catalog(trained, tmp_path):
+    model, _, catalog = trained
+    for call in (lambda: model.get_recommendations_many(list(catalog['track_id'][:3])),
+                 lambda: model.get_recommendations(catalog['track_id'][0]), lambda: model.save(str(tmp_path / 'content'))):
+        with pytest.raises(ValueError, match='recommend_streaming'):
+            call()
+
+def test_recommend_streaming_matches_score_catalog(trained, monkeypatch):
+    model, store, catalog = trained
+    # The same model scoring the whole catalog in memory, with the streaming features
+    in_memory = ContentBasedRecSys(model.prepare_song_dataset(store.read(STREAMING_COLUMNS)), None)
+    in_memory.features, in_memory.model = model.features, model.model
+    in_memory.preprocessed_data = in_memory.features.transform(in_memory.song_dataset)
+    in_memory.cache_catalog_features()
+
+    song_ids = ['unknown'] + list(catalog['track_id'].sample(20, random_state=1))
+    monkeypatch.setattr(ContentRecSys, 'SCORE_BLOCK_SIZE', 1000) # blocks of 7 seeds per chunk of 128 songs
+    streamed = model.recommend_streaming(store, song_ids, num_recs=10, chunk_size=128)
+    expected = in_memory.get_recommendations_many(song_ids, num_recs=10)
+    assert len(streamed) == 20 * 10
+    assert streamed.dtype == expected.dtype
+    for field in ('seed', 'rank', 'row', 'track_id'):
+        assert list(streamed[field]) == list(expected[field])
+    assert (streamed['track_id'] != np.asarray(song_ids, dtype=object)[streamed['seed']]).all() # never the seed itself
+
+def test_recommend_streaming_with_fewer_songs_than_num_recs(trained):
+    model, store, catalog = trained
+    records = model.recommend_streaming(store, [catalog['track_id'][5], 'unknown'], num_recs=1000, chunk_size=256)
+    assert list(records['seed']) == [0] * 599 and list(records['rank']) == list(range(1, 600))
+    assert sorted(records['row']) == [row for row in range(600) if row != 5]
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+import embeddings
+from benchmarks.synthetic import make_catalog
+from embeddings import DIMENSIONS, SongEmbeddings
+
+@pytest.fixture(scope='module')
+def catalog():
+    return make_catalog(20000)
+
+@pytest.fixture(scope='module')
+def fitted(catalog):
+    return SongEmbeddings(catalog).fit()
+
+def exact_search(model, queries, k):
+    # Rows of the k highest cosine similarities with the float vectors of the whole catalog
+    similarities = queries @ np.asarray(model.vectors).T
+    return np.argsort(-similarities, axis=1, kind='stable')[:, :k], np.sort(similarities, axis=1)[:, ::-1][:, :k]
+
+def test_vectors_and_codes(fitted, catalog):
+    vectors = np.asarray(fitted.vectors)
+    assert vectors.shape == (20000, len(DIMENSIONS)) and fitted.codes.dtype == np.int8
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1, atol=1e-5)
+    assert np.all(np.abs(fitted.codes * fitted.scales - vectors) <= fitted.scales / 2 + 1e-6) # rounding error only
+    assert fitted.memory_footprint()['bytes_per_song'] == len(DIMENSIONS) == 16
+    # Keys sit on a circle: B (11) is as close to C (0) as C# (1) is
+    songs = pd.concat([catalog.iloc[[0]]] * 4, ignore_index=True).assign(key=[0, 11, 1, 6])
+    distances = np.linalg.norm(fitted.transform(songs)[:, -2:] - fitted.transform(songs)[0, -2:], axis=1)
+    assert np.isclose(distances[1], distances[2]) and distances[1] < distances[3]
+    missing = pd.DataFrame(np.nan, index=[0], columns=embeddings.EMBEDDING_COLS)
+    assert not fitted.transform(missing).any() # no known value: a zero vector
+
+@pytest.mark.parametrize('search_chunk', [embeddings.SEARCH_CHUNK, 3000])
+def test_search_recall_against_exact_cosine(fitted, monkeypatch, search_chunk):
+    monkeypatch.setattr(embeddings, 'SEARCH_CHUNK', search_chunk) # several chunks: the first one's threshold is used
+    monkeypatch.setattr(embeddings, 'QUERY_CHUNK', 16)
+    queries = np.asarray(fitted.vectors[::200]) # 100 queries
+    similarities, rows = fitted.search(queries, 10)
+    expected_rows, expected_similarities = exact_search(fitted, queries, 10)
+    recall = np.mean([len(set(found) & set(wanted)) / 10 for found, wanted in zip(rows, expected_rows)])
+    assert recall >= 0.95
+    assert np.all(np.diff(similarities, axis=1) <= 0) # most similar first
+    assert np.allclose(similarities, np.einsum('qkd,qd->qk', np.asarray(fitted.vectors)[rows], queries), atol=1e-6)
+    assert np.all(similarities <= expected_similarities + 1e-6)
+
+def test_rerank_of_the_whole_catalog_is_exact(catalog):
+    model = SongEmbeddings(catalog.iloc[:2000], rerank=2000).fit()
+    queries = np.asarray(model.vectors[::100])
+    similarities, rows = model.search(queries, 5)
+    _, expected = exact_search(model, queries, 5)
+    assert np.allclose(similarities, expected, atol=1e-6)
+
+def test_small_catalogs_are_padded(catalog):
+    model = SongEmbeddings(catalog.iloc[:3]).fit()
+    similarities, rows = model.search(np.asarray(model.vectors[:1]), 5)
+    assert sorted(rows[0, :3]) == [0, 1, 2] and list(rows[0, 3:]) == [-1, -1] and np.all(np.isneginf(similarities[0, 3:]))
+
+def test_recommend_many_leaves_out_every_copy_of_the_seed(catalog):
+    songs = pd.concat([catalog.iloc[:500], catalog.iloc[[7]]], ignore_index=True) # track 7 listed twice
+    model = SongEmbeddings(songs).fit()
+    records = model.recommend_many([songs['track_id'][7], 'unknown', songs['track_id'][8]], num_recs=5)
+    assert list(records['seed']) == [0] * 5 + [2] * 5 and list(records['rank']) == list(range(1, 6)) * 2
+    assert songs['track_id'][7] not in set(records['track_id'][records['seed'] == 0])
+    assert list(records['track_id']) == list(songs['track_id'][records['row']])
+
+def test_save_and_load_memory_maps(fitted, catalog, tmp_path):
+    fitted.save(str(tmp_path / 'audio'))
+    loaded = SongEmbeddings.load(str(tmp_path / 'audio'), catalog)
+    assert isinstance(loaded.codes, np.memmap) and isinstance(loaded.vectors, np.memmap)
+    assert loaded.model_version == fitted.model_version and loaded.weights == fitted.weights
+    queries = np.asarray(fitted.vectors[:20])
+    for expected, found in zip(fitted.search(queries, 10), loaded.search(queries, 10)):
+        assert np.array_equal(expected, found)
+    in_memory = SongEmbeddings.load(str(tmp_path / 'audio'), catalog, mmap=False)
+    assert not isinstance(in_memory.codes, np.memmap) and np.array_equal(in_memory.codes, fitted.codes)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+from evaluation import bootstrap, evaluate, ranking_metrics, split_holdout
+from records import make_records
+
+def test_ranking_metrics_by_hand():
+    # Held-out tracks of four playlists over six tracks, the third playlist held out nothing
+    test = sp.csr_matrix((np.ones(5), ([0, 0, 0, 1, 3], [1, 4, 5, 0, 2])), shape=(4, 6))
+    recommended = np.array([[4, 2, 1], [3, -1, -1], [0, 5, -1], [-1, -1, -1]])
+    popularity = np.array([9, 0, 3, 1, 4, 0])
+    metrics = ranking_metrics(recommended, test, popularity, num_playlists=9)
+
+    # Playlist 0: hits at ranks 1 and 3 out of 3 held-out tracks. The -1 of playlist 1 must not match (0, 5)
+    dcg = 1 + 1 / np.log2(4)
+    ideal = 1 + 1 / np.log2(3) + 1 / np.log2(4)
+    np.testing.assert_allclose(metrics['precision'], [2 / 3, 0, 0, 0])
+    np.testing.assert_allclose(metrics['recall'], [2 / 3, 0, 0, 0])
+    np.testing.assert_allclose(metrics['ndcg'], [dcg / ideal, 0, 0, 0])
+    np.testing.assert_array_equal(metrics['hit_rate'], [1, 0, 0, 0])
+
+    # Self-information -log2((popularity + 1) / (playlists + 1)) of the recommended tracks, NaN without any
+    information = -np.log2((popularity + 1) / 10)
+    expected = [information[[4, 2, 1]].mean(), information[3], information[[0, 5]].mean(), np.nan]
+    np.testing.assert_allclose(metrics['novelty'], expected)
+
+def test_ranking_metrics_without_held_out_tracks():
+    metrics = ranking_metrics(np.array([[0, 1], [-1, -1]]), sp.csr_matrix((2, 3)))
+    assert 'novelty' not in metrics
+    for name in ('precision', 'recall', 'ndcg', 'hit_rate'):
+        np.testing.assert_array_equal(metrics[name], [0, 0])
+
+def test_bootstrap():
+    rng = np.random.default_rng(0)
+    values = np.column_stack([np.full(400, 0.25), rng.integers(0, 2, 400), np.where(np.arange(400) % 2, np.nan, 1.0)])
+    low, high = bootstrap(values, num_samples=2000, confidence=0.95, seed=1)
+    np.testing.assert_allclose([low[0], high[0]], [0.25, 0.25])
+    assert low[2] == high[2] == 1.0 # NaNs are skipped
+    # The mean of 400 coin flips: +-1.96 standard errors around it
+    mean, error = values[:, 1].mean(), values[:, 1].std() / np.sqrt(400)
+    assert low[1] == pytest.approx(mean - 1.96 * error, abs=0.01)
+    assert high[1] == pytest.approx(mean + 1.96 * error, abs=0.01)
+    np.testing.assert_array_equal(bootstrap(values, 2000, 0.95, seed=1), (low, high))
+    low, high = bootstrap(np.zeros((0, 2)))
+    assert np.isnan(low).all() and np.isnan(high).all()
+
+def test_split_holdout():
+    matrix = sp.csr_matrix(np.array([[1, 1, 1, 1, 1], [1, 1, 0, 0, 0], [0, 0, 1, 0, 0]]))
+    train, test = split_holdout(matrix, 0.4, seed=0)
+    np.testing.assert_array_equal(np.diff(test.indptr), [2, 1, 0]) # a playlist of one track holds out nothing
+    np.testing.assert_array_equal((train + test).toarray(), matrix.toarray())
+    assert train.multiply(test).nnz == 0
+
+def test_evaluate_coverage_and_exclusions():
+    # Every seed gets the same three recommendations: x and y, which no playlist has, and track a
+    def recommend_many(track_ids, num_recs):
+        seeds = np.repeat(np.arange(len(track_ids)), 3)
+        return make_records(seeds, np.tile([1, 2, 3], len(track_ids)), np.zeros(len(seeds)), np.tile(['x', 'a', 'y'], len(track_ids)))
+
+    matrix = sp.csr_matrix(np.ones((6, 4)))
+    summary = evaluate({'stub': recommend_many}, matrix, ['a', 'b', 'c', 'd'], k=2, holdout=0.25,
+                       catalog_track_ids=['a', 'b', 'c', 'd', 'x', 'y', 'z', 'w'], workers=0, num_samples=0)
+    row = summary.loc['stub']
+    assert row['playlists'] == 6
+    # a is held out by some playlists (a hit at rank 2) and a seed of the others (left out, y moves up)
+    held_out_a = np.asarray(split_holdout(matrix, 0.25, 0)[1][:, 0].todense()).ravel() > 0
+    assert held_out_a.tolist() == [False] * 5 + [True]
+    assert row['hit_rate'] == pytest.approx(1 / 6)
+    assert row['precision'] == pytest.approx(1 / 12)
+    assert row['recall'] == pytest.approx(1 / 6)
+    assert row['coverage'] == pytest.approx(3 / 8) # x, y and a out of the eight catalog tracks
+    assert 'precision_low' not in summary
+
+def test_main_evaluates_itemitem(tmp_path, monkeypatch):
+    # Playlists drawn from four groups of 10 tracks: only co-occurrence tells which tracks belong together
+    from benchmarks.synthetic import make_catalog
+    from evaluation import main
+    from server import ENGINES
+    assert 'itemitem' in ENGINES
+    monkeypatch.chdir(tmp_path) # the catalog store goes to ./.catalog_cache
+    catalog = make_catalog(200)
+    catalog.to_csv(tmp_path / 'catalog.csv', index=False)
+    rng = np.random.default_rng(0)
+    groups = np.asarray(catalog['track_id'])[rng.permutation(200)[:40]].reshape(4, 10)
+    paths = []
+    for i in range(60):
+        path = tmp_path / f'playlist{i}.csv'
+        pd.DataFrame({'track_id': rng.choice(groups[i % 4], 6, replace=False)}).to_csv(path, index=False)
+        paths.append(str(path))
+    output = tmp_path / 'summary.csv'
+    main(['--catalog', str(tmp_path / 'catalog.csv'), '--playlists', *paths, '--engines', 'popular', 'itemitem',
+          '--workers', '0', '--bootstrap', '0', '--k', '5', '--output', str(output)])
+    summary = pd.read_csv(output, index_col='engine')
+    assert summary.loc['itemitem', 'hit_rate'] > 0.9
+    assert summary.loc['itemitem', 'recall'] > summary.loc['popular', 'recall']
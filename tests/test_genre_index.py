@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pytest
+from fake_spotify import FakeSpotify
+from genre_index import REJECTION_RATIO, GenreIndex
+from PopularRecSys import PopularRec
+from RandomRecSys import RandomRec
+from spotify_metadata import SpotifyMetadataFetcher
+
+def make_songs():
+    # pop: a, b, c, a again (the catalog lists it twice), d. rock: 40 songs. jazz: a single song
+    rows = [('a', 'pop', 90), ('b', 'pop', 80), ('c', 'pop', 70), ('a', 'pop', 60), ('d', 'pop', 50)]
+    rows += [(f'r{i}', 'rock', 100 - i) for i in range(40)]
+    rows += [('j', 'jazz', 10)]
+    songs = pd.DataFrame(rows, columns=['track_id', 'genre', 'popularity'])
+    songs['track_name'] = 'name ' + songs['track_id']
+    songs['artist_name'] = 'artist ' + songs['track_id']
+    return songs.sample(frac=1, random_state=0).reset_index(drop=True) # rows out of popularity order
+
+@pytest.fixture(scope='module')
+def songs():
+    return make_songs()
+
+@pytest.fixture(scope='module')
+def index(songs):
+    return GenreIndex(songs)
+
+def recommended(index, seeds, ranks, rows, seed):
+    # Track ids recommended to one seed, by rank
+    assert list(ranks[seeds == seed]) == list(range(1, (seeds == seed).sum() + 1))
+    return list(np.asarray(index.track_ids, dtype=object)[index.track_codes[rows[seeds == seed]]])
+
+def test_top_many_orders_by_popularity_and_excludes_every_copy_of_the_seed(index):
+    rows = index.lookup(['a', 'd', 'missing', 'r5', 'j'])
+    assert rows[2] == -1
+    seeds, ranks, rows_out = index.top_many(rows, 3)
+    assert recommended(index, seeds, ranks, rows_out, 0) == ['b', 'c', 'd']
+    assert recommended(index, seeds, ranks, rows_out, 1) == ['a', 'b', 'c']
+    assert recommended(index, seeds, ranks, rows_out, 2) == []
+    assert recommended(index, seeds, ranks, rows_out, 3) == ['r0', 'r1', 'r2']
+    assert recommended(index, seeds, ranks, rows_out, 4) == [] # the only song of its genre
+    for seed in (0, 1, 3):
+        assert list(rows_out[seeds == seed]) == list(index.top(index.genre_codes[rows[seed]], 3, exclude_row=rows[seed]))
+
+def test_top_many_returns_the_whole_genre_when_it_is_smaller_than_num_recs(index):
+    seeds, ranks, rows = index.top_many(index.lookup(['b']), 30)
+    assert recommended(index, seeds, ranks, rows, 0) == ['a', 'c', 'a', 'd']
+
+def check_sample(index, rows, num_recs, result):
+    seeds, ranks, rows_out = result
+    for seed, row in enumerate(rows):
+        picked = rows_out[seeds == seed]
+        assert list(ranks[seeds == seed]) == list(range(1, len(picked) + 1))
+        others = index.genre_rows(index.genre_codes[row])
+        others = others[index.track_codes[others] != index.track_codes[row]]
+        assert len(picked) == min(num_recs, len(others))
+        assert len(set(picked)) == len(picked) # without replacement
+        assert set(picked) <= set(others) # same genre, never the seed track
+
+@pytest.mark.parametrize('num_recs', [3, 8, 30])
+def test_sample_many_draws_distinct_same_genre_rows(index, num_recs):
+    # rock seeds draw with rejection for small num_recs, pop seeds (and rock for large num_recs) use random keys
+    rows = index.lookup(['r0', 'r7', 'a', 'c', 'j', 'r39'] * 5)
+    check_sample(index, rows, num_recs, index.sample_many(rows, num_recs, np.random.default_rng(0)))
+    assert (39 >= REJECTION_RATIO * num_recs) == (num_recs < 10)
+
+def test_sample_many_is_reproducible_with_a_seed(index):
+    rows = index.lookup(['r0', 'a', 'r3', 'b'])
+    first = index.sample_many(rows, 4, np.random.default_rng(7))
+    second = index.sample_many(rows, 4, np.random.default_rng(7))
+    assert all(np.array_equal(x, y) for x, y in zip(first, second))
+    other = index.sample_many(rows, 4, np.random.default_rng(8))
+    assert not all(np.array_equal(x, y) for x, y in zip(first, other))
+
+@pytest.mark.parametrize('track_id,num_recs', [('r0', 3), ('a', 30)])
+def test_sample_many_is_uniform_and_in_random_order(index, track_id, num_recs):
+    row = index.lookup([track_id])[0]
+    seeds, ranks, rows = index.sample_many(np.full(3000, row), num_recs, np.random.default_rng(1))
+    others = np.unique(rows)
+    k = min(num_recs, len(others))
+    for rank in (1, k): # every rank (not only the set) is uniform over the genre
+        counts = np.bincount(np.searchsorted(others, rows[ranks == rank]), minlength=len(others))
+        expected = 3000 / len(others)
+        assert counts.min() > 0.6 * expected and counts.max() < 1.4 * expected
+
+def test_sample_many_with_no_seeds(index):
+    for part in index.sample_many(index.lookup(['missing']), 5, np.random.default_rng(0)):
+        assert len(part) == 0
+
+def test_recommend_many_records(songs):
+    popular, random = PopularRec(songs), RandomRec(songs, seed=0)
+    records = popular.recommend_many(['missing', 'c'], num_recs=2)
+    assert list(records['seed']) == [1, 1] and list(records['rank']) == [1, 2]
+    assert list(records['track_id']) == ['a', 'b'] == list(songs['track_id'].iloc[records['row']])
+    records = random.recommend_many(['r1', 'j'], num_recs=5)
+    assert list(records['seed']) == [0] * 5
+    assert set(songs['genre'].iloc[records['row']]) == {'rock'} and 'r1' not in set(records['track_id'])
+    assert np.array_equal(RandomRec(songs, seed=3).recommend_many(['r1'], 5), RandomRec(songs, seed=3).recommend_many(['r1'], 5))
+
+def test_recommend_prints_for_tracks_unknown_to_spotify(songs, capsys):
+    fetcher = SpotifyMetadataFetcher(FakeSpotify(), requests_per_second=0, backoff=0, cache_path=':memory:')
+    for recommender in (PopularRec(songs, fetcher=fetcher), RandomRec(songs, seed=0, fetcher=fetcher)):
+        assert recommender.recommend('unknown') is None
+        assert 'not found on Spotify' in capsys.readouterr().out
+        assert len(recommender.recommend('c', num_recs=2)) == 2
+
+class BrokenFetcher:
+    def track_summary(self, track_id):
+        raise ZeroDivisionError
+
+def test_recommend_does_not_hide_programming_errors(songs):
+    with pytest.raises(ZeroDivisionError):
+        PopularRec(songs, fetcher=BrokenFetcher()).recommend('unknown')
+    with pytest.raises(ZeroDivisionError):
+        RandomRec(songs, fetcher=BrokenFetcher()).recommend('unknown')
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from genres import GenreVocabulary, jaccard, overlap, popcount, split_genres
+
+# 150 single genres, so the bitsets take three words
+GENRES = [f'genre {i}' for i in range(150)]
+
+@pytest.fixture(scope='module')
+def values():
+    # Genre strings of 1 to 4 genres (some repeated within a string), plus missing values and 'No Genre'
+    rng = np.random.default_rng(0)
+    values = [', '.join(rng.choice(GENRES, size=rng.integers(1, 5))) for _ in range(500)]
+    return values + [None, 'No Genre', np.nan, ' genre 3 ,genre 3,, genre 149 ']
+
+def reference(values, vocabulary):
+    # The set of bit positions of every value, from plain Python sets
+    position = {genre: i for i, genre in enumerate(vocabulary.genres)}
+    return [{position[genre] for genre in split_genres(value) if genre in position} for value in values]
+
+def bit_sets(bits):
+    return [{word * 64 + bit for word in range(bits.shape[1]) for bit in range(64) if int(row[word]) >> bit & 1} for row in bits]
+
+def test_split_genres():
+    assert split_genres(' rock ,pop,, jazz ') == ['rock', 'pop', 'jazz']
+    assert split_genres('No Genre') == [] and split_genres(None) == [] and split_genres(float('nan')) == []
+
+def test_encode_matches_sets(values):
+    vocabulary = GenreVocabulary().fit(values)
+    assert set(vocabulary.genres) == {genre for value in values for genre in split_genres(value)}
+    assert vocabulary.num_words == -(-len(vocabulary) // 64)
+    bits = vocabulary.encode(values)
+    assert bits.dtype == np.uint64 and bits.shape == (len(values), vocabulary.num_words)
+    assert bit_sets(bits) == reference(values, vocabulary)
+    assert np.array_equal(vocabulary.encode(pd.Series(values).astype('category')), bits)
+    multi_hot = vocabulary.multi_hot(values).toarray()
+    assert [set(np.flatnonzero(row)) for row in multi_hot] == reference(values, vocabulary)
+
+def test_unknown_genres_are_left_out(values):
+    vocabulary = GenreVocabulary().fit(values[:100])
+    encoded = vocabulary.encode(values)
+    assert bit_sets(encoded) == reference(values, vocabulary)
+    assert set(vocabulary.new_genres(values)) == {genre for value in values for genre in split_genres(value)} - set(vocabulary.genres)
+    assert bit_sets(vocabulary.query(['genre 3', 'not a genre'])[None, :]) == reference(['genre 3'], vocabulary)
+
+@pytest.mark.parametrize('numpy_popcount', [True, False])
+def test_popcount_overlap_and_jaccard(values, numpy_popcount, monkeypatch):
+    if not numpy_popcount: # the lookup table of numpy < 2.0
+        monkeypatch.delattr(np, 'bitwise_count', raising=False)
+    vocabulary = GenreVocabulary().fit(values)
+    bits, sets = vocabulary.encode(values), reference(values, vocabulary)
+    assert list(popcount(bits)) == [len(genres) for genres in sets]
+    assert list(popcount(np.array([[2 ** 64 - 1, 0, 5]], dtype=np.uint64))) == [66]
+    for query in (values[0], 'genre 3, genre 149', 'No Genre'):
+        wanted = reference([query], vocabulary)[0]
+        query_bits = vocabulary.query(query)
+        assert list(overlap(bits, query_bits)) == [len(genres & wanted) for genres in sets]
+        expected = [len(genres & wanted) / len(genres | wanted) if genres | wanted else 0.0 for genres in sets]
+        assert np.allclose(jaccard(bits, query_bits), expected)
@@ -0,0 +1,74 @@
+import threading
+import pytest
+from HybridRecSys import HybridRecSys
+from records import make_records
+
+def engine(answers, release=None, calls=None):
+    # recommend_many answering {track_id: [(track_id, row), ...]}, blocked until release is set when given
+    def recommend_many(track_ids, num_recs=30):
+        if calls is not None:
+            calls.append(list(track_ids))
+        if release is not None:
+            release.wait(10)
+        entries = [(seed, rank, row, track) for seed, track_id in enumerate(track_ids)
+                   for rank, (track, row) in enumerate(answers.get(track_id, [])[:num_recs], start=1)]
+        return make_records(*zip(*entries)) if entries else make_records([], [], [], [])
+    return recommend_many
+
+def failing(track_ids, num_recs=30):
+    raise RuntimeError('engine failed')
+
+def recommended(records, seed):
+    return [(str(track), int(row)) for track, row in zip(records['track_id'][records['seed'] == seed], records['row'][records['seed'] == seed])]
+
+@pytest.fixture
+def engines():
+    return {
+        'a': engine({'s0': [('t1', 101), ('t2', 102), ('t3', 303)]}),
+        'b': engine({'s0': [('t2', 202), ('t4', 204)]}),
+        'popular': engine({'s0': [('t3', 303), ('t5', 305), ('t6', 306)], 's1': [('t8', 308), ('t9', 309)]}),
+        'random': engine({'s0': [('t7', 407), ('t5', 405)], 's1': [('t9', 409), ('t10', 410)]}),
+    }
+
+def test_weighted_rrf_then_fallbacks(engines):
+    hybrid = HybridRecSys(engines, weights={'b': 2.0}, budget=5, rrf_k=1)
+    records = hybrid.recommend_many(['s0', 's1', 'unknown'], num_recs=7)
+    # t2: 1/3 + 2/2, t4: 2/3, t1: 1/2, t3: 1/4 (popular's row, its best ranked entry), then popular, then random
+    assert recommended(records, 0) == [('t2', 202), ('t4', 204), ('t1', 101), ('t3', 303), ('t5', 305), ('t6', 306), ('t7', 407)]
+    assert recommended(records, 1) == [('t8', 308), ('t9', 409), ('t10', 410)] # no primary results, t9 once, at popular's place
+    assert recommended(records, 2) == []
+    assert list(records['rank'][records['seed'] == 0]) == list(range(1, 8))
+    assert recommended(hybrid.recommend_many(['s0'], num_recs=3), 0) == [('t2', 202), ('t4', 204), ('t1', 101)]
+    assert {name: report['status'] for name, report in hybrid.last_report.items() if name != 'total_ms'} == dict.fromkeys(engines, 'ok')
+    assert all(hybrid.last_report[name]['ms'] >= 0 for name in engines) and hybrid.last_report['total_ms'] >= 0
+    hybrid.close()
+
+def test_late_engines_are_dropped_and_the_fallback_fills_in(engines):
+    release, calls = threading.Event(), []
+    engines['b'] = engine({'s0': [('t9', 209)]}, release=release, calls=calls)
+    hybrid = HybridRecSys(engines, budget=0.05, rrf_k=1)
+    try:
+        records = hybrid.recommend_many(['s0'], num_recs=5)
+        assert hybrid.last_report['b'] == {'status': 'late'} and hybrid.last_report['a']['status'] == 'ok'
+        assert recommended(records, 0) == [('t1', 101), ('t2', 102), ('t3', 303), ('t5', 305), ('t6', 306)]
+        assert hybrid.last_report['total_ms'] < 5000
+
+        # Still running: the next request does not queue another call behind it
+        hybrid.recommend_many(['s0'], num_recs=5)
+        assert hybrid.last_report['b'] == {'status': 'busy'} and len(calls) == 1
+    finally:
+        release.set()
+    hybrid.running['b'].result(10)
+    report = hybrid.report()
+    assert report['b']['calls'] == 2 and report['b']['late'] == 1 and report['b']['busy'] == 1
+    assert report['b']['p50_ms'] is not None # the late call is timed once it ends
+    hybrid.close()
+
+def test_failing_engines_are_reported(engines):
+    engines['b'] = failing
+    hybrid = HybridRecSys(engines, budget=5, rrf_k=1)
+    records = hybrid.recommend_many(['s0'], num_recs=3)
+    assert hybrid.last_report['b']['status'] == 'error' and 'engine failed' in hybrid.last_report['b']['error']
+    assert recommended(records, 0) == [('t1', 101), ('t2', 102), ('t3', 303)]
+    assert hybrid.report()['b']['errors'] == 1
+    hybrid.close()
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ItemItemRecSys import ItemItemRecSys, _similar_tracks, playlist_matrix
+
+# Five playlists over the tracks a to e. a and b are always together (cosine 1), c and d share one playlist
+# (1 / sqrt(2 * 2) = 0.5), a or b share one playlist with c and with d (1 / sqrt(3 * 2)), e is alone
+PLAYLISTS = [['a', 'b', 'c', 'a'], ['a', 'b'], ['a', 'b', 'd'], ['c', 'd'], ['e']]
+LOW = 1 / np.sqrt(6)
+
+def fit(**params):
+    return ItemItemRecSys(workers=0, **params).fit(iter(PLAYLISTS))
+
+def memory_mapped(array):
+    # scipy keeps a view of the array it is given, the memmap is one of its bases
+    while array is not None and not isinstance(array, np.memmap):
+        array = getattr(array, 'base', None)
+    return array is not None
+
+def neighbours(model, track_id):
+    row = model.similarity[model.lookup([track_id])[0]]
+    return list(model.track_ids[row.indices]), list(row.data)
+
+def test_playlist_matrix():
+    matrix, track_ids = playlist_matrix(iter(PLAYLISTS))
+    assert list(track_ids) == ['a', 'b', 'c', 'd', 'e']
+    assert matrix.shape == (5, 5) and matrix.indices.dtype == np.int32
+    np.testing.assert_array_equal(matrix.toarray(), [[1, 1, 1, 0, 0], [1, 1, 0, 0, 0], [1, 1, 0, 1, 0], [0, 0, 1, 1, 0], [0, 0, 0, 0, 1]])
+
+def test_similarity_is_pruned_to_top_k_and_sorted():
+    model = fit(top_k=2)
+    np.testing.assert_array_equal(np.diff(model.similarity.indptr), [2, 2, 2, 2, 0])
+    ids, scores = neighbours(model, 'a')
+    assert ids == ['b', 'c'] # c and d tie, the lower column wins
+    np.testing.assert_allclose(scores, [1.0, LOW], rtol=1e-6)
+    ids, scores = neighbours(model, 'd')
+    assert ids == ['c', 'a']
+    np.testing.assert_allclose(scores, [0.5, LOW], rtol=1e-6)
+
+    model = fit(top_k=100)
+    ids, scores = neighbours(model, 'c')
+    assert ids == ['d', 'a', 'b'] # never itself
+    np.testing.assert_allclose(scores, [0.5, LOW, LOW], rtol=1e-6)
+    assert np.diff(fit(top_k=1).similarity.indptr).max() == 1
+
+def test_shrinkage_and_chunks():
+    matrix, _ = playlist_matrix(iter(PLAYLISTS))
+    by_playlist = matrix.astype(np.float32).tocsr()
+    by_track = by_playlist.T.tocsr()
+    norms = np.sqrt(np.diff(by_track.indptr)).astype(np.float32)
+    counts, columns, scores = _similar_tracks(2, 4, 2, 1.0, (by_track, by_playlist, norms))
+    np.testing.assert_array_equal(counts, [2, 2])
+    np.testing.assert_array_equal(columns, [3, 0, 2, 0])
+    np.testing.assert_allclose(scores, [1 / 3, 1 / (np.sqrt(6) + 1), 1 / 3, 1 / (np.sqrt(6) + 1)], rtol=1e-6)
+
+    # Tiny chunks, in this process and on worker processes, give the same matrix as one chunk
+    whole = fit(top_k=3).similarity
+    for workers in (0, 2):
+        chunked = ItemItemRecSys(top_k=3, chunk_entries=2, workers=workers).fit(iter(PLAYLISTS)).similarity
+        np.testing.assert_array_equal(chunked.indptr, whole.indptr)
+        np.testing.assert_array_equal(chunked.indices, whole.indices)
+        np.testing.assert_allclose(chunked.data, whole.data)
+
+def test_recommend_many_and_recommend():
+    model = fit(top_k=3)
+    records = model.recommend_many(['c', 'unknown', 'e', 'a'], num_recs=2)
+    assert records['seed'].tolist() == [0, 0, 3, 3]
+    assert records['rank'].tolist() == [1, 2, 1, 2]
+    assert records['track_id'].tolist() == ['d', 'a', 'b', 'c']
+    np.testing.assert_array_equal(records['row'], model.lookup(records['track_id']))
+
+    playlist = model.recommend(['a', 'c', 'unknown'], num_recs=5)
+    assert playlist['track_id'].tolist() == ['b', 'd']
+    np.testing.assert_allclose(playlist['score'], [1.0 + LOW, LOW + 0.5], rtol=1e-6)
+
+def test_use_catalog():
+    # d is not in the catalog, b is listed twice
+    catalog = pd.DataFrame({'track_id': ['x', 'b', 'c', 'a', 'b', 'e']})
+    model = fit(top_k=3).use_catalog(catalog)
+    records = model.recommend_many(['c', 'a'], num_recs=2)
+    assert records['track_id'].tolist() == ['a', 'b', 'b', 'c']
+    assert records['rank'].tolist() == [1, 2, 1, 2]
+    assert records['row'].tolist() == [3, 1, 1, 2]
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load_round_trip(mmap, tmp_path):
+    model = fit(top_k=2)
+    model.save(str(tmp_path / 'itemitem'))
+    loaded = ItemItemRecSys.load(str(tmp_path / 'itemitem'), mmap=mmap)
+    assert memory_mapped(loaded.similarity.data) == mmap
+    assert (loaded.top_k, loaded.num_playlists, loaded.model_version) == (2, 5, model.model_version)
+    assert list(loaded.track_ids) == list(model.track_ids)
+    seeds = ['a', 'b', 'c', 'd', 'e', 'unknown']
+    np.testing.assert_array_equal(loaded.recommend_many(seeds, 2), model.recommend_many(seeds, 2))
+    pd.testing.assert_frame_equal(loaded.recommend(['a', 'd']), model.recommend(['a', 'd']))
@@ -0,0 +1,78 @@
+import json
+import os
+import numpy as np
+import pytest
+import mpd_ingest
+from mpd_ingest import DICT_SEPARATOR, InteractionStore, ingest, slice_paths
+
+# (pid, [(track, artist), ...]) per slice, tracks and artists are reused across slices
+SLICES = {
+    'mpd.slice.0-1.json': [(0, [('A', 'x'), ('B', 'y')]), (1, [('B', 'y'), ('C', 'x')])],
+    'mpd.slice.2-3.json': [(2, [('C', 'x'), ('D', 'z')]), (3, [('A', 'x')])],
+    'mpd.slice.4-4.json': [(4, [('E', 'w'), ('A', 'x'), ('F', 'y')])],
+}
+
+@pytest.fixture
+def data_dir(tmp_path):
+    directory = tmp_path / 'mpd'
+    directory.mkdir()
+    for name, playlists in SLICES.items():
+        payload = {'playlists': [{'pid': pid, 'tracks': [{'pos': pos, 'track_uri': 'spotify:track:' + track, 'artist_name': artist}
+                                                          for pos, (track, artist) in enumerate(tracks)]}
+                                 for pid, tracks in playlists]}
+        (directory / name).write_text(json.dumps(payload), encoding='utf-8')
+    return directory
+
+def check_store(store):
+    # The store of all three slices, whatever the runs that built it
+    assert store.num_chunks == 3 and store.num_rows == 10
+    assert list(store.track_ids()) == ['A', 'B', 'C', 'D', 'E', 'F']
+    assert list(store.artist_names()) == ['x', 'y', 'z', 'w']
+    assert store.manifest['sizes'] == {'track_uri': 6, 'artist_name': 4}
+    assert list(store.artist_names()[store.track_artist()]) == ['x', 'y', 'x', 'z', 'w', 'y']
+    interactions = store.interactions()
+    assert list(interactions['playlist_id']) == [0, 0, 1, 1, 2, 2, 3, 4, 4, 4]
+    assert list(store.track_ids()[interactions['track_id']]) == ['A', 'B', 'B', 'C', 'C', 'D', 'A', 'E', 'A', 'F']
+    assert list(interactions['position']) == [0, 1, 0, 1, 0, 1, 0, 0, 1, 2]
+    for vocabulary, values in (('track_uri', [f'spotify:track:{track}' for track in 'ABCDEF']), ('artist_name', ['x', 'y', 'z', 'w'])):
+        with open(os.path.join(store.path, f'{vocabulary}.dict'), 'rb') as f: # nothing left by the interrupted run
+            assert f.read().decode('utf-8') == DICT_SEPARATOR.join(values)
+    matrix, playlist_ids, track_ids = store.playlist_matrix()
+    assert matrix.shape == (5, 6) and list(playlist_ids) == [0, 1, 2, 3, 4] and matrix.nnz == 10
+
+def test_slices_are_ordered_by_number(data_dir):
+    (data_dir / 'mpd.slice.10-11.json').write_text('{"playlists": []}')
+    assert [os.path.basename(path) for path in slice_paths(str(data_dir))] == [
+        'mpd.slice.0-1.json', 'mpd.slice.2-3.json', 'mpd.slice.4-4.json', 'mpd.slice.10-11.json']
+
+def test_an_interrupted_ingest_resumes(data_dir, tmp_path, monkeypatch):
+    paths = slice_paths(str(data_dir))
+    store_path = str(tmp_path / 'store')
+    store = ingest(paths[:2], store_path, workers=0, verbose=False)
+    assert store.num_chunks == 2 and store.num_rows == 7
+    assert len(store.vocabularies['track_uri']) == 4 and len(store.vocabularies['artist_name']) == 3
+
+    # The third slice is written (chunk files and dictionary entries) but the run dies before its manifest is in place
+    replace = os.replace
+    def interrupted(source, target):
+        if target.endswith('manifest.json'):
+            raise KeyboardInterrupt
+        replace(source, target)
+    monkeypatch.setattr(mpd_ingest.os, 'replace', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        ingest(paths, store_path, workers=0, verbose=False)
+    monkeypatch.setattr(mpd_ingest.os, 'replace', replace)
+    store = InteractionStore(store_path)
+    assert store.num_chunks == 2 and store.num_rows == 7 and len(store.vocabularies['track_uri']) == 4
+    assert os.path.exists(os.path.join(store_path, 'chunks', '00002.track_id.npy'))
+    assert os.path.getsize(os.path.join(store_path, 'track_uri.dict')) > store.manifest['bytes']['track_uri']
+
+    check_store(ingest(paths, store_path, workers=0, verbose=False))
+    check_store(InteractionStore(store_path))
+    assert ingest(paths, store_path, workers=0, verbose=False).num_chunks == 3 # nothing left to do
+
+def test_worker_processes_build_the_same_store(data_dir, tmp_path):
+    paths = slice_paths(str(data_dir))
+    check_store(ingest(paths, str(tmp_path / 'store'), workers=2, verbose=False))
+    store = ingest(paths[:1], str(tmp_path / 'store'), workers=0, resume=False, verbose=False) # started over
+    assert store.num_chunks == 1 and store.num_rows == 4
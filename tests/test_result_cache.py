@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+import numpy as np
+import pytest
+import result_cache
+from benchmarks.synthetic import make_catalog
+from records import make_records
+from result_cache import MISSING, CachedEngine, ResultCache, seed_key
+from server import load_engines
+
+class Clock:
+    # Stands in for the time module, moved by hand
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_cache, 'time', clock)
+    return clock
+
+def test_results_expire_after_the_ttl(clock, tmp_path):
+    cache = ResultCache(ttl=10, path=str(tmp_path / 'results.sqlite'))
+    cache.put(('popular', 'a', 5, 'v1'), [1, 2])
+    clock.now += 9
+    assert cache.get(('popular', 'a', 5, 'v1')) == [1, 2]
+    clock.now += 1
+    assert cache.get(('popular', 'a', 5, 'v1')) is MISSING # expired in memory and on disk
+    assert cache.stats()['expirations'] == 1
+
+    cache.put(('popular', 'b', 5, 'v1'), [3])
+    clock.now += 10
+    assert cache.evict_expired() == 1
+    assert len(cache) == 0
+    assert cache.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0] == 0
+    cache.close()
+
+def test_the_least_recently_used_result_is_evicted(clock):
+    cache = ResultCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is MISSING and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1 and len(cache) == 2
+
+def test_disk_results_survive_a_restart(clock, tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    cache = ResultCache(ttl=10, path=path)
+    cache.put(('collab', 'a', 5, 'v1'), np.arange(3))
+    cache.close()
+    cache = ResultCache(max_entries=1, ttl=10, path=path)
+    assert list(cache.get(('collab', 'a', 5, 'v1'))) == [0, 1, 2]
+    assert cache.stats()['disk_hits'] == 1 and len(cache) == 1 # moved back into memory
+    cache.close()
+
+def test_memory_hits_do_not_wait_for_the_disk(tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'results.sqlite'))
+    with cache.disk_lock: # a slow commit in progress
+        writer = threading.Thread(target=cache.put, args=(('popular', 'a', 5, 'v1'), [1]))
+        writer.start()
+        deadline = time.monotonic() + 5
+        while cache.get(('popular', 'a', 5, 'v1'), None) is None and time.monotonic() < deadline:
+            time.sleep(0.001)
+        assert cache.get(('popular', 'a', 5, 'v1')) == [1]
+        assert writer.is_alive() # still waiting to write the file
+    writer.join()
+    assert cache.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0] == 1
+    cache.close()
+
+def test_concurrent_requests_share_one_computation():
+    cache = ResultCache()
+    calls = []
+    def compute():
+        calls.append(1)
+        deadline = time.monotonic() + 5
+        while cache.stats()['coalesced'] < 7 and time.monotonic() < deadline: # every other thread is waiting
+            time.sleep(0.001)
+        return 'result'
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('key', compute))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['result'] * 8 and len(calls) == 1
+    stats = cache.stats()
+    assert stats['misses'] == 1 and stats['coalesced'] == 7 and stats['inflight'] == 0
+    assert cache.get_or_compute('key', compute) == 'result' and len(calls) == 1
+
+def test_concurrent_tasks_share_one_computation():
+    cache = ResultCache()
+    calls = []
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+    async def run():
+        return await asyncio.gather(*[cache.get_or_compute_async('key', compute) for _ in range(5)])
+    assert asyncio.run(run()) == ['result'] * 5 and len(calls) == 1
+    assert cache.stats()['coalesced'] == 4
+
+def test_errors_reach_every_waiting_request_and_are_not_cached():
+    cache = ResultCache()
+    def fail():
+        raise RuntimeError('engine failed')
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute('key', fail)
+    assert cache.get_or_compute('key', lambda: 'result') == 'result'
+
+def test_a_new_model_version_invalidates_the_engine(clock, tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'results.sqlite'))
+    cache.check_version('collab', 'v1')
+    cache.put(('collab', 'a', 5, 'v1'), [1])
+    cache.put(('popular', 'a', 5, 'p1'), [2])
+    cache.check_version('collab', 'v1')
+    assert cache.get(('collab', 'a', 5, 'v1')) == [1]
+    cache.check_version('collab', 'v2')
+    assert cache.get(('collab', 'a', 5, 'v1')) is MISSING and cache.get(('popular', 'a', 5, 'p1')) == [2]
+    assert cache.stats()['invalidations'] == 1
+    assert cache.connection.execute('SELECT engine FROM results').fetchall() == [('popular',)]
+    cache.close()
+
+def test_wrap_keys_playlists_by_their_tracks():
+    class Model:
+        model_version = 'v1'
+        def recommend(self, seed, num_recs):
+            calls.append(seed)
+            return [num_recs]
+    calls, model = [], Model()
+    recommend = ResultCache().wrap('collab', model.recommend)
+    assert recommend(['a', 'b'], 3) == [3] and recommend(['a', 'b'], 3) == [3] and recommend(['b', 'a'], 3) == [3]
+    assert len(calls) == 2 and seed_key(['a', 'b']).startswith('playlist:')
+    model.model_version = 'v2'
+    assert recommend(['a', 'b'], 3) == [3] and len(calls) == 3
+
+class Engine:
+    # recommend_many that recommends the next num_recs letters and records its calls
+    model_version = 'v1'
+
+    def __init__(self):
+        self.calls = []
+
+    def recommend_many(self, track_ids, num_recs=30):
+        self.calls.append(list(track_ids))
+        seeds = [seed for seed, track_id in enumerate(track_ids) if track_id != 'unknown' for _ in range(num_recs)]
+        rows = [ord(track_ids[seed]) - ord('a') + rank for seed in dict.fromkeys(seeds) for rank in range(1, num_recs + 1)]
+        return make_records(seeds, [rank + 1 for rank in range(num_recs)] * len(set(seeds)), rows, [chr(ord('a') + row) for row in rows])
+
+def test_cached_engine_computes_only_the_missing_seeds():
+    engine = Engine()
+    cached = CachedEngine('collab', engine.recommend_many, ResultCache())
+    first = cached(['a', 'c', 'unknown', 'a'], 2)
+    expected = engine.recommend_many(['a', 'c', 'unknown', 'a'], 2)
+    assert first.dtype == expected.dtype and first.tolist() == expected.tolist()
+    assert engine.calls[0] == ['a', 'c', 'unknown'] # duplicate seeds computed once
+    second = cached(['c', 'e'], 2)
+    assert engine.calls[-1] == ['e']
+    assert second.tolist() == engine.recommend_many(['c', 'e'], 2).tolist()
+    engine.model_version = 'v2'
+    cached(['c'], 2)
+    assert engine.calls[-1] == ['c'] # a new model is asked again
+
+def test_load_engines_puts_the_cached_engines_behind_the_cache():
+    catalog = make_catalog(300)
+    cache = ResultCache()
+    engines = load_engines(catalog, ['popular', 'random'], cache=cache)
+    assert isinstance(engines['popular'], CachedEngine) and not isinstance(engines['random'], CachedEngine)
+    track_ids = list(catalog['track_id'][:4])
+    first = engines['popular'](track_ids, 5)
+    assert engines['popular'](track_ids, 5).tolist() == first.tolist()
+    assert cache.stats()['hits'] == 4
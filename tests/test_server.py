@@ -0,0 +1,104 @@
+import asyncio
+import json
+import threading
+import pytest
+from benchmarks.synthetic import make_catalog
+from PopularRecSys import PopularRec
+from result_cache import ResultCache
+from server import RecommendationServer
+
+@pytest.fixture(scope='module')
+def catalog():
+    return make_catalog(300)
+
+class SpyEngine:
+    # recommend_many of the popular recommender that records its calls and can be held until release is set
+    def __init__(self, catalog, hold=False):
+        self.model = PopularRec(catalog)
+        self.model_version = self.model.model_version
+        self.calls = []
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def recommend_many(self, track_ids, num_recs=30):
+        self.calls.append(list(track_ids))
+        self.release.wait(10)
+        return self.model.recommend_many(track_ids, num_recs)
+
+async def get(port, path):
+    # One request on its own connection: (status, headers, decoded body)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    headers = dict(line.split(': ', 1) for line in lines[1:])
+    body = body.decode('utf-8')
+    return int(lines[0].split(' ')[1]), headers, json.loads(body) if headers['Content-Type'] == 'application/json' else body
+
+def serve(engine, catalog, test, **params):
+    # Run test(server) against a server listening on a free port
+    async def run():
+        server = RecommendationServer({'popular': engine.recommend_many}, catalog, port=0, **params)
+        await server.start()
+        try:
+            return await test(server)
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+def test_concurrent_requests_are_merged_into_one_batch(catalog):
+    engine = SpyEngine(catalog)
+    track_ids = list(catalog['track_id'][:10])
+    async def test(server):
+        return await asyncio.gather(*[get(server.port, f'/recommend/popular?track_id={track_id}&num_recs={3 + i % 2}')
+                                      for i, track_id in enumerate(track_ids)])
+    responses = serve(engine, catalog, test, max_wait=0.2)
+    assert len(engine.calls) == 1 and sorted(engine.calls[0]) == sorted(track_ids)
+    expected = engine.model.recommend_many(track_ids, 4)
+    for i, (status, _, body) in enumerate(responses):
+        assert status == 200 and body['track_id'] == track_ids[i]
+        assert [rec['track_id'] for rec in body['recommendations']] == list(expected['track_id'][expected['seed'] == i][:3 + i % 2])
+        assert [rec['rank'] for rec in body['recommendations']] == list(range(1, len(body['recommendations']) + 1))
+    assert {len(body['recommendations']) for _, _, body in responses} == {3, 4} # every request keeps its own num_recs
+
+def test_requests_beyond_the_queue_limit_get_503(catalog):
+    engine = SpyEngine(catalog, hold=True)
+    track_ids = list(catalog['track_id'][:5])
+    async def test(server):
+        requests = [asyncio.ensure_future(get(server.port, f'/recommend/popular?track_id={track_id}')) for track_id in track_ids]
+        metrics = server.batchers['popular'].metrics
+        for _ in range(500):
+            if metrics.requests == 5:
+                break
+            await asyncio.sleep(0.01)
+        engine.release.set() # the two accepted requests can finish now
+        return await asyncio.gather(*requests), metrics
+    responses, metrics = serve(engine, catalog, test, max_pending=2, max_wait=0)
+    statuses = sorted(status for status, _, _ in responses)
+    assert statuses == [200, 200, 503, 503, 503]
+    assert all(headers.get('Retry-After') == '1' for status, headers, _ in responses if status == 503)
+    assert metrics.rejected == 3
+
+def test_health_metrics_and_errors(catalog):
+    engine = SpyEngine(catalog)
+    track_id = catalog['track_id'][0]
+    async def test(server):
+        return {path: await get(server.port, path) for path in (
+            '/health', f'/recommend/popular?track_id={track_id}&num_recs=2', f'/recommend/popular?track_id={track_id}&num_recs=2',
+            '/recommend/popular?track_id=unknown', '/recommend/collab?track_id=x', '/recommend/popular?track_id=x&num_recs=0',
+            '/metrics', '/metrics/prometheus')}
+    responses = serve(engine, catalog, test, max_wait=0, cache=ResultCache())
+    status, _, health = responses['/health']
+    assert status == 200 and health['status'] == 'ok' and health['engines'] == ['popular'] and health['songs'] == 300
+    assert responses['/recommend/popular?track_id=unknown'][0] == 404
+    assert responses['/recommend/collab?track_id=x'][0] == 404
+    assert responses['/recommend/popular?track_id=x&num_recs=0'][0] == 400
+    assert len(engine.calls) == 2 # the repeated request came from the cache, 'unknown' was computed
+    status, _, metrics = responses['/metrics']
+    assert status == 200 and metrics['engines']['popular']['batches'] == 2 and metrics['cache']['hits'] == 1
+    status, headers, text = responses['/metrics/prometheus']
+    assert status == 200 and headers['Content-Type'].startswith('text/plain')
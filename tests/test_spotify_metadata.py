@@ -0,0 +1,103 @@
+import time
+import pytest
+from benchmarks.synthetic import make_catalog, make_playlist
+from fake_spotify import FakeSpotify
+from spotify_metadata import BATCH_SIZE, SpotifyMetadataFetcher
+
+class FlakyClient(FakeSpotify):
+    # Raises the queued errors on its first calls, then answers like FakeSpotify
+    def __init__(self, songs, errors):
+        fake = FakeSpotify.from_songs(songs)
+        super().__init__(fake.tracks_by_id, fake.artists_by_id, fake.playlists)
+        self.errors = list(errors)
+
+    def tracks(self, track_ids):
+        if self.errors:
+            self._count('tracks')
+            raise self.errors.pop(0)
+        return super().tracks(track_ids)
+
+@pytest.fixture(scope='module')
+def songs():
+    return make_playlist(make_catalog(1000), 120, new_fraction=0.0)
+
+def fetcher(client, **params):
+    params.setdefault('cache_path', ':memory:')
+    return SpotifyMetadataFetcher(client, requests_per_second=0, backoff=0, **params)
+
+def test_requests_are_batched_and_cached(songs):
+    client = FakeSpotify.from_songs(songs)
+    metadata = fetcher(client)
+    ids = list(songs['track_id']) + list(songs['track_id'][:10]) + ['unknown', None, '']
+    tracks = metadata.tracks(ids)
+    assert client.calls == {'tracks': 3} # 121 distinct ids, 50 per request
+    assert metadata.requests == 3 == -(-121 // BATCH_SIZE)
+    assert tracks['unknown'] is None
+    assert {track_id: track['id'] for track_id, track in tracks.items() if track} == {track_id: track_id for track_id in songs['track_id']}
+
+    assert metadata.tracks(ids) == tracks # cache hit, unknown ids included
+    assert client.calls == {'tracks': 3}
+
+def test_cache_outlives_the_fetcher(songs, tmp_path):
+    client = FakeSpotify.from_songs(songs)
+    fetcher(client, cache_path=str(tmp_path / 'cache' / 'metadata.sqlite')).tracks(list(songs['track_id']))
+    again = fetcher(client, cache_path=str(tmp_path / 'cache' / 'metadata.sqlite'))
+    again.tracks(list(songs['track_id']))
+    assert again.requests == 0
+
+def test_expired_entries_are_fetched_again(songs):
+    client = FakeSpotify.from_songs(songs)
+    metadata = fetcher(client, ttl=0.05)
+    ids = list(songs['track_id'][:60])
+    metadata.tracks(ids)
+    assert metadata.cache.evict_expired() == 0
+    time.sleep(0.1)
+    metadata.tracks(ids)
+    assert client.calls['tracks'] == 4
+    time.sleep(0.1)
+    assert metadata.cache.evict_expired() == 60
+    assert metadata.cache.get_many('track', ids) == {}
+
+def test_song_rows_and_track_summary(songs):
+    client = FakeSpotify.from_songs(songs)
+    metadata = fetcher(client)
+    rows = metadata.track_rows(list(songs['track_id'][:5]) + ['unknown'])
+    assert [row['track_id'] for row in rows] == list(songs['track_id'][:5])
+    assert [row['genre'] for row in rows] == list(songs['genre'][:5])
+    assert client.calls == {'tracks': 1, 'artists': 1}
+    name, artist, genres = metadata.track_summary(songs['track_id'].iloc[0])
+    assert (name, artist, genres) == (songs['track_name'].iloc[0], songs['artist_names'].iloc[0], [songs['genre'].iloc[0]])
+    with pytest.raises(KeyError):
+        metadata.track_summary('unknown')
+
+def test_transient_errors_are_retried(songs):
+    spotipy = pytest.importorskip('spotipy')
+    requests = pytest.importorskip('requests')
+    errors = [spotipy.SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '0'}),
+              spotipy.SpotifyException(503, -1, 'unavailable'), requests.ConnectionError(), ConnectionResetError()]
+    client = FlakyClient(songs, errors)
+    metadata = fetcher(client)
+    tracks = metadata.tracks(list(songs['track_id'][:10]))
+    assert len(tracks) == 10 and all(tracks.values())
+    assert metadata.requests == client.calls['tracks'] == 5
+
+    client = FlakyClient(songs, [ConnectionResetError()] * 3)
+    with pytest.raises(ConnectionResetError):
+        fetcher(client, max_retries=2).tracks(list(songs['track_id'][:10]))
+    assert client.calls['tracks'] == 3
+
+@pytest.mark.parametrize('status', [400, 401, 404])
+def test_client_errors_are_not_retried(songs, status):
+    spotipy = pytest.importorskip('spotipy')
+    client = FlakyClient(songs, [spotipy.SpotifyException(status, -1, 'no')])
+    metadata = fetcher(client)
+    with pytest.raises(spotipy.SpotifyException):
+        metadata.tracks(list(songs['track_id'][:10]))
+    assert metadata.requests == client.calls['tracks'] == 1
+
+def test_bugs_are_not_retried(songs):
+    client = FlakyClient(songs, [KeyError('id')])
+    metadata = fetcher(client)
+    with pytest.raises(KeyError):
+        metadata.tracks(list(songs['track_id'][:10]))
+    assert metadata.requests == 1
@@ -1,5 +1,7 @@
 import pandas as pd
 import re
+from instrumentation import instrumented
+from spotify_metadata import SpotifyMetadataFetcher
 
 def process_artist(spotify_client, artist_name):
     """
@@ -27,52 +29,30 @@ def process_artist(spotify_client, artist_name):
 
     return genre_string
 
-def get_user_liked_songs(spotify_client, user_id):
+@instrumented('utils.liked_songs', items=len)
+def get_user_liked_songs(spotify_client, user_id, fetcher=None):
     """
     This helper function retrieves the user's liked songs from Spotify and saves them to a CSV file.
 
     Parameters:
         spotify_client (spotipy.Spotify): Spotify client object used to interact with Spotify API.
         user_id (str): ID of the user.
+        fetcher (SpotifyMetadataFetcher): Batched, cached metadata fetcher, one wrapping spotify_client if None.
 
     Returns:
         pandas.DataFrame: DataFrame containing the user's liked songs.
     """
-    liked_songs = [] # Create an empty list to store the liked songs
+    fetcher = fetcher or SpotifyMetadataFetcher(client=spotify_client)
+    liked_tracks = [] # Create an empty list to store the liked tracks
     results = spotify_client.current_user_saved_tracks() # Get the user's liked tracks
-    liked_tracks = results['items']
-
-    while results['next']: # Loop through the user's liked tracks and extract the necessary information
-        for track in liked_tracks: # Extract track information
-            track_id = track['track']['id']
-            track_name = track['track']['name']
-            artists = [artist['name'] for artist in track['track']['artists']] # there could be more than one artist
-            artist_names = ', '.join(artists) # join artists name with a comma
-            popularity = track['track']['popularity']
-            duration_ms = track['track']['duration_ms']
-            explicit = track['track']['explicit']
-            album = track['track']['album']['name']
-            release_date = track['track']['album']['release_date'] # in a time format, maybe drop and get year only
-            uri = track['track']['uri']
-
-            genre = process_artist(spotify_client, artists[0]) # Get the genres for the main artist (assuming the first artist is the main artist)
-            liked_songs.append({  # Append the track information to the list of liked songs
-                'track_id': track_id,
-                'track_name': track_name,
-                'artist_names': artist_names,
-                'popularity': popularity,
-                'duration_ms': duration_ms,
-                'explicit': explicit,
-                'album': album,
-                'release_date': release_date,
-                'uri': uri,
-                'genre': genre
-            })
-
+    while True: # Loop through every page of the user's liked tracks
+        liked_tracks.extend(item['track'] for item in results['items'])
+        if not results['next']:
+            break
         results = spotify_client.next(results) # Move to the next set of liked tracks
-        liked_tracks = results['items']
 
-    liked_songs_df = pd.DataFrame(liked_songs) # Convert the list of dictionaries to a DataFrame
+    # Extract the track information, the genres of all main artists are fetched in batches
+    liked_songs_df = pd.DataFrame(fetcher.song_rows(liked_tracks)) # Convert the list of dictionaries to a DataFrame
     liked_songs_df.to_csv(f'{user_id}_liked_songs.csv', index=False) # Save the DataFrame to a CSV file before returning
     return liked_songs_df
 
@@ -84,52 +64,29 @@ def get_playlist_id(playlist_url):
     else:
         raise ValueError(f"Invalid playlist URL: {playlist_url}")
 
-def get_playlist_songs(spotify_client, playlist_url):
+@instrumented('utils.playlist_songs', items=len)
+def get_playlist_songs(spotify_client, playlist_url, fetcher=None):
     """
     This function retrieves the songs from a given Spotify playlist and saves them to a CSV file.
 
     Parameters:
     spotify_client (spotipy.Spotify): Spotify client object used to interact with Spotify API.
     playlist_url (str): URL of the Spotify playlist.
+    fetcher (SpotifyMetadataFetcher): Batched, cached metadata fetcher, one wrapping spotify_client if None.
 
     Returns:
     pandas.DataFrame: DataFrame containing the songs in the playlist.
     """
+    fetcher = fetcher or SpotifyMetadataFetcher(client=spotify_client)
+
     # Extract the playlist ID from the URL
     playlist_id = get_playlist_id(playlist_url)
 
     # Get the track IDs from the playlist
     track_ids = get_playlist_track_ids(spotify_client, playlist_id)
 
-    # Get track details for each track ID
-    playlist_songs = []
-    for track_id in track_ids:
-        track_info = spotify_client.track(track_id)
-        track_name = track_info['name']
-        artists = [artist['name'] for artist in track_info['artists']]
-        artist_names = ', '.join(artists)
-        popularity = track_info['popularity']
-        duration_ms = track_info['duration_ms']
-        explicit = track_info['explicit']
-        album = track_info['album']['name']
-        release_date = track_info['album']['release_date']
-        uri = track_info['uri']
-        genre = process_artist(spotify_client, artists[0])  # Get the genres for the main artist
-
-        playlist_songs.append({
-            'track_id': track_id,
-            'track_name': track_name,
-            'artist_names': artist_names,
-            'popularity': popularity,
-            'duration_ms': duration_ms,
-            'explicit': explicit,
-            'album': album,
-            'release_date': release_date,
-            'uri': uri,
-            'genre': genre
-        })
-
-    playlist_songs_df = pd.DataFrame(playlist_songs)
+    # Get track details (and the genres of their main artists) in batches, skipping what is already cached
+    playlist_songs_df = pd.DataFrame(fetcher.track_rows(track_ids))
 
     # Get the playlist name
     playlist = spotify_client.playlist(playlist_id)
@@ -140,6 +97,7 @@ def get_playlist_songs(spotify_client, playlist_url):
 
     return playlist_songs_df
 
+@instrumented('utils.playlist_track_ids', items=len)
 def get_playlist_track_ids(spotify_client, playlist_id):
     track_ids = []
     results = spotify_client.playlist_tracks(playlist_id)